@@ -0,0 +1,345 @@
+import os
+import re
+import json
+import struct
+import random
+from datetime import datetime, timedelta
+
+
+# Metadata files whose name differs from the event directory
+METADATA_FILES = {"network-scanning": "metadata-masscan.json"}
+
+PROTOCOL_STACKS = {
+    6: "eth:ethertype:ip:tcp",
+    17: "eth:ethertype:ip:udp",
+    1: "eth:ethertype:ip:icmp:data",
+}
+APPLICATION_PORTS = {"MQTT": (6, 1883), "CoAP": (17, 5683)}
+
+TCP_SYN, TCP_ACK, TCP_PSH = 0x002, 0x010, 0x008
+
+# Captures of different events do not overlap in time
+EVENT_OFFSETS = {
+    "benign": 0,
+    "coap-amplificator": 24,
+    "network-scanning": 48,
+    "merlin": 72,
+    "mirai-dos": 96,
+    "mirai-infection": 120,
+}
+
+
+class GothamTrafficGenerator:
+    def __init__(
+        self,
+        metadata_dir,
+        features_path,
+        seed=0,
+        n_devices=4,
+        attack_ratio=0.5,
+        start_time=datetime(2024, 10, 10, 14, 0, 0),
+    ):
+        """
+        Seeded generator of Gotham-like traffic, written both as pcap captures and as the
+        tab-separated fields tshark would extract from them.
+
+        Benign traffic is exchanged between the device IPs of metadata-benign.json and
+        their servers over the device's application protocol. Malicious captures add
+        flood, scan and C&C packets following the rules of the event's metadata that
+        apply to the device. GRE rules are skipped since the preprocessing stage only
+        handles TCP, UDP and ICMP.
+
+        Parameters:
+            metadata_dir (str): Directory containing the metadata JSON files.
+            features_path (str): Path to protocol_fields_output.json.
+            seed (int): Seed of the random generator.
+            n_devices (int): Number of device instances to generate traffic for.
+            attack_ratio (float): Share of malicious packets in the malicious captures.
+            start_time (datetime): Timestamp of the first packet.
+        """
+        self.metadata_dir = metadata_dir
+        self.seed = seed
+        self.attack_ratio = attack_ratio
+        self.start_time = start_time
+
+        with open(features_path, "r") as f:
+            self.fields = [feature["field"] for feature in json.load(f)["features"]]
+
+        with open(os.path.join(metadata_dir, "metadata-benign.json"), "r") as f:
+            self.benign_metadata = json.load(f)
+
+        # Spread the devices over the device types instead of taking one type only
+        instances = []
+        for index in range(
+            max(len(v["device_ip"]) for v in self.benign_metadata.values())
+        ):
+            for name, info in sorted(self.benign_metadata.items()):
+                if index < len(info["device_ip"]):
+                    instances.append(
+                        (f"{name}-{index + 1}", info["device_ip"][index], info)
+                    )
+        self.devices = instances[:n_devices]
+
+    def malicious_rules(self, event):
+        """Return the labelling rules of a malicious event."""
+        filename = METADATA_FILES.get(event, f"metadata-{event}.json")
+        with open(os.path.join(self.metadata_dir, filename), "r") as f:
+            return json.load(f)
+
+    @staticmethod
+    def _matches(pattern, ip):
+        return re.match(pattern.replace("x.x", ".*"), ip) is not None
+
+    def _benign_packet(self, rng, device_ip, info):
+        server_ip = rng.choice(info["server_ip"])
+        proto, port = APPLICATION_PORTS.get(info.get("iot_application"), (6, 443))
+        ephemeral = rng.randint(32768, 60999)
+        if rng.random() < 0.5:
+            return (device_ip, server_ip, proto, ephemeral, port, TCP_PSH | TCP_ACK)
+        return (server_ip, device_ip, proto, port, ephemeral, TCP_PSH | TCP_ACK)
+
+    def _malicious_packet(self, rng, device_ip, rule):
+        src = rule["source_ip"]
+        dst = rule["destination_ip"]
+        src = device_ip if "x" in src else src
+        dst = device_ip if "x" in dst else dst
+        if "UDP" in rule["label"] or "CoAP" in rule["label"]:
+            proto = 17
+        else:
+            proto = int(rule.get("protocol", 6))
+
+        sport = rule.get("source_port", rng.randint(1024, 65535))
+        dport = rule.get("destination_port", rng.randint(1, 1024))
+        if "Scan" in rule["label"] or "Flooding" in rule["label"]:
+            flags = TCP_SYN
+        else:
+            flags = TCP_PSH | TCP_ACK
+        return (src, dst, proto, sport, dport, flags)
+
+    def packets(self, device_ip, info, event, n_packets, rng):
+        """
+        Generate the time-ordered packets of one capture.
+
+        Returns:
+            list: Tuples of (time, src, dst, proto, sport, dport, tcp_flags, frame_len).
+        """
+        rules = []
+        if event != "benign":
+            rules = [
+                rule
+                for rule in self.malicious_rules(event)
+                if rule.get("protocol") != "47"
+                and (
+                    self._matches(rule["source_ip"], device_ip)
+                    or self._matches(rule["destination_ip"], device_ip)
+                )
+            ]
+
+        time = self.start_time + timedelta(hours=EVENT_OFFSETS.get(event, 0))
+        packets = []
+        for _ in range(n_packets):
+            if rules and rng.random() < self.attack_ratio:
+                rule = rng.choice(rules)
+                packet = self._malicious_packet(rng, device_ip, rule)
+                # Floods and scans are sent far faster than benign telemetry
+                time += timedelta(microseconds=rng.randint(1, 2000))
+                frame_len = rng.randint(60, 120)
+            else:
+                packet = self._benign_packet(rng, device_ip, info)
+                time += timedelta(microseconds=rng.randint(1000, 1_000_000))
+                frame_len = rng.randint(60, 600)
+            packets.append((time, *packet, frame_len))
+        return packets
+
+    @staticmethod
+    def _checksum(data):
+        if len(data) % 2:
+            data += b"\0"
+        total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+        while total >> 16:
+            total = (total & 0xFFFF) + (total >> 16)
+        return ~total & 0xFFFF
+
+    @staticmethod
+    def _ip_bytes(ip):
+        return bytes(int(part) for part in ip.split("."))
+
+    @staticmethod
+    def _mac(ip):
+        return "02:00:" + ":".join(f"{int(part):02x}" for part in ip.split("."))
+
+    def _encode(self, packet, ip_id):
+        """Encode a packet as an Ethernet frame and return it with its tshark fields."""
+        time, src, dst, proto, sport, dport, tcp_flags, frame_len = packet
+        options = bytes.fromhex("020405b40402080a") if tcp_flags == TCP_SYN else b""
+
+        if proto == 6:
+            header_len = 20 + len(options)
+            l4 = struct.pack(
+                "!HHIIHHHH",
+                sport,
+                dport,
+                ip_id,
+                0,
+                ((header_len // 4) << 12) | tcp_flags,
+                64240,
+                0,
+                0,
+            )
+            l4 += options
+        elif proto == 17:
+            l4 = struct.pack("!HHHH", sport, dport, 0, 0)
+        else:
+            l4 = struct.pack("!BBHHH", 8, 0, 0, ip_id & 0xFFFF, 1)
+
+        payload_len = max(0, frame_len - 14 - 20 - len(l4))
+        l4 += b"\0" * payload_len
+
+        pseudo = self._ip_bytes(src) + self._ip_bytes(dst)
+        pseudo += struct.pack("!BBH", 0, proto, len(l4))
+        if proto == 6:
+            l4_checksum = self._checksum(pseudo + l4)
+            l4 = l4[:16] + struct.pack("!H", l4_checksum) + l4[18:]
+        elif proto == 17:
+            l4 = l4[:4] + struct.pack("!H", len(l4)) + l4[6:]
+            l4_checksum = self._checksum(pseudo + l4)
+            l4 = l4[:6] + struct.pack("!H", l4_checksum) + l4[8:]
+        else:
+            l4_checksum = self._checksum(l4)
+            l4 = l4[:2] + struct.pack("!H", l4_checksum) + l4[4:]
+
+        ip_header = struct.pack(
+            "!BBHHHBBH4s4s",
+            0x45,
+            0,
+            20 + len(l4),
+            ip_id & 0xFFFF,
+            0x4000,  # Don't fragment
+            64,
+            proto,
+            0,
+            self._ip_bytes(src),
+            self._ip_bytes(dst),
+        )
+        ip_checksum = self._checksum(ip_header)
+        ip_header = ip_header[:10] + struct.pack("!H", ip_checksum) + ip_header[12:]
+
+        ethernet = bytes.fromhex(self._mac(dst).replace(":", ""))
+        ethernet += bytes.fromhex(self._mac(src).replace(":", ""))
+        ethernet += b"\x08\x00"
+        frame = ethernet + ip_header + l4
+
+        stack = PROTOCOL_STACKS[proto]
+        if proto == 6 and 1883 in (sport, dport) and payload_len:
+            stack += ":mqtt"
+        elif proto == 17 and 5683 in (sport, dport):
+            stack += ":coap"
+
+        # tshark pads single-digit days with a space
+        frame_time = (
+            f"{time:%b} {time.day:2d}, {time:%Y %H:%M:%S}.{time.microsecond:06d}000 BST"
+        )
+        values = {
+            "frame.time": frame_time,
+            "frame.len": len(frame),
+            "frame.protocols": stack,
+            "eth.src": self._mac(src),
+            "eth.dst": self._mac(dst),
+            "ip.dst": dst,
+            "ip.src": src,
+            "ip.flags": "0x02",
+            "ip.ttl": 64,
+            "ip.proto": proto,
+            "ip.checksum": f"0x{ip_checksum:04x}",
+        }
+        if proto == 6:
+            values.update(
+                {
+                    "tcp.srcport": sport,
+                    "tcp.dstport": dport,
+                    "tcp.flags": f"0x{tcp_flags:04x}",
+                    "tcp.window_size_value": 64240,
+                    "tcp.window_size_scalefactor": -1,
+                    "tcp.checksum": f"0x{l4_checksum:04x}",
+                    "tcp.options": options.hex(),
+                }
+            )
+        elif proto == 17:
+            values.update({"udp.srcport": sport, "udp.dstport": dport})
+
+        return frame, [str(values.get(field, "")) for field in self.fields]
+
+    def write_capture(self, packets, pcap_path=None, tsv_path=None):
+        """
+        Write packets as a libpcap capture and/or as tshark's tab-separated fields.
+
+        Parameters:
+            packets (list): Packets returned by packets().
+            pcap_path (str): Output pcap path (optional).
+            tsv_path (str): Output TSV path (optional).
+        """
+        pcap = tsv = None
+        try:
+            if pcap_path:
+                os.makedirs(os.path.dirname(pcap_path), exist_ok=True)
+                pcap = open(pcap_path, "wb")
+                pcap.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1))
+            if tsv_path:
+                os.makedirs(os.path.dirname(tsv_path), exist_ok=True)
+                tsv = open(tsv_path, "w")
+                tsv.write("\t".join(self.fields) + "\n")
+
+            for ip_id, packet in enumerate(packets):
+                frame, values = self._encode(packet, ip_id)
+                if pcap:
+                    seconds = int(packet[0].timestamp())
+                    header = struct.pack(
+                        "<IIII", seconds, packet[0].microsecond, len(frame), len(frame)
+                    )
+                    pcap.write(header + frame)
+                if tsv:
+                    tsv.write("\t".join(values) + "\n")
+        finally:
+            if pcap:
+                pcap.close()
+            if tsv:
+                tsv.close()
+
+    def generate(self, root, n_packets, events, write_pcaps=True, write_tsvs=True):
+        """
+        Generate one capture per device and event under a data directory laid out like
+        the real dataset (raw/ for the pcaps, extracted_features/ for the TSVs).
+
+        Parameters:
+            root (str): Data directory to write to.
+            n_packets (int): Number of packets per capture.
+            events (list): Events to generate captures for.
+            write_pcaps (bool): Write the pcap captures.
+            write_tsvs (bool): Write the extracted TSV files.
+
+        Returns:
+            int: Total number of generated packets.
+        """
+        rng = random.Random(self.seed)
+        total = 0
+        for event in events:
+            subdir = "benign" if event == "benign" else os.path.join("malicious", event)
+            for device, device_ip, info in self.devices:
+                packets = self.packets(device_ip, info, event, n_packets, rng)
+                self.write_capture(
+                    packets,
+                    pcap_path=(
+                        os.path.join(root, "raw", subdir, f"{device}.pcap")
+                        if write_pcaps
+                        else None
+                    ),
+                    tsv_path=(
+                        os.path.join(
+                            root, "extracted_features", subdir, f"{device}.csv"
+                        )
+                        if write_tsvs
+                        else None
+                    ),
+                )
+                total += len(packets)
+        return total
@@ -0,0 +1,487 @@
+import os
+import sys
+import json
+import time
+import platform
+import itertools
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import psutil
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.generator import GothamTrafficGenerator, METADATA_FILES
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METADATA_DIR = os.path.join(PROJECT_DIR, "metadata")
+FEATURES_PATH = os.path.join(PROJECT_DIR, "features", "protocol_fields_output.json")
+BASELINE_PATH = os.path.join(PROJECT_DIR, "benchmarks", "baseline.json")
+
+STAGES = ["extract", "label", "clean", "preprocess", "read"]
+
+# Difference of the resident memory grown by a stage below which it is noise (allocator
+# arenas, caches of the libraries)
+RSS_NOISE_MB = 16
+DEFAULT_EVENTS = ["benign", "mirai-dos", "network-scanning", "mirai-infection"]
+
+
+def peak_rss_bytes():
+    """Return the peak resident set size of the current process in bytes."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return psutil.Process().memory_info().peak_wset
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def benign_metadata():
+    with open(os.path.join(METADATA_DIR, "metadata-benign.json"), "r") as f:
+        return json.load(f)
+
+
+def labeller_for(path):
+    """Build the Labeller of the event a generated file belongs to."""
+    from src.helpers.labeller import Labeller
+
+    event = os.path.basename(os.path.dirname(path))
+    malicious_metadata = []
+    if event != "benign":
+        filename = METADATA_FILES.get(event, f"metadata-{event}.json")
+        with open(os.path.join(METADATA_DIR, filename), "r") as f:
+            malicious_metadata = json.load(f)
+    return Labeller(benign_metadata(), malicious_metadata)
+
+
+def files_under(root, extension):
+    return sorted(
+        os.path.join(dirpath, file)
+        for dirpath, _, files in os.walk(root)
+        for file in files
+        if file.endswith(extension)
+    )
+
+
+def run_extract(data_dir):
+    from src.helpers.feature_extractor import PCAPReader
+
+    with open(FEATURES_PATH, "r") as f:
+        features = [feature["field"] for feature in json.load(f)["features"]]
+
+    rows = 0
+    output_dir = tempfile.mkdtemp(dir=data_dir)
+    for pcap_path in files_under(os.path.join(data_dir, "raw"), ".pcap"):
+        output_file = os.path.join(output_dir, os.path.basename(pcap_path) + ".csv")
+        PCAPReader(
+            pcap_path=pcap_path,
+            feature_vector=features,
+            tool=None,
+            tshark_path="tshark",
+            zeek_path=None,
+            filters="ip",
+        ).to_csv(output_file)
+        with open(output_file, "r") as f:
+            rows += sum(1 for _ in f) - 1
+    return rows
+
+
+def run_label(data_dir):
+    from src.helpers.schema import load_schema
+    from src.helpers.tsv_reader import read_tsv
+
+    schema = load_schema(FEATURES_PATH)
+    rows = 0
+    for path in files_under(os.path.join(data_dir, "extracted_features"), ".csv"):
+        df = schema.apply(read_tsv(path, schema))
+        labeller_for(path).label_data(os.path.basename(path), df)
+        rows += len(df)
+    return rows
+
+
+def run_clean(data_dir):
+    import pandas as pd
+    from src.helpers.dataset_store import DatasetStore
+    from src.helpers.feature_cleaner import FeatureCleaner
+
+    store = DatasetStore.build(os.path.join(data_dir, "extracted_features"))
+    rows = 0
+    for iot_device in store.devices():
+        df = pd.concat(store.iter_chunks(iot_device))
+        FeatureCleaner().clean_features(df)
+        rows += len(df)
+    return rows
+
+
+def prepare_preprocess(data_dir):
+    """Label the generated files so the preprocessing stage can be measured alone."""
+    from src.helpers.schema import load_schema
+    from src.helpers.tsv_reader import read_tsv
+
+    schema = load_schema(FEATURES_PATH)
+    extracted_dir = os.path.join(data_dir, "extracted_features")
+    for path in files_under(extracted_dir, ".csv"):
+        df = schema.apply(read_tsv(path, schema))
+        df = labeller_for(path).label_data(os.path.basename(path), df)
+        output = os.path.join(
+            data_dir, "labelled", os.path.relpath(path, extracted_dir)
+        )
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        schema.to_text(df).to_csv(output, index=False, sep="\t")
+
+
+def run_preprocess(data_dir):
+    from src.config import (
+        port_hierarchy_map_iot,
+        categorical_vocabularies,
+        global_label_values,
+        global_label_grouped_values,
+    )
+    from src.helpers.dataset_store import DatasetStore
+    from src.helpers.preprocessor import DataPreprocessor
+    from src.run_preprocessing import load_device_data, finalise_device_data
+
+    preprocessor = DataPreprocessor(
+        port_hierarchy_map_iot=port_hierarchy_map_iot,
+        categorical_vocabularies=categorical_vocabularies,
+        global_label_values=global_label_values,
+        global_label_grouped_values=global_label_grouped_values,
+    )
+    store = DatasetStore.build(os.path.join(data_dir, "labelled"))
+    output_dir = tempfile.mkdtemp(dir=data_dir)
+
+    rows = 0
+    for iot_device in store.devices():
+        for path in store.device_paths(iot_device):
+            with open(path, "r") as f:
+                rows += sum(1 for _ in f) - 1
+        df = load_device_data(iot_device, store, preprocessor)
+        finalise_device_data(iot_device, df, output_dir, preprocessor)
+    return rows
+
+
+def write_oversized_file(data_dir, size):
+    """
+    Write the rows of the extracted files, repeated, to a single file of more than size
+    bytes, so the read stage cannot load it whole under its address-space cap.
+
+    Returns:
+        str: Path of the file.
+    """
+    sources = files_under(os.path.join(data_dir, "extracted_features"), ".csv")
+    body = []
+    for source in sources:
+        with open(source, "rb") as f:
+            header = f.readline()
+            body.append(f.read())
+    body = b"".join(body)
+
+    path = os.path.join(data_dir, "oversized.csv")
+    with open(path, "wb") as f:
+        f.write(header)
+        written = len(header)
+        while written <= size:
+            f.write(body)
+            written += len(body)
+    return path
+
+
+def run_read(path, chunk_memory):
+    """
+    Read a file with the adaptive chunk reader, as the stages do.
+
+    Raises:
+        RuntimeError: The reader ran out of the capped address space, i.e. it does not
+            stream the file within its chunk budget.
+    """
+    from src.helpers.chunk_reader import AdaptiveChunkReader
+    from src.helpers.schema import load_schema
+
+    reader = AdaptiveChunkReader(chunk_memory)
+    schema = load_schema(FEATURES_PATH)
+    rows = largest_chunk = 0
+    try:
+        for chunk in reader.iter_chunks(path, schema=schema, sep="\t"):
+            rows += len(chunk)
+            largest_chunk = max(largest_chunk, chunk.memory_usage(deep=True).sum())
+    except MemoryError as error:
+        raise RuntimeError(
+            f"Reading {os.path.getsize(path) / 2**20:.1f} MB in chunks of "
+            f"{chunk_memory / 2**20:.2f} MB exceeded the capped address space."
+        ) from error
+    return {"rows": rows, "largest_chunk_mb": round(largest_chunk / 2**20, 2)}
+
+
+def cap_address_space(limit):
+    """
+    Cap the address space of the current process to its current size plus limit bytes,
+    so reading more than the chunk budget allows fails with a MemoryError.
+
+    Returns:
+        bool: Whether the address space was capped.
+    """
+    try:
+        import resource
+    except ImportError:  # Windows
+        return False
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    soft = psutil.Process().memory_info().vms + limit
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+    return True
+
+
+STAGE_FUNCTIONS = {
+    "extract": run_extract,
+    "label": run_label,
+    "clean": run_clean,
+    "preprocess": run_preprocess,
+    "read": run_read,
+}
+
+
+def measure(stage, data_dir, chunk_memory):
+    """
+    Run a stage in the current (fresh) process and measure it.
+
+    The read stage streams a file twice as large as its address space, which is capped
+    to a few times the chunk budget, and fails when the reader runs out of it or grows
+    the resident memory by more than the cap.
+
+    Returns:
+        dict: Rows processed, wall time, throughput and peak memory of the stage.
+    """
+    import warnings
+
+    warnings.simplefilter("ignore")
+    sys.path.insert(0, PROJECT_DIR)
+
+    # Import the stage dependencies first so they are not part of the measurement
+    import src.run_preprocessing  # noqa: F401
+
+    extra = {}
+    if stage == "read":
+        limit = 4 * chunk_memory + 64 * 2**20
+        read_path = write_oversized_file(data_dir, 2 * limit)
+
+        # Read the first rows once, so the allocator and thread pools the parsing
+        # engine sets up on first use are not counted against the cap
+        warm_up_path = os.path.join(data_dir, "warm_up.csv")
+        with open(read_path, "rb") as source, open(warm_up_path, "wb") as f:
+            f.writelines(itertools.islice(source, 1000))
+        run_read(warm_up_path, chunk_memory)
+        if not cap_address_space(limit):
+            print("The address space cannot be capped: the read stage is not bounded.")
+        extra["chunk_memory_mb"] = round(chunk_memory / 2**20, 2)
+        extra["file_mb"] = round(os.path.getsize(read_path) / 2**20, 1)
+
+    start_rss = psutil.Process().memory_info().rss
+    start = time.perf_counter()
+    if stage == "read":
+        result = STAGE_FUNCTIONS[stage](read_path, chunk_memory)
+        rows = result.pop("rows")
+        extra.update(result)
+    else:
+        rows = STAGE_FUNCTIONS[stage](data_dir)
+    seconds = time.perf_counter() - start
+
+    # Memory taken within the address space already reserved by the allocators does
+    # not count against the cap
+    if stage == "read" and peak_rss_bytes() - start_rss > limit:
+        raise RuntimeError(
+            f"Reading {extra['file_mb']} MB in chunks of {extra['chunk_memory_mb']} MB "
+            f"grew the resident memory by more than {limit / 2**20:.0f} MB."
+        )
+
+    return {
+        **extra,
+        "rows": rows,
+        "seconds": round(seconds, 3),
+        "rows_per_s": round(rows / seconds, 1) if seconds else None,
+        "peak_rss_mb": round(peak_rss_bytes() / 2**20, 1),
+        "peak_rss_increase_mb": round((peak_rss_bytes() - start_rss) / 2**20, 1),
+    }
+
+
+def run_suite(stages, scales, n_devices, events, seed, chunk_memory):
+    """
+    Generate a dataset at every scale and measure each stage in its own process.
+
+    Returns:
+        dict: Measurements keyed by stage and scale.
+    """
+    results = {stage: {} for stage in stages}
+    context = multiprocessing.get_context("spawn")
+    generator = GothamTrafficGenerator(
+        METADATA_DIR, FEATURES_PATH, seed=seed, n_devices=n_devices
+    )
+
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as data_dir:
+            generator.generate(data_dir, scale, events, write_pcaps="extract" in stages)
+            if "preprocess" in stages:
+                prepare_preprocess(data_dir)
+
+            for stage in stages:
+                if stage == "extract" and shutil.which("tshark") is None:
+                    print("Skipping extract: tshark is not installed.")
+                    continue
+
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    result = pool.submit(
+                        measure, stage, data_dir, chunk_memory
+                    ).result()
+                results[stage][str(scale)] = result
+                print(
+                    f"{stage:<12}{scale:>10} pkts/capture{result['rows']:>12} rows"
+                    f"{result['rows_per_s']:>14} rows/s{result['peak_rss_mb']:>10} MB peak"
+                )
+    return results
+
+
+def compare(results, baseline, tolerance, config):
+    """
+    Compare the measurements with a baseline.
+
+    The peak memory of a stage process includes the libraries it imports, which differ
+    between hosts, so it is only compared with a baseline recorded on the same host.
+    The memory a stage grows from its start is compared whenever the baseline used the
+    same parsing engine, whose memory pools are part of it.
+
+    Parameters:
+        results (dict): Measurements keyed by stage and scale.
+        baseline (dict): Report of the baseline run.
+        tolerance (float): Relative slowdown or memory growth reported as a regression.
+        config (dict): Configuration of the current run.
+
+    Returns:
+        list: Descriptions of the throughput and memory regressions.
+    """
+    baseline_config = baseline.get("config", {})
+    same_host = baseline_config.get("host") == config["host"]
+    same_engine = baseline_config.get("tsv_engine") == config["tsv_engine"]
+    if not same_host:
+        print(
+            f"The baseline was recorded on {baseline_config.get('host')}: "
+            f"not comparing the peak memory."
+        )
+    if not same_engine:
+        print(
+            f"The baseline was recorded with the {baseline_config.get('tsv_engine')} "
+            f"engine: not comparing the memory growth."
+        )
+
+    regressions = []
+    for stage, scales in results.items():
+        for scale, result in scales.items():
+            if result.get("largest_chunk_mb", 0) > result.get(
+                "chunk_memory_mb", float("inf")
+            ) * (1 + tolerance):
+                regressions.append(
+                    f"{stage} @ {scale}: {result['largest_chunk_mb']} MB chunk "
+                    f"(budget {result['chunk_memory_mb']})"
+                )
+            reference = baseline.get("results", {}).get(stage, {}).get(scale)
+            if reference is None:
+                continue
+            if result["rows_per_s"] < reference["rows_per_s"] * (1 - tolerance):
+                regressions.append(
+                    f"{stage} @ {scale}: {result['rows_per_s']} rows/s "
+                    f"(baseline {reference['rows_per_s']})"
+                )
+            if same_host and result["peak_rss_mb"] > reference["peak_rss_mb"] * (
+                1 + tolerance
+            ):
+                regressions.append(
+                    f"{stage} @ {scale}: {result['peak_rss_mb']} MB peak "
+                    f"(baseline {reference['peak_rss_mb']})"
+                )
+            if (
+                same_engine
+                and result["peak_rss_increase_mb"]
+                > reference["peak_rss_increase_mb"] * (1 + tolerance) + RSS_NOISE_MB
+            ):
+                regressions.append(
+                    f"{stage} @ {scale}: {result['peak_rss_increase_mb']} MB grown "
+                    f"(baseline {reference['peak_rss_increase_mb']})"
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline stages on synthetic Gotham-like traffic."
+    )
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument(
+        "--scales",
+        nargs="+",
+        type=int,
+        default=[500, 2000],
+        help="Packets per generated capture.",
+    )
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--events", nargs="+", default=DEFAULT_EVENTS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--chunk-memory-mb",
+        type=float,
+        default=1.0,
+        help="Chunk budget of the read stage.",
+    )
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Relative slowdown or memory growth reported as a regression.",
+    )
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output", default=None, help="Also write the results here.")
+    args = parser.parse_args()
+
+    from src.helpers.tsv_reader import tsv_engine
+
+    results = run_suite(
+        args.stages,
+        args.scales,
+        args.devices,
+        args.events,
+        args.seed,
+        int(args.chunk_memory_mb * 2**20),
+    )
+    report = {
+        "config": {
+            "devices": args.devices,
+            "events": args.events,
+            "seed": args.seed,
+            "chunk_memory_mb": args.chunk_memory_mb,
+            "cpu_count": os.cpu_count(),
+            "python": sys.version.split()[0],
+            "host": platform.node(),
+            "tsv_engine": tsv_engine(),
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            regressions = compare(
+                results, json.load(f), args.tolerance, report["config"]
+            )
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regression against the baseline.")
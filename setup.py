@@ -12,7 +12,8 @@ setup(
         "internet of things",
         "federated learning",
     ],
-    packages=find_packages(where="."),
+    packages=find_packages(where=".", exclude=["benchmarks"]),
+    entry_points={"console_scripts": ["gotham = src.cli:main"]},
     description="A pipeline for labeling network traffic data in IoT systems",
     long_description=open("README.md", "r").read(),
     long_description_content_type="text/markdown",
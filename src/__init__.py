@@ -8,11 +8,52 @@ EVENTS = [
     "mirai-dos",
     "mirai-infection",
 ]
-DATA_DIR = os.path.join(os.path.abspath("."), "data")
-METADATA_DIR = os.path.join(os.path.abspath("."), "metadata")
+
+# The roots default to the current working directory and can be set through the
+# environment (inherited by the stage scripts) or with configure_roots()
+DATA_DIR_ENV = "GOTHAM_DATA_DIR"
+METADATA_DIR_ENV = "GOTHAM_METADATA_DIR"
+FEATURES_PATH_ENV = "GOTHAM_FEATURES_PATH"
+
+DATA_DIR = os.path.abspath(os.environ.get(DATA_DIR_ENV, "data"))
+METADATA_DIR = os.path.abspath(os.environ.get(METADATA_DIR_ENV, "metadata"))
+FEATURES_PATH = os.path.abspath(
+    os.environ.get(
+        FEATURES_PATH_ENV, os.path.join("features", "protocol_fields_output.json")
+    )
+)
+REPORT_DIR = os.path.join(DATA_DIR, "reports")
 
 __all__ = [
     "EVENTS",
     "DATA_DIR",
     "METADATA_DIR",
+    "FEATURES_PATH",
+    "REPORT_DIR",
 ]
+
+
+def configure_roots(data_dir=None, metadata_dir=None, features_path=None):
+    """
+    Set the data and metadata roots before the stage modules are imported.
+
+    The roots are also exported to the environment, so the stage scripts launched by
+    the pipeline runner use the same ones.
+
+    Parameters:
+        data_dir (str): Data directory (raw, extracted_features, labelled, ...).
+        metadata_dir (str): Directory containing the metadata JSON files.
+        features_path (str): Path to protocol_fields_output.json.
+    """
+    global DATA_DIR, METADATA_DIR, FEATURES_PATH, REPORT_DIR
+
+    if data_dir:
+        DATA_DIR = os.path.abspath(data_dir)
+        REPORT_DIR = os.path.join(DATA_DIR, "reports")
+        os.environ[DATA_DIR_ENV] = DATA_DIR
+    if metadata_dir:
+        METADATA_DIR = os.path.abspath(metadata_dir)
+        os.environ[METADATA_DIR_ENV] = METADATA_DIR
+    if features_path:
+        FEATURES_PATH = os.path.abspath(features_path)
+        os.environ[FEATURES_PATH_ENV] = FEATURES_PATH
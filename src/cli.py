@@ -0,0 +1,85 @@
+import os
+import sys
+import argparse
+from importlib import import_module
+
+
+# Subcommands and the stage module implementing them. A module is only imported when
+# its subcommand runs, so `gotham --help` or a dry run does not load pandas and
+# scikit-learn.
+COMMANDS = {
+    "extract": ("src.run_extraction", "Extract the features of the pcap files."),
+    "label": ("src.run_labeling", "Label the extracted features."),
+    "prepare": ("src.run_preparation", "Index the labelled partitions."),
+    "clean": ("src.run_cleaning", "Clean the extracted features."),
+    "preprocess": ("src.run_preprocessing", "Build the final datasets."),
+    "fused": ("src.run_fused", "Extract, label and preprocess in a single pass."),
+    "pipeline": ("src.run_pipeline", "Run the stages that are out of date."),
+    "queue": (
+        "src.run_queue",
+        "Share the stages between workers through a work queue.",
+    ),
+}
+
+# Environment variable of the parsing engine (see src.helpers.tsv_reader)
+TSV_ENGINE_ENV = "GOTHAM_TSV_ENGINE"
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="gotham",
+        description="GothamDataset2025 processing pipeline.",
+        epilog="Run 'gotham <command> --help' for the options of a command.",
+    )
+    parser.add_argument(
+        "--data-dir", default=None, help="Data directory (default is ./data)."
+    )
+    parser.add_argument(
+        "--metadata-dir",
+        default=None,
+        help="Directory of the metadata JSON files (default is ./metadata).",
+    )
+    parser.add_argument(
+        "--features-path",
+        default=None,
+        help="Fields extracted by tshark "
+        "(default is ./features/protocol_fields_output.json).",
+    )
+    parser.add_argument(
+        "--tsv-engine",
+        choices=["auto", "pandas", "pyarrow"],
+        default=None,
+        help="Engine parsing the tab-separated files: pyarrow parses on every core, "
+        "auto uses it when installed (default is auto).",
+    )
+
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+    for command, (_, description) in COMMANDS.items():
+        # The options of a command are parsed by its stage module
+        subparsers.add_parser(
+            command, help=description, description=description, add_help=False
+        )
+    return parser
+
+
+def main(argv=None):
+    """Entry point of the gotham command."""
+    args, command_args = build_parser().parse_known_args(argv)
+
+    # The roots must be set before the stage module reads them on import
+    from src import configure_roots
+
+    configure_roots(args.data_dir, args.metadata_dir, args.features_path)
+
+    # Inherited by the stage scripts, like the roots
+    if args.tsv_engine:
+        os.environ[TSV_ENGINE_ENV] = args.tsv_engine
+
+    module, _ = COMMANDS[args.command]
+    sys.argv[0] = f"gotham {args.command}"
+    import_module(module).main(command_args)
+
+
+if __name__ == "__main__":
+    main()
@@ -51,91 +51,16 @@ port_hierarchy_map_iot = [
     (range(1024, 65536), "NONPRIVILEGED_PORTS"),
 ]
 
-global_categorical_values = pd.DataFrame(
-    {
-        "ip.protocol": [
-            "TCP",
-            "UDP",
-            "ICMP",
-            "TCP",
-            "UDP",
-            "ICMP",
-            "TCP",
-            "UDP",
-            "ICMP",
-            "TCP",
-            "UDP",
-            "ICMP",
-            "TCP",
-            "UDP",
-            "ICMP",
-            "TCP",
-            "UDP",
-            "ICMP",
-            "TCP",
-            "UDP",
-            "ICMP",
-            "TCP",
-            "UDP",
-            "ICMP",
-            "TCP",
-        ],
-        "src.port": [
-            "mqttPorts",
-            "coapPorts",
-            "rtspPorts",
-            "httpPorts",
-            "mailPorts",
-            "dnsPorts",
-            "ftpPorts",
-            "shellPorts",
-            "remoteExecPorts",
-            "authPorts",
-            "passwordPorts",
-            "newsPorts",
-            "chatPorts",
-            "printPorts",
-            "timePorts",
-            "dbmsPorts",
-            "dhcpPorts",
-            "whoisPorts",
-            "netbiosPorts",
-            "kerberosPorts",
-            "RPCPorts",
-            "snmpPorts",
-            "PRIVILEGED_PORTS",
-            "NONPRIVILEGED_PORTS",
-            "",
-        ],
-        "dst.port": [
-            "mqttPorts",
-            "coapPorts",
-            "rtspPorts",
-            "httpPorts",
-            "mailPorts",
-            "dnsPorts",
-            "ftpPorts",
-            "shellPorts",
-            "remoteExecPorts",
-            "authPorts",
-            "passwordPorts",
-            "newsPorts",
-            "chatPorts",
-            "printPorts",
-            "timePorts",
-            "dbmsPorts",
-            "dhcpPorts",
-            "whoisPorts",
-            "netbiosPorts",
-            "kerberosPorts",
-            "RPCPorts",
-            "snmpPorts",
-            "PRIVILEGED_PORTS",
-            "NONPRIVILEGED_PORTS",
-            "",
-        ],
-    }
-)
+# Categories of the one-hot encoded features, in the order of their columns (the first
+# one being dropped); the ports without a category, as those of ICMP packets, are ""
+protocol_categories = ["ICMP", "TCP", "UDP"]
+port_categories = sorted({"", *(name for _, name in port_hierarchy_map_iot)})
+
+categorical_vocabularies = {
+    "ip.protocol": protocol_categories,
+    "src.port": port_categories,
+    "dst.port": port_categories,
+}
 
 global_label_values = pd.DataFrame(
     {
@@ -1,5 +1,71 @@
-from .feature_cleaner import *
-from .feature_extractor import *
-from .labeller import *
-from .preprocessor import *
-from .utils import *
+import os
+from importlib import import_module
+
+# The helpers are imported on first access, so a stage only loads the dependencies
+# (pandas, scikit-learn, ...) of the helpers it uses
+_EXPORTS = {
+    "ARTIFACT_VERSION": "artifact",
+    "PreprocessorArtifact": "artifact",
+    "CategoryEncoder": "category_encoder",
+    "CheckpointJournal": "checkpoint",
+    "atomic_output": "checkpoint",
+    "AdaptiveChunkReader": "chunk_reader",
+    "DEFAULT_CHUNK_MEMORY": "chunk_reader",
+    "DatasetStore": "dataset_store",
+    "FeatureCleaner": "feature_cleaner",
+    "PCAPReader": "feature_extractor",
+    "PROJECTED_FIELDS": "fields",
+    "FlowTable": "flow_table",
+    "LabelIndex": "label_index",
+    "query_labelled": "label_index",
+    "Labeller": "labeller",
+    "MinibatchLoader": "loader",
+    "final_devices": "loader",
+    "RunReport": "metrics",
+    "StageMetrics": "metrics",
+    "current_stage": "metrics",
+    "run_report": "metrics",
+    "PcapIndex": "pcap_index",
+    "DataPreprocessor": "preprocessor",
+    "MethodProfiler": "profiling",
+    "enable_profiling": "profiling",
+    "enable_profiling_from_env": "profiling",
+    "LabelSampler": "sampler",
+    "load_sampling_counts": "sampler",
+    "MemoryAwareScheduler": "scheduler",
+    "PacketSchema": "schema",
+    "field_kinds": "schema",
+    "load_schema": "schema",
+    "Stage": "stage_runner",
+    "StageRunner": "stage_runner",
+    "TsharkResult": "tshark_scheduler",
+    "TsharkScheduler": "tshark_scheduler",
+    "open_tsv": "tsv_reader",
+    "read_tsv": "tsv_reader",
+    "load_json_file": "utils",
+    "WindowFeatureEngine": "window_features",
+    "Lease": "work_queue",
+    "WorkQueue": "work_queue",
+    "run_worker": "work_queue",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+# Wrap the methods listed in GOTHAM_PROFILE, if any
+if os.environ.get("GOTHAM_PROFILE"):
+    from .profiling import enable_profiling_from_env
+
+    enable_profiling_from_env()
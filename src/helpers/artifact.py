@@ -0,0 +1,82 @@
+import os
+import joblib
+from datetime import datetime, timezone
+
+from src.helpers.checkpoint import atomic_output
+
+
+ARTIFACT_VERSION = 2
+
+
+class PreprocessorArtifact:
+    def __init__(
+        self,
+        transformer,
+        label_encoder,
+        label_grouped_encoder,
+        fit_mode,
+        devices,
+        n_samples_seen,
+    ):
+        """
+        Bundles a fitted feature transformer and label encoders so they can be persisted
+        once and reused to transform any number of devices.
+
+        Parameters:
+            transformer (ColumnTransformer): Fitted feature transformer.
+            label_encoder (LabelEncoder): Fitted encoder for the labels.
+            label_grouped_encoder (LabelEncoder): Fitted encoder for the grouped labels.
+            fit_mode (str): Either "global" or "per-device".
+            devices (list): IoT devices whose training data was used for fitting.
+            n_samples_seen (int): Number of training rows behind the numerical statistics.
+        """
+        self.transformer = transformer
+        self.label_encoder = label_encoder
+        self.label_grouped_encoder = label_grouped_encoder
+        self.fit_mode = fit_mode
+        self.devices = list(devices)
+        self.n_samples_seen = int(n_samples_seen)
+
+        self.version = ARTIFACT_VERSION
+        self.created_at = datetime.now(timezone.utc).isoformat()
+
+    @staticmethod
+    def filename(prefix):
+        """Return the versioned artifact filename for the given prefix."""
+        return f"{prefix}_preprocessor_v{ARTIFACT_VERSION}.joblib"
+
+    def save(self, output_dir, prefix):
+        """
+        Saves the artifact to a versioned joblib file.
+
+        Parameters:
+            output_dir (str): Directory in which to save the artifact.
+            prefix (str): Filename prefix, e.g. "global" or an IoT device name.
+
+        Returns:
+            str: Path of the saved artifact.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, self.filename(prefix))
+        with atomic_output(path) as tmp_path:
+            joblib.dump(self, tmp_path)
+        return path
+
+    @staticmethod
+    def load(path):
+        """
+        Loads an artifact and checks that it was written by a compatible version.
+
+        Parameters:
+            path (str): Path of the saved artifact.
+
+        Returns:
+            PreprocessorArtifact: The loaded artifact.
+        """
+        artifact = joblib.load(path)
+        if getattr(artifact, "version", None) != ARTIFACT_VERSION:
+            raise ValueError(
+                f"Artifact '{path}' has version {getattr(artifact, 'version', None)}, "
+                f"expected {ARTIFACT_VERSION}."
+            )
+        return artifact
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, TransformerMixin
+
+
+# Name of the column of the values missing from a vocabulary
+UNKNOWN_CATEGORY = "<unknown>"
+
+
+def category_codes(values, vocabulary):
+    """
+    Return the positions of values in a vocabulary, -1 for the values outside of it.
+
+    A categorical column is mapped through its categories, so the rows are only
+    compared as integer codes.
+
+    Parameters:
+        values (pd.Series): Categorical, text or numerical values.
+        vocabulary (list): Known categories.
+
+    Returns:
+        np.ndarray: int32 codes.
+    """
+    vocabulary = pd.Index(vocabulary)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # Category -> code, with the missing values (code -1) mapped last
+        lookup = np.append(vocabulary.get_indexer(values.cat.categories), -1)
+        return lookup[values.cat.codes.to_numpy()].astype(np.int32)
+    return vocabulary.get_indexer(values).astype(np.int32)
+
+
+class CategoryEncoder(TransformerMixin, BaseEstimator):
+    def __init__(self, vocabularies, drop_first=True):
+        """
+        One-hot encoder of categorical columns with fixed vocabularies, so every device
+        produces the same columns without fitting on a table of every category.
+
+        The columns of a feature follow the order of its vocabulary, the first category
+        being dropped (as OneHotEncoder(drop="first")), and end with a reserved column
+        for the values outside of the vocabulary.
+
+        Parameters:
+            vocabularies (dict): Categories of every encoded column, in column order.
+            drop_first (bool): Leave out the column of the first category of every
+                feature.
+        """
+        self.vocabularies = vocabularies
+        self.drop_first = drop_first
+
+    def fit(self, X, y=None):
+        """Check the columns of X; the vocabularies need no fitting."""
+        missing = [column for column in X.columns if column not in self.vocabularies]
+        if missing:
+            raise ValueError(f"No vocabulary for the columns {missing}.")
+        self.feature_names_in_ = np.asarray(X.columns, dtype=object)
+        self.n_features_in_ = len(self.feature_names_in_)
+        return self
+
+    def _widths(self):
+        """Return the number of output columns of every feature."""
+        return [
+            len(self.vocabularies[column]) - self.drop_first + 1
+            for column in self.feature_names_in_
+        ]
+
+    def transform(self, X):
+        """
+        One-hot encode the columns of X.
+
+        Parameters:
+            X (pd.DataFrame): Columns fitted on.
+
+        Returns:
+            scipy.sparse.csr_matrix: One row per row of X, with one value per feature
+            unless its first category is dropped.
+        """
+        X = pd.DataFrame(X, columns=self.feature_names_in_)
+
+        # Output column of every row and feature, -1 for a dropped first category
+        columns = np.empty((len(X), self.n_features_in_), dtype=np.int32)
+        offset = 0
+        for i, (column, width) in enumerate(
+            zip(self.feature_names_in_, self._widths())
+        ):
+            vocabulary = self.vocabularies[column]
+            codes = category_codes(X[column], vocabulary)
+            codes[codes < 0] = len(vocabulary)  # Reserved column
+            columns[:, i] = np.where(
+                codes < self.drop_first, -1, offset + codes - self.drop_first
+            )
+            offset += width
+
+        # The features are in column order, so every row holds sorted indices
+        present = columns >= 0
+        indptr = np.zeros(len(X) + 1, dtype=np.int64)
+        np.cumsum(present.sum(axis=1), out=indptr[1:])
+        indices = columns[present]
+        return sp.csr_matrix(
+            (np.ones(len(indices)), indices, indptr), shape=(len(X), offset)
+        )
+
+    def get_feature_names_out(self, input_features=None):
+        """Return the output column names, as "<feature>_<category>"."""
+        names = []
+        for column in self.feature_names_in_:
+            categories = list(self.vocabularies[column])[self.drop_first :]
+            names += [f"{column}_{category}" for category in categories]
+            names.append(f"{column}_{UNKNOWN_CATEGORY}")
+        return np.asarray(names, dtype=object)
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import hashlib
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_output(path):
+    """
+    Write an output file atomically.
+
+    Yields a temporary path next to the output; the temporary file is renamed to the
+    output once the block completes, and removed if it raises. An interrupted write
+    therefore never leaves a partial file that looks complete.
+
+    Parameters:
+        path (str): Path of the output file.
+
+    Yields:
+        str: Temporary path to write to.
+    """
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def code_version(paths):
+    """
+    Hash the content of source files, so results recorded with a version of the code
+    are recomputed once it changes.
+
+    Parameters:
+        paths (list): Paths of the source files.
+
+    Returns:
+        str: Hex digest of the files.
+    """
+    sha = hashlib.sha256()
+    for path in sorted(paths):
+        with open(path, "rb") as f:
+            sha.update(f"{os.path.basename(path)}:".encode() + f.read())
+    return sha.hexdigest()
+
+
+class CheckpointJournal:
+    def __init__(self, path, config=None):
+        """
+        Journal of the units of work (files, devices) completed by a run, so a run that
+        was interrupted can be restarted without redoing them.
+
+        Every completed unit appends one JSON line with the size and modification time
+        of its inputs and the paths of its outputs. A unit is skipped when it was
+        journaled with the same inputs and its outputs still exist. The journal is
+        discarded when the configuration of the run changes, and removed by finish()
+        once the run completes.
+
+        Parameters:
+            path (str): Path of the JSON Lines journal.
+            config (dict): JSON-serialisable configuration of the run.
+        """
+        self.path = path
+        self.config = config
+        self.units = {}
+
+        if os.path.exists(path):
+            self._load()
+        else:
+            self.reset()
+
+    def _load(self):
+        with open(self.path, "r") as f:
+            lines = f.readlines()
+
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue  # Line torn by the interruption
+
+        if not records or records[0].get("config") != self.config:
+            self.reset()
+            return
+
+        for record in records[1:]:
+            self.units[record["unit"]] = record
+        print(f"Resuming from {self.path}: {len(self.units)} units already done")
+
+    def reset(self):
+        """Discard the journal and start a new run."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.units = {}
+        with open(self.path, "w") as f:
+            f.write(json.dumps({"config": self.config, "started": time.time()}) + "\n")
+
+    @staticmethod
+    def signature(paths):
+        """Return the size and modification time of every path."""
+        signature = {}
+        for path in paths:
+            stat = os.stat(path)
+            signature[path] = [stat.st_size, stat.st_mtime_ns]
+        return signature
+
+    def is_done(self, unit, inputs=()):
+        """
+        Return True if a unit was completed from the same inputs and its outputs exist.
+
+        Parameters:
+            unit (str): Identifier of the unit.
+            inputs (list): Paths of the input files of the unit.
+        """
+        record = self.units.get(unit)
+        return (
+            record is not None
+            and record["inputs"] == self.signature(inputs)
+            and all(os.path.exists(path) for path in record["outputs"])
+        )
+
+    def outputs(self, unit):
+        """Return the output paths journaled for a unit."""
+        return self.units[unit]["outputs"]
+
+    def record(self, unit, inputs=(), outputs=()):
+        """
+        Journal a completed unit.
+
+        The record is a single appended line, so the units completed by parallel
+        processes can be journaled in the same file.
+
+        Parameters:
+            unit (str): Identifier of the unit.
+            inputs (list): Paths of the input files of the unit.
+            outputs (list): Paths of the output files of the unit.
+        """
+        record = {
+            "unit": unit,
+            "inputs": self.signature(inputs),
+            "outputs": list(outputs),
+            "finished": time.time(),
+        }
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.units[unit] = record
+
+    def finish(self):
+        """Remove the journal once the run completed."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,90 @@
+from src.helpers.tsv_reader import open_tsv
+
+
+# In-memory size of a chunk when no budget is given
+DEFAULT_CHUNK_MEMORY = 64 * 2**20
+
+
+class AdaptiveChunkReader:
+    def __init__(
+        self,
+        memory_budget=DEFAULT_CHUNK_MEMORY,
+        initial_rows=100,
+        min_rows=100,
+        max_rows=5_000_000,
+        smoothing=0.5,
+    ):
+        """
+        Read delimited files in chunks sized to a memory budget instead of a fixed
+        number of rows.
+
+        The in-memory size of every chunk is measured, and the number of rows of the
+        next chunk is derived from the average bytes per row, so narrow frames are read
+        in large chunks and wide ones in small chunks. The estimate is carried over
+        from file to file.
+
+        Parameters:
+            memory_budget (int): Target in-memory size of a chunk in bytes.
+            initial_rows (int): Number of rows of the first chunk, used to measure the
+                bytes per row.
+            min_rows (int): Minimum number of rows per chunk.
+            max_rows (int): Maximum number of rows per chunk.
+            smoothing (float): Weight of the last chunk in the bytes per row estimate.
+        """
+        if memory_budget <= 0:
+            raise ValueError("The memory budget must be positive.")
+
+        self.memory_budget = memory_budget
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.smoothing = smoothing
+        self.bytes_per_row = None
+        self.chunk_rows = max(min_rows, min(initial_rows, max_rows))
+
+    def update(self, chunk):
+        """
+        Update the bytes per row estimate with a chunk and size the next chunk.
+
+        Parameters:
+            chunk (pd.DataFrame): The last chunk read.
+        """
+        if chunk.empty:
+            return
+
+        bytes_per_row = chunk.memory_usage(index=True, deep=True).sum() / len(chunk)
+        if self.bytes_per_row is None:
+            self.bytes_per_row = bytes_per_row
+        else:
+            self.bytes_per_row = (
+                self.smoothing * bytes_per_row
+                + (1 - self.smoothing) * self.bytes_per_row
+            )
+        # Size on the larger of the estimate and the last chunk, so a sudden increase
+        # in width does not overshoot the budget
+        rows = int(self.memory_budget / max(self.bytes_per_row, bytes_per_row))
+        self.chunk_rows = max(self.min_rows, min(rows, self.max_rows))
+
+    def iter_chunks(self, filepath_or_buffer, schema=None, sep="\t", engine=None):
+        """
+        Lazily read a file in chunks sized to the memory budget.
+
+        Parameters:
+            filepath_or_buffer (str): Path or buffer of the file (see open_tsv).
+            schema (PacketSchema): Compact types of the packet fields, applied to every
+                chunk before it is measured (default is pd.read_csv's types).
+            sep (str): Field separator.
+            engine (str): Parsing engine (see tsv_engine).
+
+        Yields:
+            pd.DataFrame: The next chunk of the file.
+        """
+        with open_tsv(filepath_or_buffer, schema, sep, engine) as reader:
+            while True:
+                try:
+                    chunk = reader.get_chunk(self.chunk_rows)
+                except StopIteration:
+                    return
+                if schema is not None:
+                    chunk = schema.apply(chunk)
+                self.update(chunk)
+                yield chunk
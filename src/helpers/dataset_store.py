@@ -0,0 +1,299 @@
+import os
+import re
+import json
+import heapq
+import numpy as np
+import pandas as pd
+
+from src.helpers.checkpoint import atomic_output
+from src.helpers.chunk_reader import AdaptiveChunkReader, DEFAULT_CHUNK_MEMORY
+from src.helpers.schema import parse_time
+
+
+# Heap key of the merged streams that have no more chunks
+END = np.iinfo(np.int64).max
+
+
+def _time_keys(chunk, time_column):
+    """Return the times of a chunk, typed or text, as int64 nanoseconds."""
+    time = chunk[time_column]
+    if not pd.api.types.is_datetime64_dtype(time.dtype):
+        time = parse_time(time)  # Text from tshark
+    return time.to_numpy(dtype="datetime64[ns]").astype(np.int64)
+
+
+def merge_time_ordered(streams, time_column="frame.time"):
+    """
+    Merge chunk streams, each in time order, into a single time-ordered chunk stream.
+
+    One chunk per stream is buffered, and a heap orders the streams by the last time of
+    their buffered chunk. The smallest of these times is a watermark: no stream can
+    still hold an earlier packet, so every buffered row before it is emitted, sorted by
+    time with a stable sort of the few sorted runs, and the next chunk of the streams
+    that reached the watermark is appended to what is left of their buffer. Memory is
+    about one chunk per stream, and rows with the same time are emitted in stream
+    order, whatever the chunk sizes. A row older than the previous one of its stream is
+    merged at the time of the previous one.
+
+    Parameters:
+        streams (list): Iterables of DataFrame chunks, each in time order.
+        time_column (str): Column of the packet times.
+
+    Yields:
+        pd.DataFrame: The next time-ordered chunk.
+    """
+    streams = [iter(stream) for stream in streams]
+    buffers = [(pd.DataFrame(), np.empty(0, dtype=np.int64))] * len(streams)
+    clocks = [None] * len(streams)  # Time of the last row read from every stream
+
+    def refill(i):
+        """Append the next non-empty chunk of a stream to its buffer; return its key."""
+        for chunk in streams[i]:
+            if chunk.empty:
+                continue
+            keys = _time_keys(chunk, time_column)
+            if clocks[i] is not None:
+                keys[0] = max(keys[0], clocks[i])
+            keys = np.maximum.accumulate(keys)
+            clocks[i] = keys[-1]
+            buffered, buffered_keys = buffers[i]
+            if len(buffered):
+                chunk = pd.concat([buffered, chunk], ignore_index=True)
+                keys = np.concatenate([buffered_keys, keys])
+            buffers[i] = (chunk, keys)
+            return clocks[i]
+        return END  # Its buffered rows no longer hold the others back
+
+    heap = [(refill(i), i) for i in range(len(streams))]
+    heapq.heapify(heap)
+
+    while heap:
+        watermark = heap[0][0]
+        chunks, keys = [], []
+        for i, (chunk, chunk_keys) in enumerate(buffers):
+            cut = (
+                len(chunk_keys)
+                if watermark == END
+                else np.searchsorted(chunk_keys, watermark, side="left")
+            )
+            if cut:
+                chunks.append(chunk.iloc[:cut])
+                keys.append(chunk_keys[:cut])
+                buffers[i] = (chunk.iloc[cut:], chunk_keys[cut:])
+
+        if chunks:
+            order = np.argsort(np.concatenate(keys), kind="stable")
+            yield pd.concat(chunks, ignore_index=True).iloc[order].reset_index(
+                drop=True
+            )
+        if watermark == END:
+            return
+
+        # The streams whose chunk ended at the watermark may hold more of its rows
+        while heap[0][0] == watermark:
+            _, i = heapq.heappop(heap)
+            heapq.heappush(heap, (refill(i), i))
+
+
+class DatasetStore:
+    INDEX_FILENAME = "index.json"
+    INDEX_VERSION = 1
+
+    def __init__(self, root, partitions, sep="\t"):
+        """
+        Partitioned view over the per-event files of every IoT device.
+
+        The files stay where the previous stage wrote them, laid out as
+        <root>/benign/<device>*.csv and <root>/malicious/<event>/<device>*.csv. The store
+        only keeps an index of these partitions and streams them on demand, so a device
+        is never merged into a physical copy.
+
+        Parameters:
+            root (str): Root directory of the partitioned files (e.g. data/labelled).
+            partitions (list): Index entries with "device", "event", "path" and "size" keys,
+                where "path" is relative to root.
+            sep (str): Field separator of the partition files.
+        """
+        self.root = root
+        self.partitions = partitions
+        self.sep = sep
+
+    @staticmethod
+    def device_from_filename(filename):
+        """Return the IoT device identifier (e.g. "iotsim-air-quality-1") of a filename."""
+        match = re.match(r"([a-zA-Z\-]+)-([0-9]+)", os.path.basename(filename))
+        return match.group(0) if match else None
+
+    @classmethod
+    def build(cls, root, sep="\t", extension=".csv"):
+        """
+        Build the index by scanning the benign and malicious partitions once.
+
+        Only devices that have benign traffic are indexed. Partitions are ordered by
+        device, then benign first followed by the malicious events in path order.
+
+        Parameters:
+            root (str): Root directory of the partitioned files.
+            sep (str): Field separator of the partition files.
+            extension (str): Extension of the partition files, e.g. ".pcap" to index raw captures.
+
+        Returns:
+            DatasetStore: The indexed store.
+        """
+        entries = []
+        for dirpath, _, files in os.walk(root):
+            rel_dir = os.path.relpath(dirpath, root)
+            parts = rel_dir.split(os.sep)
+            if parts[0] == "benign":
+                event = "benign"
+            elif parts[0] == "malicious" and len(parts) > 1:
+                event = parts[1]
+            else:
+                continue
+
+            for file in files:
+                device = cls.device_from_filename(file)
+                if not file.endswith(extension) or device is None:
+                    continue
+                path = os.path.join(dirpath, file)
+                entries.append(
+                    {
+                        "device": device,
+                        "event": event,
+                        "path": os.path.relpath(path, root),
+                        "size": os.path.getsize(path),
+                    }
+                )
+
+        benign_devices = {e["device"] for e in entries if e["event"] == "benign"}
+        partitions = sorted(
+            [e for e in entries if e["device"] in benign_devices],
+            key=lambda e: (e["device"], e["event"] != "benign", e["path"]),
+        )
+
+        return cls(root, partitions, sep=sep)
+
+    def save(self, index_path):
+        """
+        Save the index as JSON. The root is stored relative to the index file.
+
+        Parameters:
+            index_path (str): Path of the index file.
+        """
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        index = {
+            "version": self.INDEX_VERSION,
+            "root": os.path.relpath(self.root, os.path.dirname(index_path)),
+            "sep": self.sep,
+            "partitions": self.partitions,
+        }
+        with atomic_output(index_path) as tmp_path:
+            with open(tmp_path, "w") as f:
+                json.dump(index, f, indent=4)
+
+    @classmethod
+    def load(cls, index_path):
+        """
+        Load a store from its index file.
+
+        Parameters:
+            index_path (str): Path of the index file.
+
+        Returns:
+            DatasetStore: The indexed store.
+        """
+        with open(index_path, "r") as f:
+            index = json.load(f)
+
+        if index.get("version") != cls.INDEX_VERSION:
+            raise ValueError(
+                f"Index '{index_path}' has version {index.get('version')}, "
+                f"expected {cls.INDEX_VERSION}."
+            )
+
+        root = os.path.normpath(
+            os.path.join(os.path.dirname(index_path), index["root"])
+        )
+        return cls(root, index["partitions"], sep=index.get("sep", "\t"))
+
+    def devices(self):
+        """Return the sorted list of indexed IoT devices."""
+        return sorted({p["device"] for p in self.partitions})
+
+    def device_partitions(self, device):
+        """Return the index entries of a device, in reading order."""
+        return [p for p in self.partitions if p["device"] == device]
+
+    def device_paths(self, device):
+        """Return the absolute paths of the partitions of a device."""
+        return [
+            os.path.join(self.root, p["path"]) for p in self.device_partitions(device)
+        ]
+
+    def device_size(self, device):
+        """Return the total size in bytes of the partitions of a device."""
+        return sum(p["size"] for p in self.device_partitions(device))
+
+    def iter_chunks(
+        self,
+        device,
+        memory_budget=DEFAULT_CHUNK_MEMORY,
+        schema=None,
+        with_partition=False,
+    ):
+        """
+        Lazily stream the partitions of a device as DataFrame chunks.
+
+        Parameters:
+            device (str): IoT device identifier.
+            memory_budget (int): Target in-memory size of a chunk in bytes.
+            schema (PacketSchema): Compact types of the packet fields (default is
+                pd.read_csv's types).
+            with_partition (bool): Whether to yield the index entry of the partition
+                with every chunk.
+
+        Yields:
+            pd.DataFrame: The next chunk of the device's traffic, or a (partition,
+                chunk) tuple.
+        """
+        reader = AdaptiveChunkReader(memory_budget)
+        for partition in self.device_partitions(device):
+            path = os.path.join(self.root, partition["path"])
+            for chunk in reader.iter_chunks(path, schema=schema, sep=self.sep):
+                yield (partition, chunk) if with_partition else chunk
+
+    def iter_time_ordered(
+        self,
+        device,
+        memory_budget=DEFAULT_CHUNK_MEMORY,
+        schema=None,
+        time_column="frame.time",
+    ):
+        """
+        Stream the partitions of a device merged into a single time-ordered stream.
+
+        Every partition is in time order (tshark's capture order), so they are merged
+        with merge_time_ordered in O(n log k) for k partitions, holding one chunk per
+        partition instead of the whole device; the budget is shared by the partitions.
+
+        Parameters:
+            device (str): IoT device identifier.
+            memory_budget (int): Target in-memory size of the merged chunks in bytes.
+            schema (PacketSchema): Compact types of the packet fields (default is
+                pd.read_csv's types).
+            time_column (str): Column of the packet times.
+
+        Yields:
+            pd.DataFrame: The next chunk of the device's traffic, in time order.
+        """
+        partitions = self.device_partitions(device)
+        partition_budget = max(1, memory_budget // max(1, len(partitions)))
+        streams = [
+            AdaptiveChunkReader(partition_budget).iter_chunks(
+                os.path.join(self.root, partition["path"]),
+                schema=schema,
+                sep=self.sep,
+            )
+            for partition in partitions
+        ]
+        yield from merge_time_ordered(streams, time_column)
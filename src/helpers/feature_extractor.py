@@ -1,6 +1,9 @@
 import subprocess
+import tempfile
 import pandas as pd
 
+from src.helpers.chunk_reader import AdaptiveChunkReader, DEFAULT_CHUNK_MEMORY
+
 
 class PCAPReader:
     def __init__(
@@ -23,18 +26,18 @@ class PCAPReader:
 
         self.dataframe = None  # Will store the extracted DataFrame
 
-    def to_dataframe(self):
+    def tshark_command(self):
         """
-        Extracts features from the pcap file and returns them as a DataFrame.
+        Builds the tshark command extracting the feature vector as tab-separated fields.
 
         Returns:
-            pd.DataFrame: DataFrame containing the extracted features.
+            list: The tshark command line.
         """
         fields = []
         for feature in self.feature_vector:
             fields += ["-e", feature]
 
-        tshark_command = [
+        return [
             self.tshark_path,
             "-n",  # No DNS resolution (speeds up processing)
             "-r",
@@ -52,6 +55,51 @@ class PCAPReader:
             self.filters,
         ]
 
+    def iter_chunks(self, memory_budget=DEFAULT_CHUNK_MEMORY, schema=None):
+        """
+        Streams the extracted features as DataFrame chunks straight from tshark's output,
+        without writing an intermediate file. The chunks are parsed exactly like a CSV
+        file written by to_csv.
+
+        Parameters:
+            memory_budget (int): Target in-memory size of a chunk in bytes.
+            schema (PacketSchema): Compact types of the packet fields (default is
+                pd.read_csv's types).
+
+        Yields:
+            pd.DataFrame: The next chunk of extracted features.
+        """
+        tshark_command = self.tshark_command()
+
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(
+                tshark_command, stdout=subprocess.PIPE, stderr=stderr, text=True
+            )
+            try:
+                yield from AdaptiveChunkReader(memory_budget).iter_chunks(
+                    process.stdout, schema=schema, sep="\t"
+                )
+            except pd.errors.EmptyDataError:
+                pass  # tshark produced no output at all
+            finally:
+                process.stdout.close()
+                returncode = process.wait()
+
+            if returncode != 0:
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(
+                    returncode, tshark_command, stderr=stderr.read().decode()
+                )
+
+    def to_dataframe(self):
+        """
+        Extracts features from the pcap file and returns them as a DataFrame.
+
+        Returns:
+            pd.DataFrame: DataFrame containing the extracted features.
+        """
+        tshark_command = self.tshark_command()
+
         try:
             # Run the tshark command and capture the output
             result = subprocess.run(
@@ -78,37 +126,26 @@ class PCAPReader:
 
         Parameters:
             output_csv (str): Path to save the CSV file.
-        """
-        fields = []
-        for feature in self.feature_vector:
-            fields += ["-e", feature]
 
-        tshark_command = [
-            self.tshark_path,
-            "-n",  # No DNS resolution (speeds up processing)
-            "-r",
-            self.pcap_path,  # Input pcap file
-            "-T",
-            "fields",  # Output in field format
-            *fields,  # Include all requested fields
-            "-E",
-            "header=y",  # Add column headers
-            "-E",
-            "separator=\t",  # Use Tab as CSV delimiter
-            "-E",
-            "occurrence=f",  # First occurrence of repeated fields
-            "-Y",
-            self.filters,
-        ]
+        Raises:
+            subprocess.CalledProcessError: If tshark exits with a non-zero code.
+        """
+        tshark_command = self.tshark_command()
 
         try:
             with open(output_file, "w") as out:
-                subprocess.run(tshark_command, stdout=out)
+                subprocess.run(
+                    tshark_command,
+                    stdout=out,
+                    stderr=subprocess.PIPE,
+                    text=True,
+                    check=True,
+                )
 
             print(f"tshark parsing complete. File saved as: {output_file}")
         except subprocess.CalledProcessError as e:
-            print(f"Error executing tshark: {e}")
+            print(f"Error executing tshark: {e}\n{e.stderr}")
             print(
                 "Ensure that tshark is correctly installed and accessible from the specified path."
             )
-            return None
+            raise
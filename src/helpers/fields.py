@@ -0,0 +1,58 @@
+# Extracted fields read by every stage consuming the tshark output. They live in a
+# module without dependencies, so projecting the extracted fields does not import the
+# stages themselves (scikit-learn, ...)
+
+# Fields read by Labeller.label_data
+LABELLER_FIELDS = ["ip.src", "ip.dst", "ip.proto", "tcp.srcport", "tcp.dstport"]
+
+# Fields read by the DataPreprocessor conversion steps up to select_columns
+PREPROCESSOR_FIELDS = [
+    "frame.time",
+    "frame.len",
+    "frame.protocols",
+    "ip.proto",
+    "ip.flags",
+    "ip.ttl",
+    "ip.checksum",
+    "tcp.srcport",
+    "tcp.dstport",
+    "tcp.flags",
+    "tcp.window_size_value",
+    "tcp.window_size_scalefactor",
+    "tcp.checksum",
+    "tcp.options",
+    "tcp.pdu.size",
+    "udp.srcport",
+    "udp.dstport",
+]
+
+# Fields read by WindowFeatureEngine.transform, the first conversion step when the
+# window features are on
+WINDOW_FIELDS = [
+    "frame.time",
+    "frame.len",
+    "ip.dst",
+    "tcp.flags",
+    "tcp.dstport",
+    "udp.dstport",
+]
+
+# Fields read by FlowTable.update
+FLOW_FIELDS = [
+    "frame.time",
+    "frame.len",
+    "ip.src",
+    "ip.dst",
+    "ip.proto",
+    "tcp.srcport",
+    "tcp.dstport",
+    "tcp.flags",
+    "udp.srcport",
+    "udp.dstport",
+]
+
+# Fields kept by the projected extraction. The feature cleaning stage is not a
+# consumer: it cleans whichever fields were extracted, so in projected mode it never
+# sees the other configured fields, such as eth.src, eth.dst and ip.tos (extract with
+# --fields full to clean them)
+PROJECTED_FIELDS = LABELLER_FIELDS + PREPROCESSOR_FIELDS + WINDOW_FIELDS + FLOW_FIELDS
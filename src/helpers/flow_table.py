@@ -0,0 +1,387 @@
+import numpy as np
+import pandas as pd
+
+from src.helpers.fields import FLOW_FIELDS
+from src.helpers.schema import PacketSchema, ipv4_to_int, parse_time
+
+
+# TCP flags counted per flow, in the order of their bits
+TCP_FLAGS = {
+    "fin": 0x01,
+    "syn": 0x02,
+    "rst": 0x04,
+    "psh": 0x08,
+    "ack": 0x10,
+    "urg": 0x20,
+}
+
+# Protocol numbers of the ports written to the tcp.* and udp.* columns
+TCP, UDP = 6, 17
+
+# Columns of the flow rows; ip.src, ip.dst and the ports are those of the initiator,
+# which sent the first packet, so the rows can be labelled like packets
+FLOW_COLUMNS = [
+    "flow.start",
+    "flow.end",
+    "flow.duration",
+    "ip.src",
+    "ip.dst",
+    "ip.proto",
+    "tcp.srcport",
+    "tcp.dstport",
+    "udp.srcport",
+    "udp.dstport",
+    "fwd.packets",
+    "fwd.bytes",
+    "bwd.packets",
+    "bwd.bytes",
+    *(f"flags.{flag}" for flag in TCP_FLAGS),
+    "iat.mean",
+    "iat.std",
+    "iat.min",
+    "iat.max",
+]
+
+# Statistics summed over the packets of a flow, then over its chunks
+_SUMS = [
+    "fwd_packets",
+    "fwd_bytes",
+    "bwd_packets",
+    "bwd_bytes",
+    *(f"flag_{flag}" for flag in TCP_FLAGS),
+    "iat_count",
+    "iat_sum",
+    "iat_sumsq",
+]
+
+# State kept per open flow: its key, initiator, first and last packet times and sums
+_STATE = [
+    "lo",
+    "hi",
+    "proto",
+    "src_ip",
+    "src_port",
+    "dst_ip",
+    "dst_port",
+    "first",
+    "time",
+    *_SUMS,
+    "iat_min",
+    "iat_max",
+]
+
+
+def flow_schema():
+    """Return the schema converting the flow rows to text and back."""
+    return PacketSchema(
+        {
+            "flow.start": "time",
+            "flow.end": "time",
+            "ip.src": "ipv4",
+            "ip.dst": "ipv4",
+            "ip.proto": "uint8",
+            "tcp.srcport": "port",
+            "tcp.dstport": "port",
+            "udp.srcport": "port",
+            "udp.dstport": "port",
+        }
+    )
+
+
+def _ipv4_values(series):
+    """Return a typed or text IPv4 column as int64, -1 for missing addresses."""
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return series.astype("Int64").fillna(-1).to_numpy(dtype=np.int64)
+    codes, uniques = pd.factorize(series)
+    values = np.array([ipv4_to_int(u) for u in uniques] + [-1], dtype=np.int64)
+    return values[codes]
+
+
+def _port_values(chunk, direction):
+    """Return the TCP or UDP port of every packet, 0 for neither."""
+    port = chunk[f"tcp.{direction}port"].astype("Float64")
+    if f"udp.{direction}port" in chunk.columns:
+        port = port.fillna(chunk[f"udp.{direction}port"].astype("Float64"))
+    return port.fillna(0).to_numpy(dtype=np.int64)
+
+
+class FlowTable:
+    # Extracted fields read by update
+    REQUIRED_FIELDS = FLOW_FIELDS
+
+    def __init__(self, idle_timeout=15.0, active_timeout=1800.0, max_flows=None):
+        """
+        Aggregates the packets of a capture into bidirectional flows, one row per flow
+        with its duration, packets and bytes per direction, TCP flag counts and
+        inter-arrival statistics, which is orders of magnitude smaller than the packets.
+
+        Both directions of a 5-tuple (addresses, ports and protocol) belong to the same
+        flow, whose forward direction is that of its first packet. A flow ends when no
+        packet was seen for idle_timeout seconds, or active_timeout seconds after its
+        first packet, like NetFlow's timeouts; the next packet of the 5-tuple starts a
+        new flow. Only the open flows are kept between chunks and the expired ones are
+        returned as soon as the capture's clock passes their timeout, so memory is
+        bounded by the number of concurrent flows. The chunks are aggregated with numpy:
+        the packets and the open flows are sorted by 5-tuple, cut into flows at the
+        timeouts and summed per flow. Packets are assumed to be in capture order; a
+        packet older than the previous one is counted at the time of the previous one.
+
+        Parameters:
+            idle_timeout (float): Seconds without packets after which a flow ends.
+            active_timeout (float): Seconds after its first packet at which a flow ends.
+            max_flows (int): Maximum number of open flows; the least recently active
+                ones are ended early beyond it (default is no limit).
+        """
+        if idle_timeout <= 0 or active_timeout <= 0:
+            raise ValueError("The flow timeouts must be positive.")
+        if max_flows is not None and max_flows < 1:
+            raise ValueError("max_flows must be at least 1.")
+
+        self.idle_timeout = float(idle_timeout)
+        self.active_timeout = float(active_timeout)
+        self.max_flows = max_flows
+        self.reset()
+
+    def reset(self):
+        """Forget the open flows, e.g. before the next capture."""
+        floats = ["iat_sum", "iat_sumsq", "iat_min", "iat_max"]
+        self._open = pd.DataFrame(
+            {
+                column: np.array([], dtype=np.float64 if column in floats else np.int64)
+                for column in _STATE
+            }
+        )
+        self._clock = None  # Time of the latest packet, in nanoseconds
+
+    def __len__(self):
+        """Return the number of open flows."""
+        return len(self._open)
+
+    def _packets(self, chunk):
+        """Extract the columns the flows are built from, skipping non-IP packets."""
+        time = chunk["frame.time"]
+        if not pd.api.types.is_datetime64_dtype(time.dtype):
+            time = parse_time(time)  # Text from tshark
+        time = time.to_numpy(dtype="datetime64[ns]").astype(np.int64)
+        if len(time):
+            if self._clock is not None:
+                time[0] = max(time[0], self._clock)
+            time = np.maximum.accumulate(time)
+            self._clock = int(time[-1])
+
+        flags = chunk["tcp.flags"]
+        if not pd.api.types.is_numeric_dtype(flags.dtype):
+            codes, uniques = pd.factorize(flags)
+            values = np.array([int(x, 16) for x in uniques] + [0], dtype=np.int64)
+            flags = pd.Series(values[codes], index=chunk.index)
+
+        packets = pd.DataFrame(
+            {
+                "time": time,
+                "length": chunk["frame.len"].fillna(0).to_numpy(dtype=np.int64),
+                "src_ip": _ipv4_values(chunk["ip.src"]),
+                "dst_ip": _ipv4_values(chunk["ip.dst"]),
+                "proto": chunk["ip.proto"].fillna(0).to_numpy(dtype=np.int64),
+                "src_port": _port_values(chunk, "src"),
+                "dst_port": _port_values(chunk, "dst"),
+                "flags": flags.fillna(0).to_numpy(dtype=np.int64),
+            }
+        )
+        packets = packets[(packets["src_ip"] >= 0) & (packets["dst_ip"] >= 0)]
+
+        # The same key for both directions: the lower and higher (address, port)
+        source = (packets["src_ip"].to_numpy() << 16) | packets["src_port"].to_numpy()
+        destination = (packets["dst_ip"].to_numpy() << 16) | packets[
+            "dst_port"
+        ].to_numpy()
+        return packets.assign(
+            lo=np.minimum(source, destination), hi=np.maximum(source, destination)
+        )
+
+    def _segments(self, time, first, key):
+        """
+        Cut the sorted rows into flows: a flow starts at the first row of a 5-tuple,
+        after an idle gap, and at the first packet past the active timeout of the flow.
+        The first time of a head row is that of its flow (anchors carry their own).
+
+        Returns:
+            tuple: Whether every row starts a flow, and the flow of every row.
+        """
+        idle, active = int(self.idle_timeout * 1e9), int(self.active_timeout * 1e9)
+        head = np.ones(len(time), dtype=bool)
+        head[1:] = (key[1:] != key[:-1]) | (time[1:] - time[:-1] > idle)
+
+        # Every split moves the start of the rest of the flow: repeat until none is due
+        while True:
+            flow = np.cumsum(head) - 1
+            start = first[np.flatnonzero(head)][flow]
+            late = np.flatnonzero((time - start > active) & ~head)
+            if not len(late):
+                return head, flow
+            new_flow = np.ones(len(late), dtype=bool)
+            new_flow[1:] = flow[late[1:]] != flow[late[:-1]]
+            head[late[new_flow]] = True
+
+    def update(self, chunk):
+        """
+        Add the next chunk of a capture and return the flows that ended.
+
+        Parameters:
+            chunk (pd.DataFrame): Next packets of the capture, in capture order.
+
+        Returns:
+            pd.DataFrame: The ended flows, one row per flow (see FLOW_COLUMNS).
+        """
+        packets = self._packets(chunk)
+        if not len(packets) and not len(self._open):
+            return self._rows(self._open)
+
+        # The open flows go first, as anchor rows carrying their state
+        packets = packets.assign(first=packets["time"])
+        rows = pd.concat(
+            [self._open.assign(anchor=True), packets.assign(anchor=False)],
+            ignore_index=True,
+        )
+        key = rows.groupby(["lo", "hi", "proto"], sort=False).ngroup().to_numpy()
+        order = np.argsort(key, kind="stable")
+        rows = rows.iloc[order].reset_index(drop=True)
+        key = key[order]
+
+        time = rows["time"].to_numpy()
+        anchor = rows["anchor"].to_numpy(dtype=bool)
+        head, flow = self._segments(time, rows["first"].to_numpy(), key)
+        heads = np.flatnonzero(head)
+
+        # Packets from the initiator of their flow go forward
+        packet = ~anchor
+        forward = packet & (
+            (rows["src_ip"].to_numpy() == rows["src_ip"].to_numpy()[heads][flow])
+            & (rows["src_port"].to_numpy() == rows["src_port"].to_numpy()[heads][flow])
+        )
+        backward = packet & ~forward
+        length = rows["length"].fillna(0).to_numpy()
+        flags = rows["flags"].fillna(0).to_numpy(dtype=np.int64)
+
+        # Inter-arrival time of every packet after the first of its flow, in seconds
+        iat = np.zeros(len(rows))
+        iat[1:] = (time[1:] - time[:-1]) / 1e9
+        has_iat = packet & ~head
+
+        contributions = {
+            "fwd_packets": forward,
+            "fwd_bytes": np.where(forward, length, 0),
+            "bwd_packets": backward,
+            "bwd_bytes": np.where(backward, length, 0),
+            **{
+                f"flag_{flag}": packet & (flags & bit != 0)
+                for flag, bit in TCP_FLAGS.items()
+            },
+            "iat_count": has_iat,
+            "iat_sum": np.where(has_iat, iat, 0),
+            "iat_sumsq": np.where(has_iat, iat**2, 0),
+        }
+        flows = rows.iloc[heads][
+            ["lo", "hi", "proto", "src_ip", "src_port", "dst_ip", "dst_port", "first"]
+        ].reset_index(drop=True)
+        flows["time"] = np.maximum.reduceat(time, heads)
+        for column, values in contributions.items():
+            # Anchors contribute the sums of their flow so far
+            values = np.where(anchor, rows[column].fillna(0), values.astype(np.float64))
+            flows[column] = np.add.reduceat(values, heads)
+        flows["iat_min"] = np.minimum.reduceat(
+            np.where(
+                anchor, rows["iat_min"].fillna(np.inf), np.where(has_iat, iat, np.inf)
+            ),
+            heads,
+        )
+        flows["iat_max"] = np.maximum.reduceat(
+            np.where(
+                anchor, rows["iat_max"].fillna(-np.inf), np.where(has_iat, iat, -np.inf)
+            ),
+            heads,
+        )
+
+        # A flow ended when a later one has its 5-tuple or its timeouts passed
+        last = np.ones(len(heads), dtype=bool)
+        last[:-1] = key[heads[1:]] != key[heads[:-1]]
+        clock = self._clock if self._clock is not None else 0
+        ended = (
+            ~last
+            | (clock - flows["time"].to_numpy() > int(self.idle_timeout * 1e9))
+            | (clock - flows["first"].to_numpy() > int(self.active_timeout * 1e9))
+        )
+
+        self._open = flows[~ended].reset_index(drop=True)
+        ended = flows[ended]
+        if self.max_flows is not None and len(self._open) > self.max_flows:
+            # Evict the least recently active flows
+            by_activity = self._open.sort_values("time", kind="stable")
+            n_evicted = len(self._open) - self.max_flows
+            ended = pd.concat([ended, by_activity.iloc[:n_evicted]])
+            self._open = by_activity.iloc[n_evicted:].reset_index(drop=True)
+
+        return self._rows(ended)
+
+    def flush(self):
+        """
+        End every open flow, e.g. at the end of the capture.
+
+        Returns:
+            pd.DataFrame: The flows, one row per flow (see FLOW_COLUMNS).
+        """
+        flows = self._open
+        self.reset()
+        return self._rows(flows)
+
+    def aggregate(self, df):
+        """Aggregate a whole capture at once."""
+        self.reset()
+        return pd.concat([self.update(df), self.flush()], ignore_index=True)
+
+    @staticmethod
+    def _rows(flows):
+        """Convert the state of ended flows to flow rows, sorted by start time."""
+        flows = flows.sort_values(["first", "lo", "hi", "proto"], kind="stable")
+        proto = flows["proto"].to_numpy(dtype=np.int64)
+        count = flows["iat_count"].to_numpy(dtype=np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = flows["iat_sum"].to_numpy(dtype=np.float64) / count
+            variance = flows["iat_sumsq"].to_numpy(dtype=np.float64) / count - mean**2
+
+        def ports(column, protocol):
+            """Ports of the flows of a protocol, missing for the others."""
+            values = pd.array(flows[column].to_numpy(dtype=np.int64), dtype="UInt16")
+            values[proto != protocol] = pd.NA
+            return values
+
+        first = flows["first"].to_numpy(dtype=np.int64)
+        end = flows["time"].to_numpy(dtype=np.int64)
+        rows = {
+            "flow.start": first.astype("datetime64[ns]"),
+            "flow.end": end.astype("datetime64[ns]"),
+            "flow.duration": (end - first) / 1e9,
+            "ip.src": pd.array(
+                flows["src_ip"].to_numpy(dtype=np.int64), dtype="UInt32"
+            ),
+            "ip.dst": pd.array(
+                flows["dst_ip"].to_numpy(dtype=np.int64), dtype="UInt32"
+            ),
+            "ip.proto": pd.array(proto, dtype="UInt8"),
+            "tcp.srcport": ports("src_port", TCP),
+            "tcp.dstport": ports("dst_port", TCP),
+            "udp.srcport": ports("src_port", UDP),
+            "udp.dstport": ports("dst_port", UDP),
+            "fwd.packets": flows["fwd_packets"].to_numpy(dtype=np.int64),
+            "fwd.bytes": flows["fwd_bytes"].to_numpy(dtype=np.int64),
+            "bwd.packets": flows["bwd_packets"].to_numpy(dtype=np.int64),
+            "bwd.bytes": flows["bwd_bytes"].to_numpy(dtype=np.int64),
+            **{
+                f"flags.{flag}": flows[f"flag_{flag}"].to_numpy(dtype=np.int64)
+                for flag in TCP_FLAGS
+            },
+            "iat.mean": mean,
+            "iat.std": np.sqrt(np.maximum(variance, 0)),
+            "iat.min": np.where(count > 0, flows["iat_min"], np.nan),
+            "iat.max": np.where(count > 0, flows["iat_max"], np.nan),
+        }
+        return pd.DataFrame(rows, columns=FLOW_COLUMNS)
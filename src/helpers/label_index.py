@@ -0,0 +1,263 @@
+import io
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from src.helpers.checkpoint import atomic_output
+from src.helpers.dataset_store import DatasetStore
+from src.helpers.schema import PacketSchema, parse_time
+from src.helpers.tsv_reader import read_tsv
+
+
+INDEX_VERSION = 1
+
+# Suffix of the index written next to a labelled file
+INDEX_SUFFIX = ".index.json"
+
+# Rows per block of an indexed file; a query reads whole blocks
+BLOCK_ROWS = 16384
+
+
+def index_path(data_file):
+    """Return the path of the index of a labelled file."""
+    return os.path.splitext(data_file)[0] + INDEX_SUFFIX
+
+
+def _time_keys(df, time_column):
+    """Return the times of typed or text rows as int64 nanoseconds."""
+    time = df[time_column]
+    if not pd.api.types.is_datetime64_dtype(time.dtype):
+        time = parse_time(time)  # Text from tshark
+    return time.to_numpy(dtype="datetime64[ns]").astype(np.int64)
+
+
+def _file_state(path):
+    """Return the size and modification time identifying the version of a file."""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def write_indexed(
+    chunks,
+    output_file,
+    schema,
+    time_column="frame.time",
+    label_column="label",
+    block_rows=BLOCK_ROWS,
+):
+    """
+    Write labelled rows to a tab-separated file with a sidecar index.
+
+    The rows are written in blocks of at most block_rows rows. The index records the
+    byte offset, number of rows and time range of every block, and the blocks holding
+    every label, so LabelIndex.read only reads the blocks a query can match.
+
+    Parameters:
+        chunks (iterable): DataFrame chunks of typed rows, written in order.
+        output_file (str): Path of the tab-separated output file.
+        schema (PacketSchema): Schema converting the rows to text and back.
+        time_column (str): Column of the row times.
+        label_column (str): Column of the labels.
+        block_rows (int): Maximum number of rows per block.
+
+    Returns:
+        int: Number of rows written.
+    """
+    columns = None
+    blocks = {"offset": [], "rows": [], "time_min": [], "time_max": []}
+    labels = {}
+    with atomic_output(output_file) as tmp_file:
+        with open(tmp_file, "wb") as f:
+            for chunk in chunks:
+                if columns is None:
+                    columns = list(chunk.columns)
+                    f.write(("\t".join(columns) + "\n").encode())
+                time = _time_keys(chunk, time_column)
+                codes, uniques = pd.factorize(chunk[label_column])
+                text = schema.to_text(chunk)
+                for start in range(0, len(chunk), block_rows):
+                    end = start + block_rows
+                    block_codes = codes[start:end]
+                    for code in np.unique(block_codes[block_codes >= 0]):
+                        block = len(blocks["rows"])
+                        labels.setdefault(str(uniques[code]), []).append(block)
+                    blocks["offset"].append(f.tell())
+                    blocks["rows"].append(len(block_codes))
+                    blocks["time_min"].append(int(time[start:end].min()))
+                    blocks["time_max"].append(int(time[start:end].max()))
+                    f.write(
+                        text.iloc[start:end]
+                        .to_csv(
+                            index=False, header=False, sep="\t", lineterminator="\n"
+                        )
+                        .encode()
+                    )
+            blocks["offset"].append(f.tell())  # End of the last block
+
+    index = {
+        "version": INDEX_VERSION,
+        "file": _file_state(output_file),
+        "columns": columns,
+        "kinds": schema.kinds,
+        "time_column": time_column,
+        "label_column": label_column,
+        "blocks": blocks,
+        "labels": labels,
+    }
+    with atomic_output(index_path(output_file)) as tmp_file:
+        with open(tmp_file, "w") as f:
+            json.dump(index, f)
+    return sum(blocks["rows"])
+
+
+class LabelIndex:
+    def __init__(self, data_file, index):
+        """
+        Sidecar index of a labelled file written by write_indexed, answering slice
+        queries (a time range and some labels) by reading only the blocks whose time
+        range overlaps the query and that hold one of the labels, instead of the whole
+        file.
+
+        Parameters:
+            data_file (str): Path of the labelled file.
+            index (dict): Content of its index file.
+        """
+        self.data_file = data_file
+        self.index = index
+        self.columns = index["columns"] or []
+        self.schema = PacketSchema(index["kinds"])
+        self.time_column = index["time_column"]
+        self.label_column = index["label_column"]
+
+        blocks = index["blocks"]
+        self.offsets = np.array(blocks["offset"], dtype=np.int64)
+        self.time_min = np.array(blocks["time_min"], dtype=np.int64)
+        self.time_max = np.array(blocks["time_max"], dtype=np.int64)
+
+    @classmethod
+    def load(cls, data_file):
+        """
+        Load the index of a labelled file.
+
+        Raises:
+            FileNotFoundError: The file has no index.
+            ValueError: The index has another version or the file changed since.
+        """
+        with open(index_path(data_file), "r") as f:
+            index = json.load(f)
+
+        if index.get("version") != INDEX_VERSION:
+            raise ValueError(
+                f"Index of '{data_file}' has version {index.get('version')}, "
+                f"expected {INDEX_VERSION}."
+            )
+        if index["file"] != _file_state(data_file):
+            raise ValueError(f"'{data_file}' changed since it was indexed.")
+        return cls(data_file, index)
+
+    def labels(self):
+        """Return the labels of the file."""
+        return sorted(self.index["labels"])
+
+    def blocks(self, start=None, end=None, labels=None):
+        """
+        Return the blocks a query can match.
+
+        Parameters:
+            start: First time of the query, inclusive (default is unbounded).
+            end: Last time of the query, exclusive (default is unbounded).
+            labels (list): Labels of the query (default is every label).
+
+        Returns:
+            np.ndarray: Sorted block numbers.
+        """
+        match = np.ones(len(self.time_min), dtype=bool)
+        if start is not None:
+            match &= self.time_max >= pd.Timestamp(start).value
+        if end is not None:
+            match &= self.time_min < pd.Timestamp(end).value
+        if labels is not None:
+            with_label = np.zeros(len(match), dtype=bool)
+            for label in labels:
+                with_label[self.index["labels"].get(str(label), [])] = True
+            match &= with_label
+        return np.flatnonzero(match)
+
+    def read(self, start=None, end=None, labels=None):
+        """
+        Read the rows of the file within a time range and with some labels.
+
+        Parameters:
+            start: First time of the query, inclusive (default is unbounded).
+            end: Last time of the query, exclusive (default is unbounded).
+            labels (list): Labels of the query (default is every label).
+
+        Returns:
+            pd.DataFrame: The matching typed rows, in file order.
+        """
+        blocks = self.blocks(start, end, labels)
+
+        # Adjacent blocks are read in a single range, after the header
+        data = [("\t".join(self.columns) + "\n").encode()]
+        with open(self.data_file, "rb") as f:
+            if len(blocks):
+                for run in np.split(blocks, np.flatnonzero(np.diff(blocks) > 1) + 1):
+                    f.seek(self.offsets[run[0]])
+                    data.append(
+                        f.read(self.offsets[run[-1] + 1] - self.offsets[run[0]])
+                    )
+
+        df = read_tsv(io.BytesIO(b"".join(data)), self.schema)
+        df = self.schema.apply(df)
+
+        mask = np.ones(len(df), dtype=bool)
+        if start is not None or end is not None:
+            time = _time_keys(df, self.time_column)
+            if start is not None:
+                mask &= time >= pd.Timestamp(start).value
+            if end is not None:
+                mask &= time < pd.Timestamp(end).value
+        if labels is not None:
+            mask &= (
+                df[self.label_column]
+                .isin([str(label) for label in labels])
+                .to_numpy(dtype=bool)
+            )
+        return df[mask].reset_index(drop=True)
+
+
+def query_labelled(root, device=None, start=None, end=None, labels=None, events=None):
+    """
+    Read the labelled rows of a device within a time range and with some labels,
+    through the indexes of its files.
+
+    Parameters:
+        root (str): Root of the labelled files, e.g. data/labelled or data/flows.
+        device (str): IoT device, e.g. "iotsim-building-monitor-3" (default is every
+            device).
+        start: First time of the query, inclusive (default is unbounded).
+        end: Last time of the query, exclusive (default is unbounded).
+        labels (list): Labels of the query (default is every label).
+        events (list): Events to read (default is every event).
+
+    Returns:
+        pd.DataFrame: The matching rows, with the event and device of every row.
+    """
+    store = DatasetStore.build(root)
+    results = []
+    for partition in store.partitions:
+        if device is not None and partition["device"] != device:
+            continue
+        if events is not None and partition["event"] not in events:
+            continue
+        index = LabelIndex.load(os.path.join(root, partition["path"]))
+        df = index.read(start, end, labels)
+        if len(df):
+            results.append(
+                df.assign(event=partition["event"], device=partition["device"])
+            )
+
+    if not results:
+        return pd.DataFrame()
+    return pd.concat(results, ignore_index=True)
@@ -1,9 +1,15 @@
 import pandas as pd
 import re
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
+
+from src.helpers.fields import LABELLER_FIELDS
+from src.helpers.schema import ipv4_equals, ipv4_match
 
 
 class Labeller:
+    # Extracted fields read by label_data
+    REQUIRED_FIELDS = LABELLER_FIELDS
+
     def __init__(
         self,
         benign_metadata: List[Dict[str, str]],
@@ -56,7 +62,9 @@ class Labeller:
         if not device_ip_address:
             raise ValueError("Device IP address is required for filtering.")
 
-        mask = (df["ip.src"] == device_ip_address) | (df["ip.dst"] == device_ip_address)
+        mask = ipv4_equals(df["ip.src"], device_ip_address) | ipv4_equals(
+            df["ip.dst"], device_ip_address
+        )
 
         return df[mask]
 
@@ -80,8 +88,12 @@ class Labeller:
 
         for server_ip in servers_ip:
             mask = (
-                (df["ip.src"] == device_ip_address) & (df["ip.dst"] == server_ip)
-            ) | ((df["ip.dst"] == device_ip_address) & (df["ip.src"] == server_ip))
+                ipv4_equals(df["ip.src"], device_ip_address)
+                & ipv4_equals(df["ip.dst"], server_ip)
+            ) | (
+                ipv4_equals(df["ip.dst"], device_ip_address)
+                & ipv4_equals(df["ip.src"], server_ip)
+            )
             df.loc[mask, "label"] = label
 
         return df
@@ -101,29 +113,30 @@ class Labeller:
             dst_ip = rule.get("destination_ip", "").replace("x.x", ".*")
             label = rule.get("label", "Malicious")
 
-            mask = df["ip.src"].str.match(src_ip) & df["ip.dst"].str.match(dst_ip)
+            mask = ipv4_match(df["ip.src"], src_ip) & ipv4_match(df["ip.dst"], dst_ip)
 
+            # Missing ports and protocols (nullable columns) do not match
             if "source_port" in rule and "destination_port" in rule:
-                mask &= (df["tcp.srcport"] == rule["source_port"]) & (
-                    df["tcp.dstport"] == rule["destination_port"]
-                )
+                mask &= (
+                    df["tcp.srcport"].eq(rule["source_port"])
+                    & df["tcp.dstport"].eq(rule["destination_port"])
+                ).fillna(False)
             if "protocol" in rule:
-                mask &= df["ip.proto"] == int(rule["protocol"])
+                mask &= df["ip.proto"].eq(int(rule["protocol"])).fillna(False)
 
             df.loc[mask & (df["label"] == "Unknown"), "label"] = label
 
         return df
 
-    def label_data(self, filename: str, df: pd.DataFrame) -> pd.DataFrame:
+    def device_ip_address(self, filename: str) -> Tuple[str, dict]:
         """
-        Main function to label the data for a specific IoT device.
+        Look up the IP address and metadata of the IoT device a file belongs to.
 
         Args:
             filename: The filename containing device identification info.
-            df: Input DataFrame containing network traffic.
 
         Returns:
-            A DataFrame with labeled network traffic.
+            A tuple containing the device IP address and the device metadata.
         """
         # Extract device info
         device_name, device_index = self.extract_device_info(filename)
@@ -143,7 +156,73 @@ class Labeller:
                 f"Device index '{device_index}' is out of range for device '{device_name}'."
             )
 
-        device_ip_address = device_ips[device_index]
+        return device_ips[device_index], device_info
+
+    def rule_dependencies(
+        self,
+        filename: str,
+        peers: Optional[List[str]] = None,
+        protocols: Optional[List[int]] = None,
+    ) -> dict:
+        """
+        Collect the metadata the labels of a file depend on: the benign entry of its
+        device and the malicious rules that can match its traffic.
+
+        Every packet of the file involves the device, so a rule can only match if one
+        side of it matches the device's IP address and the other side one of the peers
+        the device talked to, over one of the protocols seen. The other rules never
+        match, so leaving them out keeps the labels unchanged.
+
+        Args:
+            filename: The filename containing device identification info.
+            peers: IP addresses the device exchanged packets with (default is any).
+            protocols: IP protocol numbers of the packets (default is any).
+
+        Returns:
+            A JSON-serialisable dictionary of the metadata the labels depend on.
+        """
+        device_ip_address, device_info = self.device_ip_address(filename)
+
+        def matches(pattern, addresses):
+            if addresses is None:
+                return True
+            return any(re.match(pattern, address) for address in addresses)
+
+        rules = []
+        for rule in self.malicious_metadata:
+            src_ip = rule.get("source_ip", "").replace("x.x", ".*")
+            dst_ip = rule.get("destination_ip", "").replace("x.x", ".*")
+            if not (
+                (re.match(src_ip, device_ip_address) and matches(dst_ip, peers))
+                or (re.match(dst_ip, device_ip_address) and matches(src_ip, peers))
+            ):
+                continue
+            if (
+                "protocol" in rule
+                and protocols is not None
+                and int(rule["protocol"]) not in protocols
+            ):
+                continue
+            rules.append(rule)
+
+        return {
+            "device_ip": device_ip_address,
+            "device": device_info,
+            "rules": rules,
+        }
+
+    def label_data(self, filename: str, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Main function to label the data for a specific IoT device.
+
+        Args:
+            filename: The filename containing device identification info.
+            df: Input DataFrame containing network traffic.
+
+        Returns:
+            A DataFrame with labeled network traffic.
+        """
+        device_ip_address, device_info = self.device_ip_address(filename)
 
         # Filter traffic for this device
         df = self.filter_traffic_by_device(df, device_ip_address)
@@ -156,3 +235,36 @@ class Labeller:
         df = self.label_malicious_traffic_by_ip(df)
 
         return df
+
+    def label_flows(self, filename: str, flows: pd.DataFrame) -> pd.DataFrame:
+        """
+        Label bidirectional flows for a specific IoT device with the packet rules.
+
+        A flow row carries the addresses and ports of its initiator, so it is labelled
+        like its first packet. The malicious rules match a single direction: the flows
+        they miss are matched again in the reverse direction, e.g. a connection the
+        device opened to an attacker.
+
+        Args:
+            filename: The filename containing device identification info.
+            flows: Flow rows from a FlowTable.
+
+        Returns:
+            A DataFrame with labeled flows.
+        """
+        flows = self.label_data(filename, flows)
+
+        unknown = flows["label"] == "Unknown"
+        if unknown.any():
+            reverse = flows[unknown].rename(
+                columns={
+                    "ip.src": "ip.dst",
+                    "ip.dst": "ip.src",
+                    "tcp.srcport": "tcp.dstport",
+                    "tcp.dstport": "tcp.srcport",
+                }
+            )
+            reverse = self.label_malicious_traffic_by_ip(reverse)
+            flows.loc[unknown, "label"] = reverse["label"]
+
+        return flows
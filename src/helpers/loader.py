@@ -0,0 +1,264 @@
+import os
+import re
+import glob
+import queue
+import threading
+import numpy as np
+import pandas as pd
+
+
+SPLITS = ["train", "val", "test"]
+
+# Suffix of the label files of every target
+TARGETS = {"label": "labels", "label_category": "labels_grouped"}
+
+
+def final_devices(data_dir, split="train"):
+    """
+    List the devices with preprocessed files in a directory.
+
+    Parameters:
+        data_dir (str): Directory of the files written by run_preprocessing.
+        split (str): One of "train", "val" or "test".
+
+    Returns:
+        list: Sorted device names.
+    """
+    pattern = re.compile(rf"(.+)_{split}_features\.pkl$")
+    devices = []
+    for path in glob.glob(os.path.join(data_dir, f"*_{split}_features.pkl")):
+        match = pattern.match(os.path.basename(path))
+        if match:
+            devices.append(match.group(1))
+    return sorted(devices)
+
+
+class MinibatchLoader:
+    def __init__(
+        self,
+        data_dir,
+        split="train",
+        devices=None,
+        batch_size=256,
+        target="label_category",
+        shuffle=True,
+        buffer_size=2**16,
+        prefetch=4,
+        seed=42,
+        drop_last=False,
+    ):
+        """
+        Streams shuffled minibatches of the preprocessed training, validation or testing
+        sets, instead of loading every device into memory.
+
+        The devices are read one at a time, in an order shuffled every epoch, while a
+        background thread loads the next one and assembles the batches ahead of the
+        training loop (up to prefetch batches). Each device's rows are permuted and go
+        through a shuffle buffer of buffer_size rows: every incoming batch replaces
+        randomly chosen rows of the buffer, which are emitted instead, so rows of
+        consecutive devices are mixed while at most one device and the buffer are held in
+        memory. The order only depends on the seed and the epoch, so a run can be
+        reproduced.
+
+        Parameters:
+            data_dir (str): Directory of the files written by run_preprocessing.
+            split (str): One of "train", "val" or "test".
+            devices (list): Devices to read, e.g. one federated client (default is every
+                device, for centralised training).
+            batch_size (int): Number of rows per batch.
+            target (str): Either "label" or "label_category".
+            shuffle (bool): Whether to shuffle the rows (default is True).
+            buffer_size (int): Number of rows of the shuffle buffer.
+            prefetch (int): Number of batches prepared ahead by the background thread.
+            seed (int): Seed of the shuffling.
+            drop_last (bool): Whether to drop the last batch when it is incomplete.
+        """
+        if split not in SPLITS:
+            raise ValueError(f"Unknown split '{split}', expected one of {SPLITS}.")
+        if target not in TARGETS:
+            raise ValueError(f"Unknown target '{target}', expected one of {TARGETS}.")
+        if batch_size < 1 or prefetch < 1:
+            raise ValueError("batch_size and prefetch must be at least 1.")
+
+        self.data_dir = data_dir
+        self.split = split
+        self.devices = (
+            list(devices) if devices is not None else final_devices(data_dir, split)
+        )
+        self.batch_size = batch_size
+        self.target = target
+        self.shuffle = shuffle
+        self.buffer_size = max(buffer_size, batch_size)
+        self.prefetch = prefetch
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._rows = None
+
+        if not self.devices:
+            raise FileNotFoundError(f"No {split} files found in {data_dir}.")
+
+    @classmethod
+    def for_devices(cls, data_dir, split="train", **kwargs):
+        """
+        Build one loader per device, e.g. one per federated learning client.
+
+        Returns:
+            dict: MinibatchLoader of every device.
+        """
+        return {
+            device: cls(data_dir, split, devices=[device], **kwargs)
+            for device in final_devices(data_dir, split)
+        }
+
+    def paths(self, device):
+        """Return the features and labels files of a device."""
+        prefix = os.path.join(self.data_dir, f"{device}_{self.split}")
+        return f"{prefix}_features.pkl", f"{prefix}_{TARGETS[self.target]}.pkl"
+
+    def load_device(self, device):
+        """
+        Load the features and labels of a device.
+
+        Returns:
+            tuple: float32 features and int64 labels as numpy arrays.
+        """
+        features_path, labels_path = self.paths(device)
+        X = pd.read_pickle(features_path, compression="gzip")
+        y = pd.read_pickle(labels_path, compression="gzip")
+        return X.to_numpy(dtype=np.float32), y[self.target].to_numpy(dtype=np.int64)
+
+    def num_rows(self):
+        """Return the number of rows of the devices, from their label files."""
+        if self._rows is None:
+            self._rows = sum(
+                len(pd.read_pickle(self.paths(device)[1], compression="gzip"))
+                for device in self.devices
+            )
+        return self._rows
+
+    def __len__(self):
+        """Return the number of batches per epoch."""
+        if self.drop_last:
+            return self.num_rows() // self.batch_size
+        return -(-self.num_rows() // self.batch_size)
+
+    def set_epoch(self, epoch):
+        """Set the epoch of the next iteration, which seeds its order."""
+        self.epoch = epoch
+
+    def __iter__(self):
+        """
+        Iterate over the batches of an epoch; every iteration starts the next epoch.
+
+        Yields:
+            tuple: (features, labels) numpy arrays of batch_size rows.
+        """
+        rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            """Wait for room in the queue, unless the loop stopped; return False if so."""
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for batch in self._batches(rng):
+                    if not put(batch):
+                        return
+                put(None)
+            except BaseException as e:  # Raised in the training loop instead
+                put(e)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                if isinstance(batch, BaseException):
+                    raise batch
+                yield batch
+        finally:
+            # The loop may stop early: release the producer blocked on the queue
+            stop.set()
+            thread.join()
+
+    def _batches(self, rng):
+        devices = list(self.devices)
+        if self.shuffle:
+            devices = [devices[i] for i in rng.permutation(len(devices))]
+
+        pending = self._rows_of(devices, rng)
+        if self.shuffle:
+            pending = self._shuffle_buffer(pending, rng)
+        yield from self._rebatch(pending)
+
+    def _rows_of(self, devices, rng):
+        """Yield the rows of the devices in blocks of at most batch_size rows."""
+        for device in devices:
+            X, y = self.load_device(device)
+            order = rng.permutation(len(y)) if self.shuffle else np.arange(len(y))
+            for start in range(0, len(y), self.batch_size):
+                index = order[start : start + self.batch_size]
+                yield X[index], y[index]
+            del X, y
+
+    def _shuffle_buffer(self, blocks, rng):
+        """Shuffle blocks of rows through a fixed-size buffer."""
+        buffer_X, buffer_y, filled = None, None, 0
+        for X, y in blocks:
+            if buffer_X is None:
+                buffer_X = np.empty((self.buffer_size, X.shape[1]), dtype=X.dtype)
+                buffer_y = np.empty(self.buffer_size, dtype=y.dtype)
+
+            if filled < self.buffer_size:
+                # Fill the buffer before emitting anything
+                n = min(len(y), self.buffer_size - filled)
+                buffer_X[filled : filled + n] = X[:n]
+                buffer_y[filled : filled + n] = y[:n]
+                filled += n
+                X, y = X[n:], y[n:]
+                if not len(y):
+                    continue
+
+            # Emit random rows of the buffer and put the incoming rows in their place
+            slots = rng.choice(self.buffer_size, size=len(y), replace=False)
+            yield buffer_X[slots].copy(), buffer_y[slots].copy()
+            buffer_X[slots] = X
+            buffer_y[slots] = y
+
+        if filled:
+            order = rng.permutation(filled)
+            yield buffer_X[order], buffer_y[order]
+
+    def _rebatch(self, blocks):
+        """Cut blocks of rows of any size into batches of batch_size rows."""
+        pending_X, pending_y, n = [], [], 0
+        for X, y in blocks:
+            pending_X.append(X)
+            pending_y.append(y)
+            n += len(y)
+            if n < self.batch_size:
+                continue
+
+            X, y = np.concatenate(pending_X), np.concatenate(pending_y)
+            end = n - n % self.batch_size
+            for start in range(0, end, self.batch_size):
+                yield X[start : start + self.batch_size], y[
+                    start : start + self.batch_size
+                ]
+            pending_X, pending_y, n = [X[end:]], [y[end:]], n - end
+
+        if n and not self.drop_last:
+            yield np.concatenate(pending_X), np.concatenate(pending_y)
@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+import psutil
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+RUN_ID_ENV = "GOTHAM_RUN_ID"
+REPORT_DIR_ENV = "GOTHAM_REPORT_DIR"
+
+
+class StageMetrics:
+    def __init__(self, run_id, stage, unit=None):
+        """
+        Metrics of one stage, or of one unit (file or device) processed by a stage.
+
+        Parameters:
+            run_id (str): Identifier of the pipeline run.
+            stage (str): Name of the stage, e.g. "label".
+            unit (str): File or device processed, None for the whole stage.
+        """
+        self.run_id = run_id
+        self.stage = stage
+        self.unit = unit
+        self.rows_in = None
+        self.rows_out = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_rss = 0
+        self.started_at = None
+        self.wall_time = None
+        self.status = "running"
+        self.details = {}  # Stage-specific fields, e.g. the exit code of a process
+
+    def read(self, *paths):
+        """Count the size of the given files as bytes read."""
+        self.bytes_read += sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+    def wrote(self, *paths):
+        """Count the size of the given files as bytes written."""
+        self.bytes_written += sum(
+            os.path.getsize(p) for p in paths if os.path.exists(p)
+        )
+
+    def to_dict(self):
+        rows = self.rows_out if self.rows_out is not None else self.rows_in
+        return {
+            "run_id": self.run_id,
+            "stage": self.stage,
+            "unit": self.unit,
+            "status": self.status,
+            "started_at": self.started_at,
+            "wall_time_s": round(self.wall_time, 4),
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "rows_per_s": (
+                round(rows / self.wall_time, 1) if rows and self.wall_time else None
+            ),
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "peak_rss_mb": round(self.peak_rss / 2**20, 1),
+            "pid": os.getpid(),
+            "host": socket.gethostname(),
+            **self.details,
+        }
+
+
+# Stages and units being measured in this process, innermost last
+_active_stages = []
+
+
+def current_stage():
+    """Return the metrics of the innermost stage or unit being measured, if any."""
+    return _active_stages[-1] if _active_stages else None
+
+
+class _RSSSampler:
+    """Background thread sampling the RSS of the process for the active metrics."""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.active = set()
+        self.lock = threading.Lock()
+        self.process = psutil.Process()
+        self.thread = None
+
+    def sample(self):
+        rss = self.process.memory_info().rss
+        with self.lock:
+            for metrics in self.active:
+                metrics.peak_rss = max(metrics.peak_rss, rss)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+    def add(self, metrics):
+        with self.lock:
+            self.active.add(metrics)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.sample()
+
+    def remove(self, metrics):
+        self.sample()
+        with self.lock:
+            self.active.discard(metrics)
+
+
+class RunReport:
+    _sampler = None
+
+    def __init__(self, report_dir, run_id=None):
+        """
+        Structured JSONL report of a pipeline run.
+
+        Every stage and every unit (file or device) processed by a stage appends one line
+        with its wall time, rows in and out, bytes read and written and peak RSS. All the
+        processes of a run (stage scripts, pool workers) append to the same file, which is
+        named after the run identifier.
+
+        Parameters:
+            report_dir (str): Directory of the run reports.
+            run_id (str): Identifier of the run (default is a new timestamped identifier).
+        """
+        self.report_dir = report_dir
+        self.run_id = run_id or (
+            datetime.now().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6]
+        )
+        self.path = os.path.join(report_dir, f"{self.run_id}.jsonl")
+
+    def write(self, record):
+        """Append a record to the report."""
+        os.makedirs(self.report_dir, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    @contextmanager
+    def stage(self, stage, unit=None):
+        """
+        Measure a stage or a unit of a stage and append its metrics to the report.
+
+        Parameters:
+            stage (str): Name of the stage.
+            unit (str): File or device processed, None for the whole stage.
+
+        Yields:
+            StageMetrics: Metrics to fill with the rows and bytes processed.
+        """
+        if RunReport._sampler is None:
+            RunReport._sampler = _RSSSampler()
+
+        metrics = StageMetrics(self.run_id, stage, unit)
+        metrics.started_at = datetime.now(timezone.utc).isoformat()
+        RunReport._sampler.add(metrics)
+        _active_stages.append(metrics)
+        start = time.perf_counter()
+        try:
+            yield metrics
+            metrics.status = "ok"
+        except BaseException:
+            metrics.status = "error"
+            raise
+        finally:
+            metrics.wall_time = time.perf_counter() - start
+            _active_stages.remove(metrics)
+            RunReport._sampler.remove(metrics)
+            self.write(metrics.to_dict())
+
+    def records(self):
+        """Return the records written to the report so far."""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def summary(self):
+        """
+        Summarise the report per stage.
+
+        The wall time of a stage is the one of its stage-level record when present (the
+        units of a stage may run in parallel), while rows and bytes are summed over the
+        units and the peak RSS is the largest one of any process of the stage.
+
+        Returns:
+            dict: Totals of every stage, in order of first appearance.
+        """
+        summary = {}
+        for record in self.records():
+            totals = summary.setdefault(
+                record["stage"],
+                {
+                    "units": 0,
+                    "wall_time_s": 0.0,
+                    "rows_in": 0,
+                    "rows_out": 0,
+                    "bytes_read": 0,
+                    "bytes_written": 0,
+                    "peak_rss_mb": 0.0,
+                    "failed": 0,
+                },
+            )
+            totals["peak_rss_mb"] = max(totals["peak_rss_mb"], record["peak_rss_mb"])
+            totals["failed"] += record["status"] != "ok"
+            if record["unit"] is None:
+                totals["wall_time_s"] += record["wall_time_s"]
+                continue
+
+            totals["units"] += 1
+            for key in ["rows_in", "rows_out", "bytes_read", "bytes_written"]:
+                totals[key] += record[key] or 0
+        return summary
+
+
+_run_report = None
+
+
+def run_report(default_dir):
+    """
+    Return the run report of the current process.
+
+    The run identifier and report directory are taken from the GOTHAM_RUN_ID and
+    GOTHAM_REPORT_DIR environment variables when set. Otherwise a new run is started and
+    the variables are exported, so subprocesses and pool workers join the same run.
+
+    Parameters:
+        default_dir (str): Report directory used when GOTHAM_REPORT_DIR is not set.
+
+    Returns:
+        RunReport: The run report.
+    """
+    global _run_report
+    if _run_report is None:
+        _run_report = RunReport(
+            os.environ.get(REPORT_DIR_ENV, default_dir), os.environ.get(RUN_ID_ENV)
+        )
+        os.environ[RUN_ID_ENV] = _run_report.run_id
+        os.environ[REPORT_DIR_ENV] = _run_report.report_dir
+    return _run_report
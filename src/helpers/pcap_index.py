@@ -0,0 +1,362 @@
+import os
+import mmap
+import struct
+from array import array
+
+import numpy as np
+import pandas as pd
+
+from src.helpers.checkpoint import atomic_output
+
+
+INDEX_VERSION = 1
+
+# Suffix of the index written next to a capture
+INDEX_SUFFIX = ".pcapidx"
+
+# Header of an index file: magic, version, capture size and modification time, number
+# of packets; the packet records follow
+INDEX_MAGIC = b"GOTHPIDX"
+INDEX_HEADER = struct.Struct("<8sIQqQ")
+
+# One record per packet, in capture order: byte offset and captured length of its data,
+# timestamp in nanoseconds (NaT when the capture has none) and link-layer type
+PACKET_DTYPE = np.dtype(
+    [("offset", "<u8"), ("time", "<i8"), ("length", "<u4"), ("linktype", "<u2")]
+)
+
+NAT = np.iinfo(np.int64).min
+
+# Magic numbers of the pcap file header, with the resolution of their timestamps
+PCAP_MAGICS = {0xA1B2C3D4: 10**3, 0xA1B23C4D: 1}
+
+# pcapng blocks read by the indexer
+SECTION_HEADER_BLOCK = 0x0A0D0D0A
+INTERFACE_BLOCK = 1
+PACKET_BLOCK = 2  # Obsolete, still written by old tools
+SIMPLE_PACKET_BLOCK = 3
+ENHANCED_PACKET_BLOCK = 6
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+IF_TSRESOL = 9
+
+
+def index_path(capture):
+    """Return the path of the packet index of a capture."""
+    return os.path.splitext(capture)[0] + INDEX_SUFFIX
+
+
+def _file_state(path):
+    """Return the size and modification time identifying the version of a file."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _pcap_packets(data, packets):
+    """Append the packets of a pcap file to the record columns."""
+    for endian in "<>":
+        (magic,) = struct.unpack_from(endian + "I", data, 0)
+        if magic in PCAP_MAGICS:
+            break
+    else:
+        raise ValueError("Not a pcap or pcapng file.")
+
+    scale = PCAP_MAGICS[magic]
+    linktype = struct.unpack_from(endian + "I", data, 20)[0] & 0xFFFF
+    record = struct.Struct(endian + "IIII")
+    offset, size = 24, len(data)
+    while offset + record.size <= size:
+        seconds, fraction, length, _ = record.unpack_from(data, offset)
+        offset += record.size
+        if offset + length > size:
+            break  # Truncated last packet
+        packets["offset"].append(offset)
+        packets["time"].append(seconds * 10**9 + fraction * scale)
+        packets["length"].append(length)
+        packets["linktype"].append(linktype)
+        offset += length
+
+
+def _interface(data, endian, start, end):
+    """Return the link-layer type, snapshot length and timestamp unit of an IDB."""
+    linktype, _, snaplen = struct.unpack_from(endian + "HHI", data, start)
+    resolution = 6  # Microseconds, unless an option says otherwise
+    offset = start + 8
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(endian + "HH", data, offset)
+        if code == 0:
+            break
+        if code == IF_TSRESOL:
+            resolution = data[offset + 4]
+        offset += 4 + (length + 3) // 4 * 4
+
+    # Nanoseconds per tick, as a fraction: 10^-n or 2^-n seconds
+    if resolution & 0x80:
+        return linktype, snaplen, (10**9, 2 ** (resolution & 0x7F))
+    return (
+        linktype,
+        snaplen,
+        (10 ** max(9 - resolution, 0), 10 ** max(resolution - 9, 0)),
+    )
+
+
+def _pcapng_packets(data, packets):
+    """Append the packets of a pcapng file to the record columns."""
+    endian, interfaces = "<", []
+    offset, size = 0, len(data)
+    while offset + 12 <= size:
+        (block_type,) = struct.unpack_from(endian + "I", data, offset)
+        if block_type == SECTION_HEADER_BLOCK:
+            # A section sets the byte order and interfaces of the blocks that follow
+            (magic,) = struct.unpack_from("<I", data, offset + 8)
+            endian = "<" if magic == BYTE_ORDER_MAGIC else ">"
+            interfaces = []
+        (block_length,) = struct.unpack_from(endian + "I", data, offset + 4)
+        if block_length < 12 or offset + block_length > size:
+            break  # Truncated last block
+
+        body = offset + 8
+        if block_type == INTERFACE_BLOCK:
+            interfaces.append(_interface(data, endian, body, offset + block_length - 4))
+        elif block_type in (ENHANCED_PACKET_BLOCK, PACKET_BLOCK):
+            if block_type == ENHANCED_PACKET_BLOCK:
+                interface, high, low, length = struct.unpack_from(
+                    endian + "IIII", data, body
+                )
+            else:
+                interface, _, high, low, length = struct.unpack_from(
+                    endian + "HHIII", data, body
+                )
+            linktype, _, (numerator, denominator) = interfaces[interface]
+            packets["offset"].append(body + 20)
+            packets["time"].append(((high << 32) | low) * numerator // denominator)
+            packets["length"].append(length)
+            packets["linktype"].append(linktype)
+        elif block_type == SIMPLE_PACKET_BLOCK:
+            # No timestamp; the data fills the block, up to the snapshot length
+            linktype, snaplen, _ = interfaces[0]
+            (length,) = struct.unpack_from(endian + "I", data, body)
+            length = min(length, block_length - 16, snaplen or length)
+            packets["offset"].append(body + 4)
+            packets["time"].append(NAT)
+            packets["length"].append(length)
+            packets["linktype"].append(linktype)
+        offset += block_length
+
+
+class PcapIndex:
+    def __init__(self, capture, records):
+        """
+        Index of the packets of a pcap or pcapng capture, giving random access to a
+        packet by its frame number (1-based, as tshark's frame.number) or to the
+        packets of a time range through an mmap of the capture.
+
+        Parameters:
+            capture (str): Path of the capture.
+            records (np.ndarray): One PACKET_DTYPE record per packet, in capture order.
+        """
+        self.capture = capture
+        self.records = records
+        self._mmap = None
+        self._file = None
+
+        # Time ranges are binary searched in captures whose packets are in time order
+        time = records["time"]
+        self._sorted = bool(np.all(time != NAT) and np.all(np.diff(time) >= 0))
+
+    @classmethod
+    def build(cls, capture):
+        """Scan a capture and index its packets, reading only their headers."""
+        packets = {
+            "offset": array("Q"),
+            "time": array("q"),
+            "length": array("I"),
+            "linktype": array("H"),
+        }
+        with open(capture, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    (magic,) = struct.unpack_from("<I", data, 0)
+                    if magic == SECTION_HEADER_BLOCK:
+                        _pcapng_packets(data, packets)
+                    else:
+                        _pcap_packets(data, packets)
+
+        records = np.empty(len(packets["offset"]), dtype=PACKET_DTYPE)
+        for name, values in packets.items():
+            records[name] = np.frombuffer(values, dtype=values.typecode)
+        return cls(capture, records)
+
+    def save(self):
+        """Write the index next to the capture."""
+        size, mtime_ns = _file_state(self.capture)
+        with atomic_output(index_path(self.capture)) as tmp_file:
+            with open(tmp_file, "wb") as f:
+                f.write(
+                    INDEX_HEADER.pack(
+                        INDEX_MAGIC, INDEX_VERSION, size, mtime_ns, len(self)
+                    )
+                )
+                f.write(np.ascontiguousarray(self.records).tobytes())
+
+    @classmethod
+    def load(cls, capture):
+        """
+        Load the index of a capture. The packet records are memory-mapped, so loading
+        does not depend on the size of the capture.
+
+        Raises:
+            FileNotFoundError: The capture has no index.
+            ValueError: The index has another version or the capture changed since.
+        """
+        path = index_path(capture)
+        with open(path, "rb") as f:
+            header = f.read(INDEX_HEADER.size)
+        if len(header) < INDEX_HEADER.size:
+            raise ValueError(f"Index of '{capture}' is truncated.")
+
+        magic, version, size, mtime_ns, count = INDEX_HEADER.unpack(header)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(
+                f"Index of '{capture}' has version {version}, expected {INDEX_VERSION}."
+            )
+        if (size, mtime_ns) != _file_state(capture):
+            raise ValueError(f"'{capture}' changed since it was indexed.")
+
+        if count == 0:
+            return cls(capture, np.empty(0, dtype=PACKET_DTYPE))
+        packets = np.memmap(
+            path, dtype=PACKET_DTYPE, mode="r", offset=INDEX_HEADER.size, shape=count
+        )
+        return cls(capture, packets)
+
+    @classmethod
+    def open(cls, capture):
+        """Load the index of a capture, indexing it first if needed."""
+        try:
+            return cls.load(capture)
+        except (FileNotFoundError, ValueError):
+            index = cls.build(capture)
+            index.save()
+            return index
+
+    def __len__(self):
+        return len(self.records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Unmap the capture."""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = self._file = None
+
+    def _data(self):
+        """Return the mmap of the capture, opened on first access."""
+        if self._mmap is None:
+            self._file = open(self.capture, "rb")
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _select(self, frames):
+        """Return the records of some frame numbers."""
+        frames = np.asarray(frames, dtype=np.int64)
+        if len(frames) and (frames.min() < 1 or frames.max() > len(self)):
+            raise IndexError(
+                f"Frame numbers of '{self.capture}' range from 1 to {len(self)}."
+            )
+        return self.records[frames - 1]
+
+    def times(self):
+        """Return the timestamps of the packets, in capture order."""
+        return np.asarray(self.records["time"]).view("datetime64[ns]")
+
+    def frames(self, start=None, end=None):
+        """
+        Return the frame numbers of the packets within a time range.
+
+        Parameters:
+            start: First time of the range, inclusive (default is unbounded).
+            end: Last time of the range, exclusive (default is unbounded).
+
+        Returns:
+            np.ndarray: Sorted frame numbers.
+        """
+        start = NAT if start is None else pd.Timestamp(start).value
+        end = None if end is None else pd.Timestamp(end).value
+        time = self.records["time"]
+        if self._sorted:
+            first = np.searchsorted(time, start, side="left")
+            last = len(time) if end is None else np.searchsorted(time, end, side="left")
+            return np.arange(first + 1, max(first, last) + 1, dtype=np.int64)
+
+        match = (time >= start) & (time != NAT)
+        if end is not None:
+            match &= time < end
+        return np.flatnonzero(match) + 1
+
+    def packet(self, frame):
+        """Return the data of the packet with a frame number."""
+        return self.packets([frame])[0]
+
+    def packets(self, frames):
+        """
+        Return the data of the packets with some frame numbers.
+
+        Parameters:
+            frames (list): Frame numbers, e.g. the frame.number column of labelled rows.
+
+        Returns:
+            list: The bytes of every packet, in the order of the frame numbers.
+        """
+        data = self._data()
+        return [
+            data[offset : offset + length]
+            for offset, length in zip(
+                *(self._select(frames)[name].tolist() for name in ("offset", "length"))
+            )
+        ]
+
+    def write_pcap(self, frames, output_file):
+        """
+        Write the packets with some frame numbers to a pcap file, e.g. to open the
+        packets behind some labelled rows in Wireshark.
+
+        Parameters:
+            frames (list): Frame numbers of the packets, in the order to write them.
+            output_file (str): Path of the pcap file.
+
+        Returns:
+            int: Number of packets written.
+        """
+        records = self._select(frames)
+        linktypes = np.unique(records["linktype"])
+        if len(linktypes) > 1:
+            raise ValueError(
+                f"The packets have several link-layer types {linktypes.tolist()}, "
+                "which a pcap file cannot hold."
+            )
+        linktype = int(linktypes[0]) if len(linktypes) else 1
+
+        data = self._data()
+        record = struct.Struct("<IIII")
+        with atomic_output(output_file) as tmp_file:
+            with open(tmp_file, "wb") as f:
+                # Nanosecond pcap header
+                f.write(
+                    struct.pack("<IHHiIII", 0xA1B23C4D, 2, 4, 0, 0, 262144, linktype)
+                )
+                for offset, time, length in zip(
+                    records["offset"].tolist(),
+                    records["time"].tolist(),
+                    records["length"].tolist(),
+                ):
+                    time = max(time, 0)
+                    seconds, nanoseconds = divmod(time, 10**9)
+                    f.write(record.pack(seconds, nanoseconds, length, length))
+                    f.write(data[offset : offset + length])
+        return len(records)
@@ -4,120 +4,243 @@ from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import (
     FunctionTransformer,
     StandardScaler,
-    OneHotEncoder,
     LabelEncoder,
 )
 from sklearn.compose import ColumnTransformer
 
+from src.helpers.category_encoder import CategoryEncoder
+from src.helpers.fields import PREPROCESSOR_FIELDS
+from src.helpers.schema import fill_integers
+from src.helpers.window_features import WindowFeatureEngine
+
 
 class DataPreprocessor:
+    # Extracted fields read by the conversion steps up to select_columns
+    REQUIRED_FIELDS = PREPROCESSOR_FIELDS
+
+    # Columns of the feature transformer that are not standardised
+    FLAG_FEATURES = ["ip.flags", "tcp.flags"]
+    CATEGORICAL_FEATURES = ["ip.protocol", "src.port", "dst.port"]
+
+    # Protocols of the packets, matched in order in frame.protocols, and the layer
+    # holding their ports
+    PROTOCOL_LAYERS = [
+        (":tcp", "TCP", "tcp"),
+        (":udp", "UDP", "udp"),
+        (":icmp", "ICMP", None),
+    ]
+
     def __init__(
         self,
         port_hierarchy_map_iot,
-        global_categorical_values,
+        categorical_vocabularies,
         global_label_values,
         global_label_grouped_values,
         training_size=0.6,
         validation_size=0.2,
         testing_size=0.2,
+        windows=None,
     ):
         """
         Initialize the DataPreprocessor with required mappings and configurations.
 
         Parameters:
         port_hierarchy_map_iot (dict): Port hierarchy map for IoT devices.
-        global_categorical_values (dict): Global categorical values for encoding.
+        categorical_vocabularies (dict): Categories of every categorical feature, in the order of their one-hot columns.
         global_label_values (list): List of global label values for encoding.
         training_size (float): Proportion of the data to be used for training (default is 0.6).
         validation_size (float): Proportion of the data to be used for validation (default is 0.2).
         testing_size (float): Proportion of the data to be used for testing (default is 0.2).
+        windows (list): Lengths in seconds of the sliding windows of the host statistics features (default is no window features).
         """
         self.port_hierarchy_map_iot = port_hierarchy_map_iot
-        self.global_categorical_values = global_categorical_values
+        self.categorical_vocabularies = categorical_vocabularies
         self.global_label_values = global_label_values
         self.global_label_grouped_values = global_label_grouped_values
         self.training_size = training_size
         self.validation_size = validation_size
         self.testing_size = testing_size
+        self.windows = list(windows) if windows else []
+        self._port_categories = None
 
-    def scale(self, training_set, validation_set, testing_set):
+    def build_transformer(self, numeric_features):
         """
-        Scale the numerical features and encode categorical features using OneHotEncoder.
+        Build an unfitted ColumnTransformer for the flag, categorical and numerical features.
 
         Parameters:
-        training_set (tuple): A tuple containing the training features and labels.
-        validation_set (tuple): A tuple containing the validation features and labels.
-        testing_set (tuple): A tuple containing the testing features and labels.
+        numeric_features (list): Names of the numerical columns to standardise.
 
         Returns:
-        tuple: A tuple containing the scaled and encoded training, validation, and testing sets.
+        ColumnTransformer: Unfitted feature transformer.
         """
-        (X_train, y_train), (X_val, y_val), (X_test, y_test) = (
-            training_set,
-            validation_set,
-            testing_set,
-        )
-
-        categorical_features = X_train.select_dtypes(exclude=["number"]).columns
-        numeric_features = X_train.select_dtypes(exclude=[object]).columns
-
-        preprocessor = ColumnTransformer(
+        return ColumnTransformer(
             transformers=[
                 (
                     "flags",
                     FunctionTransformer(self.unpack_flags),
-                    ["ip.flags", "tcp.flags"],
+                    self.FLAG_FEATURES,
                 ),
                 (
                     "categoricals",
-                    OneHotEncoder(
-                        drop="first", sparse_output=True, handle_unknown="error"
-                    ),
-                    ["ip.protocol", "src.port", "dst.port"],
+                    CategoryEncoder(self.categorical_vocabularies),
+                    self.CATEGORICAL_FEATURES,
                 ),
                 ("numericals", StandardScaler(), numeric_features),
             ]
         )
 
+    def fit_transformer(self, X_train, numerical_statistics=None):
+        """
+        Fit the feature transformer on training features.
+
+        The categorical encoder uses the fixed categorical vocabularies, so every device
+        produces the same one-hot columns. When numerical statistics merged from several
+        devices are given, they replace the ones computed on X_train.
+
+        Parameters:
+        X_train (pandas.DataFrame): Training features (or a sample of them).
+        numerical_statistics (StandardScaler): Scaler holding statistics merged over all training data (optional).
+
+        Returns:
+        ColumnTransformer: Fitted feature transformer.
+        """
+        numeric_features = self.numeric_features(X_train)
+
+        preprocessor = self.build_transformer(numeric_features)
         preprocessor.fit(X_train)
-        preprocessor["categoricals"].fit(self.global_categorical_values)
 
-        # Preprocess the features
-        X_train = pd.DataFrame(preprocessor.transform(X_train))
-        X_val = pd.DataFrame(preprocessor.transform(X_val))
-        X_test = pd.DataFrame(preprocessor.transform(X_test))
+        if numerical_statistics is not None:
+            scaler = preprocessor["numericals"]
+            scaler.mean_ = numerical_statistics.mean_
+            scaler.var_ = numerical_statistics.var_
+            scaler.scale_ = numerical_statistics.scale_
+            scaler.n_samples_seen_ = numerical_statistics.n_samples_seen_
 
-        # Preprocess the labels
-        le = LabelEncoder()
-        le.fit(self.global_label_values)
+        return preprocessor
 
-        y_train_not_grouped = pd.DataFrame(
-            le.transform(y_train["label"]), columns=["label"]
-        )
-        y_val_not_grouped = pd.DataFrame(
-            le.transform(y_val["label"]), columns=["label"]
-        )
-        y_test_not_grouped = pd.DataFrame(
-            le.transform(y_test["label"]), columns=["label"]
-        )
+    @classmethod
+    def numeric_features(cls, X):
+        """
+        Return the numerical columns of a feature set, standardised by the transformer.
+
+        The flags and categorical columns are excluded by name, as the flags are held as
+        integers by the compact packet schema.
+
+        Parameters:
+        X (pandas.DataFrame): Features.
 
+        Returns:
+        list: Names of the numerical columns.
+        """
+        excluded = set(cls.FLAG_FEATURES) | set(cls.CATEGORICAL_FEATURES)
+        return [
+            column
+            for column in X.select_dtypes(exclude=[object, "category"]).columns
+            if column not in excluded
+        ]
+
+    @staticmethod
+    def merge_numerical_statistics(scalers):
+        """
+        Merge StandardScalers fitted on disjoint datasets into a single one.
+
+        The means and variances are combined pairwise in the given order, so merging the
+        same scalers in the same order always gives the same statistics.
+
+        Parameters:
+        scalers (list): Fitted StandardScalers sharing the same features.
+
+        Returns:
+        StandardScaler: Scaler with the statistics of the concatenated datasets.
+        """
+        n = 0
+        mean, var = None, None
+        for scaler in scalers:
+            n_b = scaler.n_samples_seen_
+            if mean is None:
+                n, mean, var = n_b, scaler.mean_, scaler.var_
+                continue
+
+            n_ab = n + n_b
+            delta = scaler.mean_ - mean
+            m2 = var * n + scaler.var_ * n_b + delta**2 * n * n_b / n_ab
+            mean = mean + delta * n_b / n_ab
+            var = m2 / n_ab
+            n = n_ab
+
+        merged = StandardScaler()
+        merged.n_features_in_ = scalers[0].n_features_in_
+        merged.feature_names_in_ = scalers[0].feature_names_in_
+        merged.n_samples_seen_ = n
+        merged.mean_ = mean
+        merged.var_ = var
+        merged.scale_ = np.sqrt(var)
+        merged.scale_[merged.scale_ < 10 * np.finfo(merged.scale_.dtype).eps] = 1.0
+        return merged
+
+    def fit_label_encoders(self):
+        """
+        Fit the label encoders on the global label values.
+
+        Returns:
+        tuple: LabelEncoders for the labels and the grouped labels.
+        """
         le = LabelEncoder()
-        le.fit(self.global_label_grouped_values)
+        le.fit(self.global_label_values["label"])
 
-        y_train_grouped = pd.DataFrame(
-            le.transform(y_train["label_category"]), columns=["label_category"]
-        )
-        y_val_grouped = pd.DataFrame(
-            le.transform(y_val["label_category"]), columns=["label_category"]
-        )
-        y_test_grouped = pd.DataFrame(
-            le.transform(y_test["label_category"]), columns=["label_category"]
+        le_grouped = LabelEncoder()
+        le_grouped.fit(self.global_label_grouped_values["label"])
+
+        return le, le_grouped
+
+    @staticmethod
+    def transform(preprocessor, le, le_grouped, dataset):
+        """
+        Transform a dataset with an already fitted transformer and label encoders.
+
+        Parameters:
+        preprocessor (ColumnTransformer): Fitted feature transformer.
+        le (LabelEncoder): Fitted encoder for the labels.
+        le_grouped (LabelEncoder): Fitted encoder for the grouped labels.
+        dataset (tuple): A tuple containing the features and labels.
+
+        Returns:
+        tuple: Transformed features, labels and grouped labels.
+        """
+        X, y = dataset
+
+        X = pd.DataFrame(preprocessor.transform(X))
+        y_not_grouped = pd.DataFrame(le.transform(y["label"]), columns=["label"])
+        y_grouped = pd.DataFrame(
+            le_grouped.transform(y["label_category"]), columns=["label_category"]
         )
 
+        return X, y_not_grouped, y_grouped
+
+    def scale(self, training_set, validation_set, testing_set, artifact=None):
+        """
+        Scale the numerical features and one-hot encode the categorical features.
+
+        Parameters:
+        training_set (tuple): A tuple containing the training features and labels.
+        validation_set (tuple): A tuple containing the validation features and labels.
+        testing_set (tuple): A tuple containing the testing features and labels.
+        artifact (PreprocessorArtifact): Fitted artifact to reuse instead of fitting on the training set (optional).
+
+        Returns:
+        tuple: A tuple containing the scaled and encoded training, validation, and testing sets.
+        """
+        if artifact is None:
+            preprocessor = self.fit_transformer(training_set[0])
+            le, le_grouped = self.fit_label_encoders()
+        else:
+            preprocessor = artifact.transformer
+            le, le_grouped = artifact.label_encoder, artifact.label_grouped_encoder
+
         return (
-            (X_train, y_train_not_grouped, y_train_grouped),
-            (X_val, y_val_not_grouped, y_val_grouped),
-            (X_test, y_test_not_grouped, y_test_grouped),
+            self.transform(preprocessor, le, le_grouped, training_set),
+            self.transform(preprocessor, le, le_grouped, validation_set),
+            self.transform(preprocessor, le, le_grouped, testing_set),
         )
 
     def train_valid_test_split(self, df):
@@ -133,21 +256,68 @@ class DataPreprocessor:
         self.labels = df[["label", "label_category"]]
         self.features = df.drop(labels=["label", "label_category"], axis=1)
 
-        X_train, X_test, y_train, y_test = train_test_split(
-            self.features,
-            self.labels,
+        splits = self.split_positions(self.label_classes(self.labels))
+        return tuple(
+            (self.features.iloc[positions], self.labels.iloc[positions])
+            for positions in splits
+        )
+
+    @staticmethod
+    def label_classes(labels):
+        """
+        Return the classes the split is stratified on, one per label and label
+        category pair.
+
+        The classes are a categorical of the pairs joined by a space, whose sorted
+        categories order them as sklearn orders the rows of a frame of labels, so the
+        split is the same as when stratifying on the labels themselves. Categoricals of
+        several chunks of a dataset can be combined with union_categoricals and
+        sort_categories=True.
+
+        Parameters:
+        labels (pandas.DataFrame): Labels of the dataset.
+
+        Returns:
+        pandas.Categorical: The class of every row.
+        """
+        return pd.Categorical(
+            labels["label"].astype(str) + " " + labels["label_category"].astype(str)
+        )
+
+    def split_positions(self, classes):
+        """
+        Return the positions of the rows of the training, validation, and testing sets.
+
+        Parameters:
+        classes (pandas.Categorical): Class of every row, from label_classes.
+
+        Returns:
+        tuple: Positions of the training, validation, and testing rows.
+        """
+        positions = np.arange(len(classes))
+        train, test = train_test_split(
+            positions,
             test_size=(self.validation_size + self.testing_size),
             random_state=42,
-            stratify=self.labels,
+            stratify=classes.codes,
         )
-        X_test, X_val, y_test, y_val = train_test_split(
-            X_test,
-            y_test,
+        test, val = train_test_split(
+            test,
             test_size=self.testing_size / (self.validation_size + self.testing_size),
             random_state=42,
         )
+        return train, val, test
 
-        return (X_train, y_train), (X_val, y_val), (X_test, y_test)
+    def window_engine(self):
+        """
+        Build the engine computing the sliding-window features of a capture.
+
+        Returns:
+        WindowFeatureEngine: New engine, or None without window features.
+        """
+        if not self.windows:
+            return None
+        return WindowFeatureEngine(self.windows)
 
     @staticmethod
     def extract_protocols_and_ports(df):
@@ -160,26 +330,37 @@ class DataPreprocessor:
         Returns:
         pandas.DataFrame: Dataset with extracted protocol and port information.
         """
-        src_ports, dst_ports, protocols = [], [], []
-        for _, pkt in df.iterrows():
-            if ":tcp" in pkt["frame.protocols"]:
-                protocol = "TCP"
-                src_port = int(pkt["tcp.srcport"])
-                dst_port = int(pkt["tcp.dstport"])
-            elif ":udp" in pkt["frame.protocols"]:
-                protocol = "UDP"
-                src_port = int(pkt["udp.srcport"])
-                dst_port = int(pkt["udp.dstport"])
-            elif ":icmp" in pkt["frame.protocols"]:
-                protocol = "ICMP"
-                src_port = np.nan
-                dst_port = np.nan
-
-            protocols.append(protocol)
-            src_ports.append(src_port)
-            dst_ports.append(dst_port)
-
-        df["ip.protocol"] = protocols
+        protocols = df["frame.protocols"]
+        if isinstance(protocols.dtype, pd.CategoricalDtype):
+            # Match every distinct protocol stack once, then map the rows by code
+            stacks = pd.Series(protocols.cat.categories.astype(str))
+        else:
+            stacks = protocols.fillna("").astype(str)
+
+        layers = DataPreprocessor.PROTOCOL_LAYERS
+        matches = [
+            stacks.str.contains(marker, regex=False).to_numpy()
+            for marker, _, _ in layers
+        ]
+        codes = np.select(matches, np.arange(len(layers)), -1)
+        if isinstance(protocols.dtype, pd.CategoricalDtype):
+            codes = np.append(codes, -1)[protocols.cat.codes.to_numpy()]
+
+        # Packets of other protocols, as ICMP, have no ports
+        src_ports = np.full(len(df), np.nan)
+        dst_ports = np.full(len(df), np.nan)
+        for code, (_, _, layer) in enumerate(layers):
+            rows = codes == code
+            if layer is None or not rows.any():
+                continue
+            for ports, column in ((src_ports, "srcport"), (dst_ports, "dstport")):
+                values = df[f"{layer}.{column}"].to_numpy(dtype=float, na_value=np.nan)
+                ports[rows] = values[rows]
+
+        # Integer codes, the protocols missing from PROTOCOL_LAYERS being left missing
+        df["ip.protocol"] = pd.Categorical.from_codes(
+            codes, categories=[protocol for _, protocol, _ in layers]
+        )
         df["src.port"] = src_ports
         df["dst.port"] = dst_ports
 
@@ -207,12 +388,13 @@ class DataPreprocessor:
         Returns:
         pandas.DataFrame: Dataset with timestamp column.
         """
-        df["frame.time"] = df["frame.time"].str.replace("  ", " ")
-        df["frame.time"] = df["frame.time"].str.replace(" BST", "")
-        df["frame.time"] = df["frame.time"].str.replace(" GMT", "")
-        df["frame.time"] = pd.to_datetime(
-            df["frame.time"], format="%b %d, %Y %H:%M:%S.%f000"
-        )
+        if not pd.api.types.is_datetime64_dtype(df["frame.time"].dtype):
+            df["frame.time"] = df["frame.time"].str.replace("  ", " ")
+            df["frame.time"] = df["frame.time"].str.replace(" BST", "")
+            df["frame.time"] = df["frame.time"].str.replace(" GMT", "")
+            df["frame.time"] = pd.to_datetime(
+                df["frame.time"], format="%b %d, %Y %H:%M:%S.%f000"
+            )
         df["timestamp"] = df["frame.time"].values.astype(np.int64) // 10**9
         return df
 
@@ -226,14 +408,43 @@ class DataPreprocessor:
         Returns:
         pandas.DataFrame: Dataset with converted ports.
         """
-        df["src.port"] = df["src.port"].apply(
-            lambda port: self.port_to_categories(port)
-        )
-        df["dst.port"] = df["dst.port"].apply(
-            lambda port: self.port_to_categories(port)
-        )
+        categories = self.port_categories()
+        for column in ["src.port", "dst.port"]:
+            ports = df[column].to_numpy(dtype=float, na_value=np.nan)
+            known = (ports >= 0) & (ports < len(categories["codes"])) & (ports % 1 == 0)
+
+            # Missing and out-of-range ports fall in the "" category
+            codes = np.full(len(ports), categories["missing"], dtype=np.int32)
+            codes[known] = categories["codes"][ports[known].astype(np.int64)]
+            df[column] = pd.Categorical.from_codes(
+                codes, categories=categories["names"]
+            )
         return df
 
+    def port_categories(self):
+        """
+        Return the categories of the ports and the category code of every port number,
+        looked up once from the port hierarchy (the first range holding a port wins).
+
+        Returns:
+        dict: Category "names", "codes" of the port numbers 0 to 65535 and the code of
+        the "missing" ports.
+        """
+        if self._port_categories is None:
+            names = list(dict.fromkeys(name for _, name in self.port_hierarchy_map_iot))
+            names.append("")
+            codes = np.full(65536, len(names) - 1, dtype=np.int32)
+            for p_range, p_name in reversed(self.port_hierarchy_map_iot):
+                ports = np.array(list(p_range), dtype=np.int64)
+                ports = ports[(ports >= 0) & (ports < len(codes))]
+                codes[ports] = names.index(p_name)
+            self._port_categories = {
+                "names": names,
+                "codes": codes,
+                "missing": len(names) - 1,
+            }
+        return self._port_categories
+
     @staticmethod
     def convert_checksums(df):
         """
@@ -245,12 +456,14 @@ class DataPreprocessor:
         Returns:
         pandas.DataFrame: Dataset with converted checksum fields.
         """
-        df["ip.checksum"] = df["ip.checksum"].apply(
-            lambda x: int(str(x), 16) if pd.notna(x) else 0
-        )
-        df["tcp.checksum"] = df["tcp.checksum"].apply(
-            lambda x: int(str(x), 16) if pd.notna(x) else 0
-        )
+        for column in ["ip.checksum", "tcp.checksum"]:
+            if pd.api.types.is_integer_dtype(df[column].dtype):
+                # Already parsed by the packet schema
+                df[column] = df[column].fillna(0).astype(np.int64)
+            else:
+                df[column] = df[column].apply(
+                    lambda x: int(str(x), 16) if pd.notna(x) else 0
+                )
         df["tcp.options"] = (
             df["tcp.options"]
             .apply(lambda x: int(str(x), 16) if pd.notna(x) else 0)
@@ -270,10 +483,15 @@ class DataPreprocessor:
         pandas.DataFrame: Dataset with missing values filled.
         """
         num_cols = df.select_dtypes(include=["number"]).columns
-        df[num_cols] = df[num_cols].fillna(-1)
+        for column in num_cols:
+            # Nullable integer columns are widened to hold -1
+            df[column] = fill_integers(df[column], -1)
 
         cat_cols = df.select_dtypes(exclude=["number"]).columns
-        df[cat_cols] = df[cat_cols].fillna(-1)
+        for column in cat_cols[df[cat_cols].isna().any()]:
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].cat.add_categories([-1])
+            df[column] = df[column].fillna(-1)
 
         return df
 
@@ -303,9 +521,10 @@ class DataPreprocessor:
             "tcp.checksum",
             "tcp.options",
             "tcp.pdu.size",
-            "label",
-            "label_category",
         ]
+        # Sliding-window features, when computed
+        selected_columns += [c for c in df.columns if c.startswith("win.")]
+        selected_columns += ["label", "label_category"]
 
         df = df[selected_columns]
         df = df[df["label"] != "Unknown"]
@@ -350,21 +569,27 @@ class DataPreprocessor:
         return df
 
     @staticmethod
-    def unpack_flags(X):
+    def _flag_values(flags):
+        """Return flags, hex text or integers, as uint8 with -1 (missing) as 0."""
+        if pd.api.types.is_numeric_dtype(flags.dtype):
+            values = flags.to_numpy(dtype=np.int64)
+            return np.where(values < 0, 0, values).astype(np.uint8)
+        return flags.apply(lambda x: int(x, 16) if x != -1 else 0).values.astype(
+            np.uint8
+        )
+
+    @classmethod
+    def unpack_flags(cls, X):
         X = X.copy()
 
         # Unpack IP flags
-        ip_flags = X["ip.flags"].apply(lambda x: int(x, 16)).values.astype(np.uint8)
+        ip_flags = cls._flag_values(X["ip.flags"])
         ip_flags = np.unpackbits(ip_flags.reshape((-1, 1)), axis=1, bitorder="little")[
             :, :3
         ]
 
         # Unpack TCP flags (handle -1 for missing values)
-        tcp_flags = (
-            X["tcp.flags"]
-            .apply(lambda x: int(x, 16) if x != -1 else 0)
-            .values.astype(np.uint8)
-        )
+        tcp_flags = cls._flag_values(X["tcp.flags"])
         tcp_flags = np.unpackbits(
             tcp_flags.reshape((-1, 1)), axis=1, bitorder="little"
         )[:, :9]
@@ -374,8 +599,7 @@ class DataPreprocessor:
 
     def port_to_categories(self, port):
         """Convert port number to category according to port_map."""
-        for p_range, p_name in self.port_hierarchy_map_iot:
-            if port in p_range:
-                return p_name
-
-        return ""
+        categories = self.port_categories()
+        if pd.isna(port) or not 0 <= port < len(categories["codes"]) or port % 1:
+            return ""
+        return categories["names"][categories["codes"][int(port)]]
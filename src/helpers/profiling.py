@@ -0,0 +1,244 @@
+import os
+import re
+import cProfile
+import pstats
+import importlib
+import inspect
+import threading
+import tracemalloc
+from functools import wraps
+
+from src.helpers.metrics import RUN_ID_ENV, REPORT_DIR_ENV, current_stage
+
+
+PROFILE_ENV = "GOTHAM_PROFILE"
+PROFILE_MODE_ENV = "GOTHAM_PROFILE_MODE"
+PROFILE_MODES = ["cpu", "memory"]
+
+# Classes whose methods can be profiled, by module
+PROFILED_CLASSES = {
+    "DataPreprocessor": "src.helpers.preprocessor",
+    "FeatureCleaner": "src.helpers.feature_cleaner",
+    "Labeller": "src.helpers.labeller",
+    "PCAPReader": "src.helpers.feature_extractor",
+}
+
+# Only one cProfile profiler can be active at a time
+_local = threading.local()
+
+
+class MethodProfiler:
+    def __init__(self, target, modes=("cpu",), top=25):
+        """
+        Profile the calls of a method with cProfile and/or tracemalloc.
+
+        Calls are grouped by the stage and unit (file or device) measured by the run
+        report when they happen. The cumulated cProfile statistics of every group are
+        saved as a .prof file and its top allocation sites as a text file, both updated
+        after every call so the results survive a crash or an interrupted run.
+
+        Parameters:
+            target (str): Profiled method, as "Class.method".
+            modes (tuple): "cpu" for cProfile, "memory" for tracemalloc.
+            top (int): Number of allocation sites reported.
+        """
+        self.target = target
+        self.modes = modes
+        self.top = top
+        self.profiles = {}
+        self.allocations = {}
+
+    @staticmethod
+    def output_dir():
+        """Return the profile directory of the current run."""
+        return os.path.join(
+            os.environ.get(REPORT_DIR_ENV, os.path.join("data", "reports")),
+            "profiles",
+            os.environ.get(RUN_ID_ENV, "latest"),
+        )
+
+    @staticmethod
+    def group():
+        """Return the stage and unit the current call belongs to."""
+        metrics = current_stage()
+        if metrics is None:
+            return "main"
+        if metrics.unit is None:
+            return metrics.stage
+        unit = os.path.splitext(os.path.basename(str(metrics.unit)))[0]
+        return f"{metrics.stage}-{re.sub(r'[^A-Za-z0-9._-]', '_', unit)}"
+
+    def path(self, group, extension):
+        directory = os.path.join(self.output_dir(), self.target)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f"{group}-{os.getpid()}{extension}")
+
+    def __call__(self, function, *args, **kwargs):
+        # Calls nested in another profiled call are covered by the outer profile
+        if getattr(_local, "active", False):
+            return function(*args, **kwargs)
+
+        group = self.group()
+        _local.active = True
+        try:
+            if "memory" in self.modes:
+                return self._trace_memory(group, function, *args, **kwargs)
+            return self._profile_cpu(group, function, *args, **kwargs)
+        finally:
+            _local.active = False
+
+    def _profile_cpu(self, group, function, *args, **kwargs):
+        if "cpu" not in self.modes:
+            return function(*args, **kwargs)
+
+        profile = self.profiles.setdefault(group, cProfile.Profile())
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            profile.dump_stats(self.path(group, ".prof"))
+
+    def _trace_memory(self, group, function, *args, **kwargs):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        try:
+            return self._profile_cpu(group, function, *args, **kwargs)
+        finally:
+            peak = tracemalloc.get_traced_memory()[1]
+            after = tracemalloc.take_snapshot()
+            # Leave out the allocations of the profilers themselves
+            filters = [
+                tracemalloc.Filter(False, module.__file__)
+                for module in [cProfile, pstats, tracemalloc]
+            ]
+            filters.append(tracemalloc.Filter(False, __file__))
+            self._record_allocations(
+                group,
+                after.filter_traces(filters).compare_to(
+                    before.filter_traces(filters), "lineno"
+                ),
+                peak,
+            )
+
+    def _record_allocations(self, group, differences, peak):
+        stats = self.allocations.setdefault(group, {"calls": 0, "peak": 0, "sites": {}})
+        stats["calls"] += 1
+        stats["peak"] = max(stats["peak"], peak)
+        for difference in differences:
+            if difference.size_diff <= 0:
+                continue
+            site = str(difference.traceback)
+            size, count = stats["sites"].get(site, (0, 0))
+            stats["sites"][site] = (
+                size + difference.size_diff,
+                count + difference.count_diff,
+            )
+
+        sites = sorted(stats["sites"].items(), key=lambda item: -item[1][0])
+        with open(self.path(group, ".allocations.txt"), "w") as f:
+            f.write(
+                f"{self.target} ({group}): {stats['calls']} calls, "
+                f"peak traced memory {stats['peak'] / 2**20:.1f} MiB\n"
+                f"Top {self.top} allocation sites (memory still held after the calls):\n"
+            )
+            for site, (size, count) in sites[: self.top]:
+                f.write(f"{size / 2**20:>10.2f} MiB {count:>10} blocks  {site}\n")
+
+
+def resolve_target(target):
+    """
+    Resolve a profiling target to its class and method name.
+
+    Parameters:
+        target (str): "Class.method", or a method name looked up in PROFILED_CLASSES.
+
+    Returns:
+        tuple: The class and the method name.
+    """
+    if "." in target:
+        class_name, method = target.split(".", 1)
+        candidates = [class_name]
+    else:
+        method = target
+        candidates = list(PROFILED_CLASSES)
+
+    for class_name in candidates:
+        if class_name not in PROFILED_CLASSES:
+            break
+        cls = getattr(importlib.import_module(PROFILED_CLASSES[class_name]), class_name)
+        if hasattr(cls, method):
+            return cls, method
+    raise ValueError(
+        f"Unknown profiling target '{target}', expected a method of "
+        f"{', '.join(PROFILED_CLASSES)}."
+    )
+
+
+def enable_profiling(targets, modes=("cpu",)):
+    """
+    Wrap the given methods with a MethodProfiler.
+
+    Nothing is wrapped unless this function is called, so profiling has no cost when it
+    is switched off.
+
+    Parameters:
+        targets (list): Methods to profile, e.g. ["extract_protocols_and_ports",
+            "Labeller.label_malicious_traffic_by_ip"].
+        modes (tuple): "cpu" for cProfile, "memory" for tracemalloc.
+
+    Returns:
+        list: The profiled targets, as "Class.method".
+    """
+    unknown = set(modes) - set(PROFILE_MODES)
+    if unknown:
+        raise ValueError(f"Unknown profiling modes {sorted(unknown)}.")
+
+    enabled = []
+    for target in targets:
+        cls, method = resolve_target(target)
+        name = f"{cls.__name__}.{method}"
+        attribute = inspect.getattr_static(cls, method)
+        if getattr(attribute, "__profiled__", False) or name in enabled:
+            continue
+
+        wrapper = _profiled(
+            getattr(attribute, "__func__", attribute), MethodProfiler(name, modes)
+        )
+        if isinstance(attribute, (staticmethod, classmethod)):
+            wrapper = type(attribute)(wrapper)
+            wrapper.__profiled__ = True
+        setattr(cls, method, wrapper)
+        enabled.append(name)
+    return enabled
+
+
+def _profiled(function, profiler):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        return profiler(function, *args, **kwargs)
+
+    wrapper.__profiled__ = True
+    return wrapper
+
+
+def enable_profiling_from_env():
+    """
+    Enable profiling when the GOTHAM_PROFILE environment variable lists targets.
+
+    GOTHAM_PROFILE is a comma-separated list of methods, and GOTHAM_PROFILE_MODE a
+    comma-separated list of modes ("cpu" by default). Both are inherited by the stage
+    scripts of run_pipeline and by the parallel workers, which enable profiling when
+    the helpers are imported.
+
+    Returns:
+        list: The profiled targets.
+    """
+    targets = [t.strip() for t in os.environ.get(PROFILE_ENV, "").split(",")]
+    targets = [t for t in targets if t]
+    if not targets:
+        return []
+
+    modes = os.environ.get(PROFILE_MODE_ENV, "cpu").split(",")
+    return enable_profiling(targets, tuple(m.strip() for m in modes if m.strip()))
@@ -0,0 +1,162 @@
+import os
+import json
+import zlib
+import numpy as np
+import pandas as pd
+
+from src.helpers.checkpoint import atomic_output
+
+
+SAMPLE_MODES = ["reservoir", "cap"]
+
+# Suffix of the files recording the counts of a sampler
+COUNTS_SUFFIX = ".sampling.json"
+
+
+class LabelSampler:
+    def __init__(self, size, mode="reservoir", seed=42, name="", label="label"):
+        """
+        Samples at most size packets of every label of a capture in one streaming pass.
+
+        In "cap" mode the first size packets of every label are kept. In "reservoir" mode
+        every packet draws a random key and the size packets with the smallest keys of
+        every label are kept, which is a uniform sample of the label; the keys are drawn
+        from a generator seeded with the seed and the name of the capture, so the sample
+        does not depend on how the capture is split into chunks. The kept packets are
+        returned in their original order, and the number of packets seen and kept per
+        label is recorded, e.g. to weight the classes by seen / kept.
+
+        Parameters:
+            size (int): Maximum number of packets kept per label.
+            mode (str): Either "reservoir" or "cap".
+            seed (int): Seed of the reservoir sampling.
+            name (str): Name of the capture, e.g. its filename, mixed into the seed.
+            label (str): Column of the labels.
+        """
+        if mode not in SAMPLE_MODES:
+            raise ValueError(f"Unknown sample mode '{mode}', expected {SAMPLE_MODES}.")
+        if size < 1:
+            raise ValueError("The sample size must be at least 1.")
+
+        self.size = size
+        self.mode = mode
+        self.seed = seed
+        self.name = name
+        self.label = label
+        self.seen = {}
+        self.rng = np.random.default_rng([seed, zlib.crc32(name.encode())])
+
+        self._kept = []  # Kept chunks, concatenated in reservoir mode
+        self._offset = 0  # Position of the next packet in the capture
+
+    def update(self, df):
+        """
+        Feed the next chunk of labelled packets.
+
+        Parameters:
+            df (pd.DataFrame): Chunk of labelled packets.
+        """
+        for label, count in df[self.label].value_counts(sort=False).items():
+            self.seen[label] = self.seen.get(label, 0) + int(count)
+
+        df = df.assign(_order=np.arange(self._offset, self._offset + len(df)))
+        self._offset += len(df)
+
+        if self.mode == "cap":
+            kept = self.kept()
+            already = df[self.label].map(kept).fillna(0).to_numpy(dtype=np.int64)
+            rank = df.groupby(self.label, sort=False).cumcount().to_numpy()
+            self._kept.append(df[already + rank < self.size])
+        else:
+            df = df.assign(_key=self.rng.random(len(df)))
+            candidates = pd.concat(self._kept + [df]) if self._kept else df
+            self._kept = [
+                candidates.sort_values("_key", kind="stable")
+                .groupby(self.label, sort=False)
+                .head(self.size)
+            ]
+
+    def kept(self):
+        """Return the number of packets kept so far per label."""
+        counts = {}
+        for chunk in self._kept:
+            for label, count in chunk[self.label].value_counts(sort=False).items():
+                counts[label] = counts.get(label, 0) + int(count)
+        return counts
+
+    def result(self):
+        """
+        Return the kept packets, in their original order.
+
+        Returns:
+            pd.DataFrame: The sampled packets.
+        """
+        if not self._kept:
+            return pd.DataFrame()
+        df = pd.concat(self._kept).sort_values("_order")
+        return df.drop(columns=["_order", "_key"], errors="ignore").reset_index(
+            drop=True
+        )
+
+    def sample(self, df):
+        """Sample a whole capture at once."""
+        self.update(df)
+        return self.result()
+
+    def counts(self, device=None):
+        """
+        Return the configuration of the sampler and its counts per label.
+
+        Parameters:
+            device (str): IoT device of the capture, recorded with the counts.
+        """
+        kept = self.kept()
+        return {
+            "device": device,
+            "name": self.name,
+            "mode": self.mode,
+            "size": self.size,
+            "seed": self.seed,
+            "labels": {
+                str(label): {"seen": seen, "kept": kept.get(label, 0)}
+                for label, seen in sorted(self.seen.items())
+            },
+        }
+
+    def save_counts(self, path, device=None):
+        """Write the counts to a JSON file."""
+        with atomic_output(path) as tmp_path:
+            with open(tmp_path, "w") as f:
+                json.dump(self.counts(device), f, indent=4)
+
+
+def counts_path(output_file):
+    """Return the path of the counts of a sampled output file."""
+    return os.path.splitext(output_file)[0] + COUNTS_SUFFIX
+
+
+def load_sampling_counts(root):
+    """
+    Sum the counts recorded by the samplers under a directory per device and label.
+
+    Parameters:
+        root (str): Directory searched recursively, e.g. data/labelled.
+
+    Returns:
+        pd.DataFrame: device, label, seen and kept columns, with the weight (seen /
+            kept) that restores the original distribution of the labels.
+    """
+    records = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if not filename.endswith(COUNTS_SUFFIX):
+                continue
+            with open(os.path.join(dirpath, filename), "r") as f:
+                counts = json.load(f)
+            for label, c in counts["labels"].items():
+                records.append((counts["device"], label, c["seen"], c["kept"]))
+
+    df = pd.DataFrame(records, columns=["device", "label", "seen", "kept"])
+    df = df.groupby(["device", "label"], as_index=False)[["seen", "kept"]].sum()
+    df["weight"] = df["seen"] / df["kept"].where(df["kept"] > 0)
+    return df
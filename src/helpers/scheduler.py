@@ -0,0 +1,81 @@
+import os
+import psutil
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+
+class MemoryAwareScheduler:
+    def __init__(
+        self,
+        max_workers=None,
+        memory_budget=None,
+        memory_factor=10.0,
+        size_of=os.path.getsize,
+    ):
+        """
+        Runs one job per input in a process pool while keeping the estimated memory of
+        the running jobs under a budget.
+
+        The memory of a job is estimated ahead of time from the size of its input data, so
+        large inputs are started first and small ones fill the remaining budget. An input
+        whose estimate exceeds the whole budget still runs, but on its own.
+
+        Parameters:
+            max_workers (int): Maximum number of worker processes (default is the CPU count).
+            memory_budget (int): Memory budget in bytes (default is 80% of the available memory).
+            memory_factor (float): Estimated bytes of memory per byte of input data.
+            size_of (callable): Returns the size in bytes of an input (default is the file size).
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.memory_budget = memory_budget or int(
+            psutil.virtual_memory().available * 0.8
+        )
+        self.memory_factor = memory_factor
+        self.size_of = size_of
+
+    def estimate(self, item):
+        """Estimate the peak memory in bytes needed to process the given input."""
+        return int(self.size_of(item) * self.memory_factor)
+
+    def map(self, fn, items, *args):
+        """
+        Apply fn(item, *args) to every item and return the results in the order of items.
+
+        With a single worker the jobs run serially in the current process, which gives
+        the same results as the pool since every job is independent of the others.
+
+        Parameters:
+            fn (callable): Picklable function taking an input as first argument.
+            items (list): Inputs, e.g. file paths or IoT device names.
+            *args: Extra arguments passed to every call.
+
+        Returns:
+            list: Results of fn, in the same order as items.
+        """
+        if self.max_workers == 1 or len(items) <= 1:
+            return [fn(item, *args) for item in items]
+
+        estimates = {item: self.estimate(item) for item in items}
+        pending = sorted(items, key=lambda item: estimates[item], reverse=True)
+        results = {}
+        running = {}
+        in_flight = 0
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                # Start the largest jobs that fit into the remaining budget
+                for item in list(pending):
+                    if len(running) >= self.max_workers:
+                        break
+                    if running and in_flight + estimates[item] > self.memory_budget:
+                        continue
+                    running[executor.submit(fn, item, *args)] = item
+                    in_flight += estimates[item]
+                    pending.remove(item)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = running.pop(future)
+                    in_flight -= estimates[item]
+                    results[item] = future.result()
+
+        return [results[item] for item in items]
@@ -0,0 +1,310 @@
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+
+from src.helpers.utils import load_json_file
+
+
+# Kind of the fields extracted without being configured (see extraction_fields); the
+# kind of the configured fields is the "type" of their entry in the feature
+# configuration
+EXTRA_FIELD_KINDS = {"frame.number": "uint32"}
+
+# dtype given to pd.read_csv for the kinds read as text; ipv4, hex and time columns
+# are converted after parsing
+READ_DTYPES = {
+    "ipv4": "category",
+    "hex8": "category",
+    "hex16": "category",
+    "time": "object",
+    "category": "category",
+    "text": "object",
+}
+
+# Nullable dtype of the integer kinds, cast after parsing: pd.read_csv is several times
+# slower when it parses to nullable dtypes itself
+INTEGER_DTYPES = {
+    "port": "UInt16",
+    "uint8": "UInt8",
+    "uint16": "UInt16",
+    "uint32": "UInt32",
+    "int8": "Int8",
+}
+
+# Hex digits written back for the hex kinds, as printed by tshark
+HEX_WIDTHS = {"hex8": 2, "hex16": 4}
+HEX_DTYPES = {"hex8": "UInt8", "hex16": "UInt16"}
+
+# Every kind a field can have
+KINDS = sorted(set(READ_DTYPES) | set(INTEGER_DTYPES))
+
+# Format of the whole seconds of frame.time once the double spaces are removed
+SECONDS_FORMAT = "%b %d, %Y %H:%M:%S"
+
+
+def _map_categories(series, convert, dtype):
+    """Convert a categorical column through its (few) distinct values."""
+    values = np.array([convert(c) for c in series.cat.categories] + [0])
+    codes = series.cat.codes.to_numpy()
+    result = pd.array(values[codes], dtype=dtype)  # Code -1 picks the trailing 0
+    result[codes < 0] = pd.NA
+    return pd.Series(result, index=series.index)
+
+
+def _to_nullable(series, dtype):
+    """Cast a parsed integer or float column to a nullable integer dtype."""
+    dtype = pd.api.types.pandas_dtype(dtype)
+    if isinstance(series.dtype, pd.api.extensions.ExtensionDtype):
+        return series.astype(dtype)
+    values = series.to_numpy()
+    mask = np.isnan(values) if values.dtype.kind == "f" else np.zeros(len(values), bool)
+    values = np.where(mask, 0, values).astype(dtype.numpy_dtype)
+    return pd.Series(dtype.construct_array_type()(values, mask), index=series.index)
+
+
+def ipv4_to_int(address):
+    """Return the integer value of a dotted IPv4 address."""
+    a, b, c, d = (int(part) for part in address.split("."))
+    if not all(0 <= part <= 255 for part in (a, b, c, d)):
+        raise ValueError(f"Invalid IPv4 address '{address}'.")
+    return (a << 24) | (b << 16) | (c << 8) | d
+
+
+def int_to_ipv4(value):
+    """Return the dotted form of an integer IPv4 address."""
+    value = int(value)
+    return f"{value >> 24 & 255}.{value >> 16 & 255}.{value >> 8 & 255}.{value & 255}"
+
+
+def parse_time(series):
+    """
+    Parse tshark's frame.time to microseconds, ignoring the time zone like the original
+    conversion.
+
+    The whole seconds are parsed once per distinct value and the fraction is added as
+    an integer, which is much faster than parsing every timestamp with a format.
+    """
+    dots = series.str.find(".").to_numpy()
+    dot = dots[0] if len(dots) else 0
+    if (dots == dot).all():
+        # tshark pads the day to two characters, so the fraction starts at a fixed offset
+        seconds = series.str.slice(0, dot)
+        fraction = series.str.slice(dot + 1, dot + 7)
+    else:
+        parts = series.str.partition(".")
+        seconds, fraction = parts[0], parts[2].str.slice(0, 6)
+
+    codes, uniques = pd.factorize(seconds)
+    uniques = pd.Series(uniques, dtype=object).str.replace("  ", " ")
+    parsed = pd.to_datetime(uniques, format=SECONDS_FORMAT).to_numpy()
+    micros = fraction.astype(np.int64).to_numpy()
+    return pd.Series(
+        parsed[codes] + micros.astype("timedelta64[us]"), index=series.index
+    )
+
+
+def format_time(series):
+    """Format datetimes as tshark's frame.time, without the time zone."""
+    seconds = series.dt.floor("s")
+    codes, uniques = pd.factorize(seconds)
+    text = pd.Index(uniques).strftime(SECONDS_FORMAT).to_numpy(dtype=object)
+    micros = (series - seconds).dt.microseconds.map("{:06d}000".format)
+    return pd.Series(text[codes], index=series.index) + "." + micros
+
+
+def _distinct_text(series, convert):
+    """Format a column through its distinct values, keeping missing values empty."""
+    codes, uniques = pd.factorize(series)
+    text = np.array([convert(u) for u in uniques] + [np.nan], dtype=object)
+    return pd.Series(text[codes], index=series.index)
+
+
+def ipv4_equals(series, address):
+    """
+    Compare an IPv4 column, typed or text, with a dotted address.
+
+    Returns:
+        pd.Series: Boolean mask, False for missing addresses.
+    """
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return series.eq(ipv4_to_int(address)).fillna(False).astype(bool)
+    return series == address
+
+
+def ipv4_match(series, pattern):
+    """
+    Match an IPv4 column, typed or text, with a regular expression on the dotted form.
+
+    The typed column is matched through its distinct addresses, so the semantics of
+    Series.str.match are kept at the cost of a handful of regular expressions.
+
+    Returns:
+        pd.Series: Boolean mask, False for missing addresses.
+    """
+    if pd.api.types.is_integer_dtype(series.dtype):
+        addresses = series.dropna().unique()
+        text = pd.Series([int_to_ipv4(a) for a in addresses], dtype=object)
+        matching = addresses[text.str.match(pattern).to_numpy(dtype=bool)]
+        return series.isin(matching).fillna(False).astype(bool)
+    return series.str.match(pattern)
+
+
+def fill_integers(series, value):
+    """
+    Fill the missing values of a column, widening a nullable integer column to the
+    smallest signed integer dtype holding both its values and the fill value.
+
+    Returns:
+        pd.Series: The filled column, with a plain numpy dtype for integer columns.
+    """
+    if not isinstance(series.dtype, pd.api.extensions.ExtensionDtype):
+        return series.fillna(value)
+    if not pd.api.types.is_integer_dtype(series.dtype):
+        return series.fillna(value)
+
+    numpy_dtype = series.dtype.numpy_dtype
+    if series.isna().any():
+        numpy_dtype = np.result_type(numpy_dtype, np.min_scalar_type(value))
+        nullable = {"i": "Int", "u": "UInt", "f": "Float"}[numpy_dtype.kind]
+        series = series.astype(f"{nullable}{numpy_dtype.itemsize * 8}").fillna(value)
+    return series.to_numpy(dtype=numpy_dtype)
+
+
+class PacketSchema:
+    def __init__(self, kinds):
+        """
+        Compact in-memory types of the extracted packet fields.
+
+        IPv4 addresses are held as uint32, ports as nullable uint16, flags and
+        checksums as nullable uint8/uint16 parsed from their hex text, frame.time as
+        datetime64 and repeated strings such as frame.protocols as categoricals, which
+        takes six to seven times less memory than the object and float columns
+        pd.read_csv produces.
+        The files on disk keep tshark's text format: to_text converts a typed frame
+        back before writing.
+
+        Parameters:
+            kinds (dict): Kind of every field (see KINDS).
+        """
+        unknown = {field: kind for field, kind in kinds.items() if kind not in KINDS}
+        if unknown:
+            raise ValueError(f"Unknown field kinds {unknown}, expected one of {KINDS}.")
+        self.kinds = dict(kinds)
+
+    @classmethod
+    def from_features(cls, features, kinds):
+        """
+        Build the schema of a list of extracted fields.
+
+        Parameters:
+            features (list): Fields extracted by tshark.
+            kinds (dict): Kind of every configured field (see field_kinds).
+
+        Returns:
+            PacketSchema: The schema of the extracted fields.
+        """
+        kinds = {**EXTRA_FIELD_KINDS, **kinds}
+        missing = [field for field in features if field not in kinds]
+        if missing:
+            raise ValueError(f"No kind for the extracted fields {missing}.")
+        return cls({field: kinds[field] for field in features})
+
+    def read_dtypes(self):
+        """Return the dtype argument of pd.read_csv for the extracted fields."""
+        return {
+            field: READ_DTYPES[kind]
+            for field, kind in self.kinds.items()
+            if kind in READ_DTYPES
+        }
+
+    def read_csv_kwargs(self, sep="\t"):
+        """Return the arguments of pd.read_csv reading an extracted or labelled file."""
+        return {"sep": sep, "dtype": self.read_dtypes(), "low_memory": False}
+
+    def apply(self, df):
+        """
+        Convert the columns read with read_dtypes to their compact types.
+
+        Parameters:
+            df (pd.DataFrame): Frame read with read_csv_kwargs.
+
+        Returns:
+            pd.DataFrame: The frame with compact columns.
+        """
+        for field, kind in self.kinds.items():
+            if field not in df.columns:
+                continue  # Not extracted (field projection)
+            if kind == "ipv4":
+                df[field] = _map_categories(df[field], ipv4_to_int, "UInt32")
+            elif kind in HEX_DTYPES:
+                df[field] = _map_categories(
+                    df[field], lambda x: int(x, 16), HEX_DTYPES[kind]
+                )
+            elif kind in INTEGER_DTYPES:
+                df[field] = _to_nullable(df[field], INTEGER_DTYPES[kind])
+            elif kind == "time" and df[field].dtype == object:
+                df[field] = parse_time(df[field])
+        return df
+
+    def to_text(self, df):
+        """
+        Convert the compact columns of a frame back to tshark's text format.
+
+        Parameters:
+            df (pd.DataFrame): Frame with compact columns.
+
+        Returns:
+            pd.DataFrame: A copy of the frame ready to be written with to_csv.
+        """
+        df = df.copy()
+        for field, kind in self.kinds.items():
+            if field not in df.columns:
+                continue
+            if kind == "ipv4" and pd.api.types.is_integer_dtype(df[field].dtype):
+                df[field] = _distinct_text(df[field], int_to_ipv4)
+            elif kind in HEX_WIDTHS and pd.api.types.is_integer_dtype(df[field].dtype):
+                width = HEX_WIDTHS[kind]
+                df[field] = _distinct_text(df[field], lambda x: f"0x{int(x):0{width}x}")
+            elif kind == "time" and pd.api.types.is_datetime64_dtype(df[field].dtype):
+                df[field] = format_time(df[field])
+        return df
+
+
+@lru_cache(maxsize=None)
+def field_kinds(features_path):
+    """
+    Load the kind of every field of a feature configuration, given by the "type" of
+    its entry.
+
+    Parameters:
+        features_path (str): Path of protocol_fields_output.json.
+
+    Returns:
+        dict: Kind of every configured field.
+
+    Raises:
+        ValueError: If a field has no type, rather than reading it as text.
+    """
+    kinds = {}
+    for feature in load_json_file(features_path)["features"]:
+        if "type" not in feature:
+            raise ValueError(
+                f"The field {feature['field']} of {features_path} has no type, "
+                f"expected one of {KINDS}."
+            )
+        kinds[feature["field"]] = feature["type"]
+    return kinds
+
+
+@lru_cache(maxsize=None)
+def load_schema(features_path):
+    """
+    Load the schema of the fields of a feature configuration.
+
+    Parameters:
+        features_path (str): Path of protocol_fields_output.json.
+
+    Returns:
+        PacketSchema: The schema of the configured fields.
+    """
+    return PacketSchema(field_kinds(features_path))
@@ -0,0 +1,229 @@
+import os
+import json
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from src.helpers.checkpoint import atomic_output
+
+
+class Stage:
+    def __init__(self, name, command, inputs=(), outputs=(), code=(), config=None):
+        """
+        Declares a pipeline stage with the data it reads and writes.
+
+        Parameters:
+            name (str): Unique stage name, e.g. "label:mirai-dos".
+            command (list): Command line run for the stage.
+            inputs (list): Files or directories read by the stage.
+            outputs (list): Files or directories written by the stage.
+            code (list): Source files that make up the stage's code version.
+            config (dict): Configuration values that change the stage's outputs.
+        """
+        self.name = name
+        self.command = list(command)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.code = list(code)
+        self.config = config or {}
+
+
+class StageRunner:
+    STATUS_SKIPPED = "up-to-date"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_BLOCKED = "blocked"
+
+    def __init__(
+        self, stages, state_path, cwd=".", max_workers=None, content_hash_limit=2**20
+    ):
+        """
+        Runs a DAG of stages, skipping the ones whose fingerprint has not changed.
+
+        A stage depends on every stage that writes one of its inputs. Its fingerprint
+        hashes its inputs, code and config, and is stored in a state file once the stage
+        succeeds. Stages whose dependencies are all finished run concurrently.
+
+        Parameters:
+            stages (list): Stages of the pipeline.
+            state_path (str): JSON file storing the fingerprint of every finished stage.
+            cwd (str): Working directory of the stage commands.
+            max_workers (int): Maximum number of stages running at once.
+            content_hash_limit (int): Files up to this size are hashed by content, larger
+                files (e.g. pcaps) by size and modification time.
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_path = state_path
+        self.cwd = cwd
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.content_hash_limit = content_hash_limit
+
+    @staticmethod
+    def _contains(parent, path):
+        parent, path = os.path.abspath(parent), os.path.abspath(path)
+        return path == parent or path.startswith(parent + os.sep)
+
+    def dependencies(self):
+        """Return a mapping from each stage name to the names of the stages it depends on."""
+        deps = {name: set() for name in self.stages}
+        for name, stage in self.stages.items():
+            for other_name, other in self.stages.items():
+                if other_name == name:
+                    continue
+                if any(
+                    self._contains(output, path) or self._contains(path, output)
+                    for output in other.outputs
+                    for path in stage.inputs
+                ):
+                    deps[name].add(other_name)
+        return deps
+
+    def select(self, targets):
+        """
+        Return the names of the target stages and all of their upstream stages.
+
+        A target matches a stage by its full name or by the part before ":", so "label"
+        selects every "label:<event>" stage.
+        """
+        deps = self.dependencies()
+        selected = set()
+        stack = [
+            name
+            for name in self.stages
+            if not targets or name in targets or name.split(":")[0] in targets
+        ]
+        if targets and not stack:
+            raise ValueError(f"No stage matches {targets}.")
+
+        while stack:
+            name = stack.pop()
+            if name not in selected:
+                selected.add(name)
+                stack.extend(deps[name])
+        return selected
+
+    def _file_digest(self, path):
+        stat = os.stat(path)
+        if stat.st_size > self.content_hash_limit:
+            return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def _path_digests(self, path):
+        if os.path.isfile(path):
+            return [(path, self._file_digest(path))]
+        if not os.path.isdir(path):
+            return [(path, "missing")]
+
+        digests = []
+        for root, _, files in os.walk(path):
+            for file in files:
+                file_path = os.path.join(root, file)
+                if self._contains(file_path, self.state_path):
+                    continue
+                digests.append((file_path, self._file_digest(file_path)))
+        return digests
+
+    def fingerprint(self, stage):
+        """Hash the inputs, code, config and command of a stage."""
+        sha = hashlib.sha256()
+        sha.update(json.dumps(stage.command).encode())
+        sha.update(json.dumps(stage.config, sort_keys=True, default=str).encode())
+        for paths in (stage.code, stage.inputs):
+            for path in sorted(paths):
+                for file_path, digest in sorted(self._path_digests(path)):
+                    sha.update(f"{os.path.relpath(file_path)}={digest};".encode())
+        return sha.hexdigest()
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path, "r") as f:
+            return json.load(f)
+
+    def _save_state(self, state):
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        with atomic_output(self.state_path) as tmp_path:
+            with open(tmp_path, "w") as f:
+                json.dump(state, f, indent=4, sort_keys=True)
+
+    def _run_stage(self, stage):
+        print(f"[{stage.name}] {' '.join(stage.command)}")
+        return subprocess.run(stage.command, cwd=self.cwd).returncode
+
+    def run(self, targets=None, force=False, dry_run=False):
+        """
+        Run the selected stages in dependency order.
+
+        Parameters:
+            targets (list): Stage names or prefixes to run (default is every stage).
+            force (bool): Run the stages even when they are up to date.
+            dry_run (bool): Only report which stages would run.
+
+        Returns:
+            dict: Status of every selected stage.
+        """
+        deps = self.dependencies()
+        selected = self.select(targets)
+        state = self._load_state()
+        status = {}
+        running = {}
+        fingerprints = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(status) < len(selected):
+                n_finished = len(status)
+                for name in sorted(selected):
+                    if name in status or name in running.values():
+                        continue
+                    upstream = deps[name] & selected
+                    if any(
+                        status.get(dep) in (self.STATUS_FAILED, self.STATUS_BLOCKED)
+                        for dep in upstream
+                    ):
+                        status[name] = self.STATUS_BLOCKED
+                        print(f"[{name}] blocked by a failed upstream stage")
+                        continue
+                    if not all(dep in status for dep in upstream):
+                        continue
+
+                    stage = self.stages[name]
+                    fingerprint = self.fingerprint(stage)
+                    up_to_date = state.get(name) == fingerprint and all(
+                        os.path.exists(output) for output in stage.outputs
+                    )
+                    # In a dry run the upstream stages did not actually rewrite their outputs
+                    upstream_pending = dry_run and any(
+                        status.get(dep) == self.STATUS_DONE for dep in upstream
+                    )
+                    if up_to_date and not force and not upstream_pending:
+                        status[name] = self.STATUS_SKIPPED
+                        print(f"[{name}] up to date")
+                    elif dry_run:
+                        status[name] = self.STATUS_DONE
+                        print(f"[{name}] would run")
+                    else:
+                        fingerprints[name] = fingerprint
+                        running[executor.submit(self._run_stage, stage)] = name
+
+                if not running:
+                    if len(status) == n_finished:
+                        raise ValueError("The stages contain a dependency cycle.")
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.result() == 0:
+                        status[name] = self.STATUS_DONE
+                        state[name] = fingerprints[name]
+                        self._save_state(state)
+                    else:
+                        status[name] = self.STATUS_FAILED
+                        print(f"[{name}] failed with exit code {future.result()}")
+
+        return status
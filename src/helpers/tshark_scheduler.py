@@ -0,0 +1,225 @@
+import os
+import time
+import signal
+import asyncio
+import subprocess
+from contextlib import nullcontext
+
+from src.helpers.checkpoint import atomic_output
+
+
+class TsharkResult:
+    def __init__(self, pcap_path, output_file):
+        """
+        Outcome of the extraction of a pcap file.
+
+        Parameters:
+            pcap_path (str): Path of the pcap file.
+            output_file (str): Path of the tab-separated output file.
+        """
+        self.pcap_path = pcap_path
+        self.output_file = output_file
+        self.status = "pending"  # ok, error or timeout
+        self.returncode = None
+        self.stderr = ""
+        self.rows = 0
+        self.bytes_written = 0
+        self.wall_time = None
+
+    @property
+    def ok(self):
+        return self.status == "ok"
+
+    def to_dict(self):
+        return {
+            "pcap_path": self.pcap_path,
+            "output_file": self.output_file,
+            "status": self.status,
+            "returncode": self.returncode,
+            "stderr": self.stderr,
+            "rows": self.rows,
+            "bytes_written": self.bytes_written,
+            "wall_time_s": self.wall_time,
+        }
+
+
+class TsharkScheduler:
+    def __init__(
+        self,
+        max_concurrency=4,
+        timeout=None,
+        queue_size=16,
+        block_size=2**16,
+        stderr_limit=2**13,
+        report=None,
+        stage="extract",
+    ):
+        """
+        Runs many tshark extractions at once from an asyncio event loop.
+
+        At most max_concurrency tshark processes run at the same time. The stdout of
+        every process is read in blocks into a bounded queue, and written to the output
+        file by a consumer: when the writes fall behind, the queue fills up, the reader
+        stops draining the pipe and tshark blocks on its own output, so a slow consumer
+        throttles its producer instead of buffering its output in memory. The exit code
+        and the end of the stderr of every process are recorded, and a process running
+        longer than the timeout is killed without holding up the rest of the batch.
+
+        Parameters:
+            max_concurrency (int): Maximum number of tshark processes running at once.
+            timeout (float): Seconds after which a tshark process is killed (default is
+                no timeout).
+            queue_size (int): Maximum number of blocks buffered per process.
+            block_size (int): Size in bytes of the blocks read from stdout.
+            stderr_limit (int): Number of trailing bytes of stderr kept per process.
+            report (RunReport): Run report every file is recorded in, if any.
+            stage (str): Stage name of the report records.
+        """
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1.")
+
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.queue_size = queue_size
+        self.block_size = block_size
+        self.stderr_limit = stderr_limit
+        self.report = report
+        self.stage = stage
+
+    def run(self, jobs, on_result=None):
+        """
+        Extract a batch of pcap files.
+
+        Parameters:
+            jobs (list): (PCAPReader, output_file) pairs.
+            on_result (callable): Called with the TsharkResult of every job as soon as
+                it finishes, e.g. to checkpoint it.
+
+        Returns:
+            list: TsharkResult of every job, in the order of jobs.
+        """
+        return asyncio.run(self.run_async(jobs, on_result))
+
+    async def run_async(self, jobs, on_result=None):
+        """Coroutine version of run, for callers that already run an event loop."""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        return await asyncio.gather(
+            *(
+                self._run_job(semaphore, reader, output, on_result)
+                for reader, output in jobs
+            )
+        )
+
+    async def _run_job(self, semaphore, reader, output_file, on_result):
+        result = TsharkResult(reader.pcap_path, output_file)
+        async with semaphore:
+            measure = (
+                self.report.stage(self.stage, reader.pcap_path)
+                if self.report
+                else nullcontext()
+            )
+            start = time.perf_counter()
+            try:
+                with measure as metrics:
+                    try:
+                        await asyncio.wait_for(
+                            self._extract(reader, result), self.timeout
+                        )
+                        result.status = "ok"
+                    except asyncio.TimeoutError:
+                        result.status = "timeout"
+                        result.stderr += f"\nKilled after {self.timeout}s"
+                        raise
+                    except (OSError, subprocess.CalledProcessError):
+                        result.status = "error"
+                        raise
+                    finally:
+                        if metrics is not None:
+                            metrics.read(reader.pcap_path)
+                            metrics.rows_out = result.rows
+                            metrics.bytes_written = result.bytes_written
+                            metrics.details.update(
+                                tshark_status=result.status,
+                                returncode=result.returncode,
+                                stderr=result.stderr,
+                            )
+            except (asyncio.TimeoutError, OSError, subprocess.CalledProcessError):
+                pass  # Recorded in the result, the rest of the batch goes on
+            result.wall_time = round(time.perf_counter() - start, 4)
+
+        if on_result is not None:
+            on_result(result)
+        return result
+
+    async def _extract(self, reader, result):
+        tshark_command = reader.tshark_command()
+        process = await asyncio.create_subprocess_exec(
+            *tshark_command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            # Own process group, so a kill also reaches the children of tshark
+            start_new_session=os.name == "posix",
+        )
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        tasks = [
+            asyncio.ensure_future(self._produce(process.stdout, queue)),
+            asyncio.ensure_future(self._read_stderr(process.stderr, result)),
+        ]
+        try:
+            with atomic_output(result.output_file) as tmp_file:
+                with open(tmp_file, "wb") as out:
+                    await self._consume(queue, out, result)
+                await asyncio.gather(*tasks)
+                result.returncode = await process.wait()
+                if result.returncode != 0:
+                    # The partial output is discarded with the temporary file
+                    raise subprocess.CalledProcessError(
+                        result.returncode, tshark_command, stderr=result.stderr
+                    )
+        finally:
+            # Cancelled (timeout) or failed: do not leave the process behind
+            if process.returncode is None:
+                self._kill(process)
+                result.returncode = await process.wait()
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    def _kill(process):
+        try:
+            if os.name == "posix":
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except ProcessLookupError:
+            pass  # Exited meanwhile
+
+    async def _produce(self, stream, queue):
+        while True:
+            block = await stream.read(self.block_size)
+            # Waits while the queue is full, which stops draining tshark's stdout
+            await queue.put(block)
+            if not block:
+                return
+
+    async def _consume(self, queue, out, result):
+        loop = asyncio.get_running_loop()
+        newlines = 0
+        while True:
+            block = await queue.get()
+            if not block:
+                break
+            # Write from a thread, so a slow disk does not stall the other processes
+            await loop.run_in_executor(None, out.write, block)
+            newlines += block.count(b"\n")
+            result.bytes_written += len(block)
+        result.rows = max(0, newlines - 1)  # Without the header line
+
+    async def _read_stderr(self, stream, result):
+        stderr = b""
+        while True:
+            block = await stream.read(self.block_size)
+            if not block:
+                break
+            stderr = (stderr + block)[-self.stderr_limit :]
+        result.stderr = stderr.decode(errors="replace")
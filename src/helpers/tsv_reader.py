@@ -0,0 +1,406 @@
+import io
+import os
+import importlib.util
+
+import numpy as np
+import pandas as pd
+
+from src.helpers.schema import INTEGER_DTYPES
+
+
+# Parsing engine of the readers, inherited by the stage scripts: "pyarrow" parses
+# blocks of the file on every core, "pandas" uses pandas' single-threaded C parser
+# and "auto" picks pyarrow when it is installed
+TSV_ENGINE_ENV = "GOTHAM_TSV_ENGINE"
+TSV_ENGINES = ["auto", "pandas", "pyarrow"]
+
+# Bytes of a file parsed per block (and per thread) by pyarrow
+ARROW_BLOCK_SIZE = 4 * 2**20
+
+# Smallest block of a file read in chunks, which is otherwise sized to the rows asked
+MIN_STREAM_BLOCK_SIZE = 64 * 2**10
+
+# Blocks parsed in parallel by pyarrow
+ARROW_THREADS = os.cpu_count() or 1
+
+# Text pd.read_csv reads as missing values (its default na_values)
+NA_VALUES = [
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+]
+
+# Text pd.read_csv reads as booleans
+TRUE_VALUES = ["True", "TRUE", "true"]
+FALSE_VALUES = ["False", "FALSE", "false"]
+
+
+def tsv_engine(engine=None):
+    """
+    Resolve the parsing engine of the readers.
+
+    Parameters:
+        engine (str): One of TSV_ENGINES (default is GOTHAM_TSV_ENGINE, else "auto").
+
+    Returns:
+        str: "pandas" or "pyarrow".
+    """
+    engine = engine or os.environ.get(TSV_ENGINE_ENV) or "auto"
+    if engine not in TSV_ENGINES:
+        raise ValueError(
+            f"Unknown TSV engine '{engine}', expected one of {TSV_ENGINES}."
+        )
+
+    installed = importlib.util.find_spec("pyarrow") is not None
+    if engine == "auto":
+        return "pyarrow" if installed else "pandas"
+    if engine == "pyarrow" and not installed:
+        raise ImportError("The pyarrow TSV engine requires pyarrow.")
+    return engine
+
+
+def _pandas_kwargs(schema, sep):
+    """Return the arguments of pd.read_csv, as used by the stages."""
+    if schema is None:
+        return {"sep": sep, "low_memory": False}
+    return schema.read_csv_kwargs(sep)
+
+
+def _header(source, sep):
+    """Return the column names of a path or seekable binary buffer."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            line = f.readline()
+    else:
+        position = source.tell()
+        line = source.readline()
+        source.seek(position)
+    return line.decode().rstrip("\r\n").split(sep) if line.strip() else []
+
+
+def _arrow_options(schema, columns, sep):
+    """
+    Return the pyarrow read, parse and convert options parsing like pd.read_csv with
+    the read dtypes of a schema: the same missing values, categories as dictionaries
+    and the integer kinds as int64. The other columns are read as text, which
+    _infer_text converts like pandas.
+    """
+    import pyarrow as pa
+    from pyarrow import csv
+
+    read_dtypes = schema.read_dtypes()
+    types = {}
+    for column in columns:
+        if read_dtypes.get(column) == "category":
+            types[column] = pa.dictionary(pa.int32(), pa.string())
+        elif schema.kinds.get(column) in INTEGER_DTYPES:
+            types[column] = pa.int64()
+        else:
+            types[column] = pa.string()
+
+    return (
+        csv.ReadOptions(use_threads=True, block_size=ARROW_BLOCK_SIZE),
+        csv.ParseOptions(delimiter=sep),
+        csv.ConvertOptions(
+            column_types=types,
+            null_values=NA_VALUES,
+            strings_can_be_null=True,
+            true_values=TRUE_VALUES,
+            false_values=FALSE_VALUES,
+        ),
+    )
+
+
+def _infer_text(column):
+    """
+    Convert a text column without a read dtype like pd.read_csv: to integers, floats
+    or booleans when every value parses, else text; an empty column is float.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if column.null_count == len(column):
+        return pa.nulls(len(column), pa.float64()) if len(column) else column
+    if pc.any(pc.match_substring_regex(column, r"^[+-]?0[xX]")).as_py():
+        return column  # pyarrow parses hex integers, pandas does not
+
+    for dtype in (pa.int64(), pa.float64()):
+        try:
+            return pc.cast(column, dtype)
+        except pa.ArrowInvalid:
+            pass
+    if pc.all(pc.is_in(column.drop_null(), pa.array(TRUE_VALUES + FALSE_VALUES))):
+        return pc.if_else(
+            pc.is_valid(column),
+            pc.is_in(column, pa.array(TRUE_VALUES)),
+            pa.scalar(None, pa.bool_()),
+        )
+    return column
+
+
+def _sorted_categories(series):
+    """Keep the categories of a column that are used, sorted like pd.read_csv's."""
+    codes = series.cat.codes.to_numpy()
+    categories = series.cat.categories
+    used = np.bincount(codes[codes >= 0], minlength=len(categories)) > 0
+    order = np.argsort(categories[used].to_numpy(dtype=object))
+
+    # Old code -> new code, with -1 (missing) kept at the end
+    mapping = np.full(len(categories) + 1, -1, dtype=np.int32)
+    mapping[np.flatnonzero(used)[order]] = np.arange(len(order), dtype=np.int32)
+    return pd.Series(
+        pd.Categorical.from_codes(
+            mapping[codes], categories[used][order], validate=False
+        ),
+        index=series.index,
+    )
+
+
+def _to_pandas(table, schema):
+    """
+    Convert an Arrow table to the frame pd.read_csv returns for the same text: missing
+    text as NaN rather than None, and categories sorted and limited to the values
+    present.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    read_dtypes = schema.read_dtypes()
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_string(column.type) and name not in read_dtypes:
+            column = _infer_text(column)
+        columns.append(column)
+    table = pa.table(columns, names=table.column_names)
+
+    df = table.to_pandas()
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_dictionary(column.type):
+            df[name] = _sorted_categories(df[name])
+        elif not len(df):
+            df[name] = df[name].astype(object)  # Nothing to infer a type from
+        elif df[name].dtype == object and column.null_count:
+            values = df[name].to_numpy()
+            values[pc.is_null(column).to_numpy(zero_copy_only=False)] = np.nan
+            df[name] = values
+    return df
+
+
+def _empty_data(error):
+    """Raise the error of pd.read_csv for an empty file, else the pyarrow error."""
+    if "Empty CSV file" in str(error):
+        raise pd.errors.EmptyDataError("No columns to parse from file") from error
+    raise error
+
+
+def read_tsv(source, schema=None, sep="\t", engine=None):
+    """
+    Read a whole tab-separated file, like pd.read_csv with the read dtypes of a schema.
+
+    The frames are the same with both engines, so a stage can switch engine without
+    any other change; the typed columns are then converted with schema.apply. Without
+    a schema, or a buffer pyarrow cannot read, pandas parses the file.
+
+    Parameters:
+        source: Path, or binary buffer, of the file.
+        schema (PacketSchema): Read dtypes of the packet fields (default is
+            pd.read_csv's types).
+        sep (str): Field separator.
+        engine (str): One of TSV_ENGINES (default is GOTHAM_TSV_ENGINE, else "auto").
+
+    Returns:
+        pd.DataFrame: The rows of the file.
+    """
+    if (
+        tsv_engine(engine) == "pandas"
+        or schema is None
+        or not isinstance(source, (str, os.PathLike, io.BytesIO))
+    ):
+        return pd.read_csv(source, **_pandas_kwargs(schema, sep))
+
+    import pyarrow as pa
+    from pyarrow import csv
+
+    position = None if isinstance(source, (str, os.PathLike)) else source.tell()
+    try:
+        options = _arrow_options(schema, _header(source, sep), sep)
+        table = csv.read_csv(source, *options)
+    except pa.ArrowInvalid as error:
+        if "CSV conversion error" not in str(error):
+            _empty_data(error)
+        # A typed column holds text pandas reads otherwise
+        if position is not None:
+            source.seek(position)
+        return pd.read_csv(source, **_pandas_kwargs(schema, sep))
+    return _to_pandas(table, schema)
+
+
+class _ArrowChunks:
+    def __init__(self, path, schema, sep):
+        """
+        Chunks of the rows of a file parsed by pyarrow, with the interface of the
+        iterator returned by pd.read_csv(..., iterator=True).
+
+        The file is parsed one block of whole lines at a time, sized to the rows asked
+        from the bytes per row seen so far (up to one pyarrow block per core), so the
+        memory held follows the chunk size (pyarrow's streaming reader reads ahead over
+        the whole file). When a typed
+        column holds text pandas reads otherwise, the rest of the file is read by
+        pandas.
+
+        Parameters:
+            path (str): Path of the file.
+            schema (PacketSchema): Read dtypes of the packet fields.
+            sep (str): Field separator.
+        """
+        self.path = path
+        self.schema = schema
+        self.sep = sep
+        self.rows = 0  # Rows returned so far
+        self.started = False  # Like pandas, a file without rows gives an empty chunk
+        self.tables = []  # Rows parsed ahead
+        self.fallback = None
+
+        self.file = open(path, "rb")
+        self.header = self.file.readline()
+        if not self.header.strip():
+            self.file.close()
+            raise pd.errors.EmptyDataError("No columns to parse from file")
+        self.options = _arrow_options(
+            schema, self.header.decode().rstrip("\r\n").split(sep), sep
+        )
+        self.bytes_read = self.rows_read = 0  # To size the blocks
+
+    def _read_block(self, rows):
+        """
+        Parse the next block of lines of the file, about rows long, or return None at
+        its end. The block is split into one pyarrow block per core, so the chunks are
+        parsed in parallel like a whole file.
+        """
+        from pyarrow import csv
+
+        size = ARROW_BLOCK_SIZE
+        if self.rows_read:
+            size = rows * self.bytes_read // self.rows_read
+        data = self.file.read(
+            min(max(size, MIN_STREAM_BLOCK_SIZE), ARROW_THREADS * ARROW_BLOCK_SIZE)
+        )
+        if not data:
+            return None
+        data += self.file.readline()  # Up to the end of the last line
+
+        block_size = -(-len(data) // ARROW_THREADS)
+        read_options = csv.ReadOptions(
+            use_threads=True,
+            block_size=min(max(block_size, MIN_STREAM_BLOCK_SIZE), ARROW_BLOCK_SIZE),
+        )
+        table = csv.read_csv(
+            io.BytesIO(self.header + data), read_options, *self.options[1:]
+        )
+        self.bytes_read += len(data)
+        self.rows_read += len(table)
+        return table
+
+    def _fall_back(self):
+        """Read the rows not returned yet with pandas."""
+        self.file.close()
+        self.tables = []
+        self.fallback = pd.read_csv(
+            self.path, iterator=True, **_pandas_kwargs(self.schema, self.sep)
+        )
+        skip = self.rows
+        while skip:
+            skip -= len(self.fallback.get_chunk(min(skip, 2**20)))
+
+    def get_chunk(self, size):
+        """
+        Return the next chunk of at most size rows.
+
+        Raises:
+            StopIteration: All the rows were returned.
+        """
+        import pyarrow as pa
+        from pyarrow import csv
+
+        if self.fallback is None:
+            buffered = sum(len(table) for table in self.tables)
+            try:
+                while buffered < size:
+                    table = self._read_block(size - buffered)
+                    if table is None:
+                        break
+                    self.tables.append(table)
+                    buffered += len(table)
+            except pa.ArrowInvalid:
+                self._fall_back()
+            if self.fallback is None and not buffered and self.started:
+                raise StopIteration
+
+        if self.fallback is not None:
+            chunk = self.fallback.get_chunk(size)
+            self.rows += len(chunk)
+            return chunk
+
+        if self.tables:
+            table = pa.concat_tables(self.tables)
+        else:  # A file without rows
+            table = csv.read_csv(io.BytesIO(self.header), *self.options)
+        self.tables = [table.slice(size)] if len(table) > size else []
+        chunk = _to_pandas(table.slice(0, size), self.schema)
+        chunk.index = pd.RangeIndex(self.rows, self.rows + len(chunk))
+        self.rows += len(chunk)
+        self.started = True
+        return chunk
+
+    def close(self):
+        self.file.close()
+        if self.fallback is not None:
+            self.fallback.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_tsv(source, schema=None, sep="\t", engine=None):
+    """
+    Open a tab-separated file to read it in chunks, like pd.read_csv(..., iterator=True)
+    with the read dtypes of a schema.
+
+    Parameters:
+        source: Path or buffer of the file; buffers, such as tshark's output, and
+            files without a schema are read by pandas.
+        schema (PacketSchema): Read dtypes of the packet fields (default is
+            pd.read_csv's types).
+        sep (str): Field separator.
+        engine (str): One of TSV_ENGINES (default is GOTHAM_TSV_ENGINE, else "auto").
+
+    Returns:
+        A context manager whose get_chunk(size) returns the next chunk of at most size
+        rows and raises StopIteration at the end of the file.
+    """
+    if (
+        tsv_engine(engine) == "pandas"
+        or schema is None
+        or not isinstance(source, (str, os.PathLike))
+    ):
+        return pd.read_csv(source, iterator=True, **_pandas_kwargs(schema, sep))
+    return _ArrowChunks(source, schema, sep)
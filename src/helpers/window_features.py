@@ -0,0 +1,167 @@
+import numpy as np
+import pandas as pd
+
+from src.helpers.fields import WINDOW_FIELDS
+from src.helpers.schema import parse_time
+
+
+# TCP flags of a connection request: SYN without ACK
+SYN, ACK = 0x02, 0x10
+
+
+def window_columns(windows):
+    """Return the names of the features computed for the given window lengths."""
+    return [
+        f"win.{window:g}s.{feature}"
+        for window in windows
+        for feature in [
+            "pkts_per_s",
+            "bytes_per_s",
+            "dst_ips",
+            "dst_ports",
+            "syn_ratio",
+        ]
+    ]
+
+
+def _previous_occurrence(codes):
+    """Return the index of the previous packet with the same code, -1 if none."""
+    order = np.argsort(codes, kind="stable")
+    ordered = codes[order]
+    same = ordered[1:] == ordered[:-1]
+    previous = np.full(len(codes), -1, dtype=np.int64)
+    previous[order[1:][same]] = order[:-1][same]
+    previous[codes < 0] = -1  # Missing values are never counted
+    return previous
+
+
+def _window_sum(values, start):
+    """Sum values over the windows [start[i], i] of every packet i."""
+    cumsum = np.concatenate([[0], np.cumsum(values)])
+    return cumsum[1:] - cumsum[start]
+
+
+def _window_distinct(codes, start):
+    """
+    Count the distinct non-missing codes over the windows [start[i], i].
+
+    A packet k repeats a value within the window of packet i when its previous
+    occurrence p is in the window, i.e. start[i] <= p and k <= i. As start is
+    non-decreasing, this holds for the packets i in [k, last[k]], where last[k] is the
+    last packet whose window starts at or before p: the repeats of every window are
+    counted by adding these intervals to a difference array.
+    """
+    n = len(codes)
+    previous = _previous_occurrence(codes)
+    k = np.flatnonzero(previous >= 0)
+    last = np.searchsorted(start, previous[k], side="right") - 1
+    k, last = k[last >= k], last[last >= k]
+    repeats = np.cumsum(
+        np.bincount(k, minlength=n + 1) - np.bincount(last + 1, minlength=n + 1)
+    )[:n]
+    return _window_sum(codes >= 0, start) - repeats
+
+
+class WindowFeatureEngine:
+    # Extracted fields read by transform
+    REQUIRED_FIELDS = WINDOW_FIELDS
+
+    def __init__(self, windows=(1.0, 10.0)):
+        """
+        Computes host statistics over sliding time windows ending at every packet of a
+        device's capture: packets/s, bytes/s, distinct destination IPs and ports, and
+        the share of connection requests (SYN without ACK), which describe floods and
+        scans better than any single packet.
+
+        The statistics are vectorized over a chunk: the start of every window is found
+        with a binary search on the packet times, sums come from cumulative sums, and
+        distinct counts from the previous occurrence of every value. The packets of the
+        last (longest) window are carried over to the next chunk, so the features do not
+        depend on how the capture is split into chunks. Packets are assumed to be in
+        capture order; a packet older than the previous one is counted at the time of
+        the previous one.
+
+        Parameters:
+            windows (list): Window lengths in seconds.
+        """
+        if not windows or min(windows) <= 0:
+            raise ValueError("The window lengths must be positive.")
+        self.windows = sorted(float(w) for w in windows)
+        self.columns = window_columns(self.windows)
+        self.reset()
+
+    def reset(self):
+        """Forget the previous packets, e.g. before the next capture."""
+        self._tail = None
+
+    def _inputs(self, chunk):
+        """Extract the columns the statistics are computed from."""
+        time = chunk["frame.time"]
+        if not pd.api.types.is_datetime64_dtype(time.dtype):
+            time = parse_time(time)  # Text from tshark
+
+        flags = chunk["tcp.flags"]
+        if not pd.api.types.is_numeric_dtype(flags.dtype):
+            codes, uniques = pd.factorize(flags)
+            values = np.array([int(x, 16) for x in uniques] + [0], dtype=np.int64)
+            flags = pd.Series(values[codes], index=chunk.index)
+        flags = flags.fillna(0).to_numpy(dtype=np.int64)
+
+        return pd.DataFrame(
+            {
+                "time": time.to_numpy(dtype="datetime64[ns]").astype(np.int64),
+                "length": chunk["frame.len"].fillna(0).to_numpy(dtype=np.float64),
+                "dst_ip": chunk["ip.dst"].array,
+                "dst_port": chunk["tcp.dstport"]
+                .fillna(chunk["udp.dstport"])
+                .to_numpy(dtype=np.float64, na_value=np.nan),
+                "syn": ((flags & (SYN | ACK)) == SYN).astype(np.float64),
+            }
+        )
+
+    def transform(self, chunk):
+        """
+        Add the window features of the next chunk of a capture.
+
+        Parameters:
+            chunk (pd.DataFrame): Next packets of the capture, in capture order.
+
+        Returns:
+            pd.DataFrame: The chunk with one column per feature and window.
+        """
+        inputs = self._inputs(chunk)
+        if self._tail is not None:
+            inputs = pd.concat([self._tail, inputs], ignore_index=True)
+        n_tail = len(inputs) - len(chunk)
+
+        # The tail ends with the last packet, so time also increases across chunks
+        time = np.maximum.accumulate(inputs["time"].to_numpy())
+        dst_ips = pd.factorize(inputs["dst_ip"])[0]
+        dst_ports = pd.factorize(inputs["dst_port"])[0]
+        index = np.arange(len(inputs))
+
+        features = {}
+        for window in self.windows:
+            start = np.searchsorted(time, time - int(window * 1e9), side="right")
+            packets = index - start + 1
+            name = f"win.{window:g}s"
+            features[f"{name}.pkts_per_s"] = packets / window
+            features[f"{name}.bytes_per_s"] = (
+                _window_sum(inputs["length"].to_numpy(), start) / window
+            )
+            features[f"{name}.dst_ips"] = _window_distinct(dst_ips, start)
+            features[f"{name}.dst_ports"] = _window_distinct(dst_ports, start)
+            features[f"{name}.syn_ratio"] = (
+                _window_sum(inputs["syn"].to_numpy(), start) / packets
+            )
+
+        # Keep the packets the next windows may still reach
+        if len(time):
+            keep = time > time[-1] - int(self.windows[-1] * 1e9)
+            self._tail = inputs[keep].reset_index(drop=True)
+            self._tail["time"] = time[keep]
+
+        chunk = chunk.copy()
+        for column in self.columns:
+            chunk[column] = features[column][n_tail:].astype(np.float64)
+        return chunk
@@ -0,0 +1,313 @@
+import os
+import re
+import json
+import time
+import uuid
+import socket
+import threading
+
+
+class WorkQueue:
+    STATES = ["pending", "claimed", "done", "failed"]
+
+    def __init__(self, root, lease_seconds=600, max_attempts=3, worker_id=None):
+        """
+        Work queue shared by several worker processes through a directory, for instance
+        on an NFS mount.
+
+        Every unit of work is a JSON file that moves between the pending, claimed, done
+        and failed subdirectories with atomic renames, so exactly one worker wins the
+        rename that claims a unit. A claimed file is named after its claim, so only the
+        current claim can rename it to finish the unit. A worker keeps its lease alive by
+        touching the claimed file; units whose lease expired (crashed or killed workers)
+        are renamed back to pending by the next worker that looks. Lease ages are measured against the
+        modification time of a file touched in the queue, i.e. the clock of the file
+        server, so the hosts' clocks do not need to agree.
+
+        Parameters:
+            root (str): Directory of the queue.
+            lease_seconds (float): Time after which a claimed unit without heartbeat is
+                re-queued.
+            max_attempts (int): Number of claims of a unit before it is marked failed.
+            worker_id (str): Identifier of this worker (default is host:pid:random).
+        """
+        self.root = root
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or (
+            f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        )
+        for state in self.STATES + ["tmp"]:
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+
+    @staticmethod
+    def unit_key(stage, unit_id):
+        """Return the file-safe key of a unit."""
+        return f"{stage}-{re.sub(r'[^A-Za-z0-9._-]+', '_', unit_id)}"
+
+    def path(self, state, key):
+        return os.path.join(self.root, state, f"{key}.json")
+
+    def claimed_path(self, unit, suffix=".json"):
+        """Return the path of the claimed file of a unit, named after its claim."""
+        filename = f"{unit['key']}@{unit['claim']}{suffix}"
+        return os.path.join(self.root, "claimed", filename)
+
+    def state(self, key):
+        """Return the state of a unit, or None if it was never enqueued."""
+        for state in self.STATES:
+            if state == "claimed":
+                claimed = os.listdir(os.path.join(self.root, "claimed"))
+                if any(filename.startswith(f"{key}@") for filename in claimed):
+                    return state
+            elif os.path.exists(self.path(state, key)):
+                return state
+        return None
+
+    def _write(self, path, unit):
+        """Write a unit atomically (temporary file, then rename)."""
+        tmp_path = os.path.join(self.root, "tmp", f"{uuid.uuid4().hex}.json")
+        with open(tmp_path, "w") as f:
+            json.dump(unit, f)
+        os.replace(tmp_path, path)
+
+    def _read(self, path):
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def enqueue(self, stage, unit_id, args=None, after=()):
+        """
+        Add a unit of work unless it is already queued, running or done.
+
+        Parameters:
+            stage (str): Stage of the unit, selecting the handler that runs it.
+            unit_id (str): Identifier of the unit within its stage (a file or device).
+            args (dict): JSON-serialisable arguments of the handler.
+            after (list): Keys of the units that must be done before this one runs.
+
+        Returns:
+            str: The key of the unit.
+        """
+        key = self.unit_key(stage, unit_id)
+        if self.state(key) in ["pending", "claimed", "done"]:
+            return key
+
+        unit = {
+            "key": key,
+            "stage": stage,
+            "id": unit_id,
+            "args": args or {},
+            "after": list(after),
+            "attempts": 0,
+            "history": [],
+        }
+        self._write(self.path("pending", key), unit)
+        return key
+
+    def now(self):
+        """Return the current time of the file server."""
+        clock = os.path.join(self.root, "tmp", f"clock-{self.worker_id}")
+        with open(clock, "a"):
+            pass
+        os.utime(clock, None)
+        return os.path.getmtime(clock)
+
+    def requeue_expired(self):
+        """
+        Move the claimed units whose lease expired back to pending.
+
+        Returns:
+            list: Keys of the re-queued units.
+        """
+        now = self.now()
+        requeued = []
+        for filename in sorted(os.listdir(os.path.join(self.root, "claimed"))):
+            path = os.path.join(self.root, "claimed", filename)
+            key = filename.split("@")[0]
+            try:
+                if now - os.path.getmtime(path) < self.lease_seconds:
+                    continue
+                # Only one worker wins the rename of an expired unit
+                os.rename(path, self.path("pending", key))
+            except FileNotFoundError:
+                continue  # Completed or re-queued by another worker meanwhile
+            requeued.append(key)
+        return requeued
+
+    def ready(self, unit):
+        """Return True if all the units a unit depends on are done."""
+        return all(os.path.exists(self.path("done", key)) for key in unit["after"])
+
+    def claim(self):
+        """
+        Claim the first pending unit whose dependencies are done.
+
+        Returns:
+            dict: The claimed unit, or None if no unit can run now.
+        """
+        for filename in sorted(os.listdir(os.path.join(self.root, "pending"))):
+            key = filename[: -len(".json")]
+            try:
+                unit = self._read(self.path("pending", key))
+                if any(os.path.exists(self.path("failed", k)) for k in unit["after"]):
+                    os.rename(self.path("pending", key), self.path("failed", key))
+                    unit["history"].append({"error": "A dependency failed"})
+                    self._write(self.path("failed", key), unit)
+                    continue
+                if not self.ready(unit):
+                    continue
+                # Start the lease before the rename, which keeps the modification time
+                os.utime(self.path("pending", key), None)
+                unit["claim"] = uuid.uuid4().hex
+                os.rename(self.path("pending", key), self.claimed_path(unit))
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue  # Claimed by another worker first
+
+            # Read the file renamed, which may have been rewritten since it was read
+            unit = {**self._read(self.claimed_path(unit)), "claim": unit["claim"]}
+            unit["attempts"] += 1
+            unit["history"].append({"worker": self.worker_id, "claimed": time.time()})
+            if unit["attempts"] > self.max_attempts:
+                unit["history"][-1]["error"] = "Too many attempts"
+                self._write(self.path("failed", key), unit)
+                os.remove(self.claimed_path(unit))
+                continue
+
+            self._write(self.claimed_path(unit), unit)
+            return unit
+        return None
+
+    def heartbeat(self, unit):
+        """Renew the lease of a claimed unit."""
+        os.utime(self.claimed_path(unit), None)
+
+    def _finish(self, unit, state, **info):
+        """
+        Move a claimed unit to a state if its claim is still the current one.
+
+        The claimed file is first renamed to a name private to the finish, which only
+        succeeds for the current claim and which no other worker writes to, and is then
+        updated and moved to its state. A worker whose lease expired finds its claimed
+        file gone, whether the unit was re-queued, claimed again or finished since.
+        """
+        finishing = self.claimed_path(unit, ".finishing")
+        try:
+            # Renew the lease for the time of the finish, then take the claimed file
+            self.heartbeat(unit)
+            os.rename(self.claimed_path(unit), finishing)
+        except FileNotFoundError:
+            return False  # The lease expired and the unit was re-queued
+
+        unit["history"][-1].update(info, finished=time.time())
+        self._write(finishing, unit)
+        os.rename(finishing, self.path(state, unit["key"]))
+        return True
+
+    def complete(self, unit):
+        """
+        Mark a claimed unit as done.
+
+        Returns:
+            bool: False if the lease had expired and the unit was re-queued, in which
+            case the unit is left to its current claim.
+        """
+        return self._finish(unit, "done")
+
+    def fail(self, unit, error):
+        """
+        Re-queue a claimed unit after an error, or mark it failed after max_attempts.
+
+        Returns:
+            bool: False if the lease had expired and the unit was re-queued, in which
+            case the unit is left to its current claim.
+        """
+        state = "failed" if unit["attempts"] >= self.max_attempts else "pending"
+        return self._finish(unit, state, error=error)
+
+    def counts(self):
+        """Return the number of units in every state."""
+        return {
+            state: len(os.listdir(os.path.join(self.root, state)))
+            for state in self.STATES
+        }
+
+    def drained(self):
+        """Return True if no unit is pending or claimed."""
+        counts = self.counts()
+        return counts["pending"] == 0 and counts["claimed"] == 0
+
+
+class Lease:
+    def __init__(self, queue, unit):
+        """
+        Context manager renewing the lease of a claimed unit from a background thread
+        while it runs.
+
+        Parameters:
+            queue (WorkQueue): Queue the unit was claimed from.
+            unit (dict): The claimed unit.
+        """
+        self.queue = queue
+        self.unit = unit
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._renew, daemon=True)
+
+    def _renew(self):
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            try:
+                self.queue.heartbeat(self.unit)
+            except FileNotFoundError:
+                return  # The unit was re-queued by another worker
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_worker(queue, handlers, poll_interval=5.0, stop_when_drained=True):
+    """
+    Claim and run units until the queue is drained.
+
+    Parameters:
+        queue (WorkQueue): Queue to work on.
+        handlers (dict): Function running the units of every stage, called with the
+            unit's arguments.
+        poll_interval (float): Seconds to wait when no unit is ready.
+        stop_when_drained (bool): Return once no unit is pending or claimed, instead of
+            waiting for new units.
+
+    Returns:
+        dict: Number of units completed and failed by this worker, and of the units it
+        ran after their lease expired, which are left to their current claim.
+    """
+    stats = {"done": 0, "failed": 0, "lost": 0}
+    while True:
+        queue.requeue_expired()
+        unit = queue.claim()
+        if unit is None:
+            if stop_when_drained and queue.drained():
+                return stats
+            time.sleep(poll_interval)
+            continue
+
+        print(f"[{queue.worker_id}] {unit['key']}")
+        try:
+            with Lease(queue, unit):
+                handlers[unit["stage"]](**unit["args"])
+        except Exception as e:
+            finished = queue.fail(unit, f"{type(e).__name__}: {e}")
+            outcome = "failed"
+            print(f"[{queue.worker_id}] {unit['key']} failed: {e}")
+        else:
+            finished = queue.complete(unit)
+            outcome = "done"
+
+        if finished:
+            stats[outcome] += 1
+        else:
+            stats["lost"] += 1
+            print(f"[{queue.worker_id}] {unit['key']} lost its lease, not {outcome}")
@@ -1,20 +1,25 @@
 import os
-import re
 import gc
-import glob
+import argparse
 import pandas as pd
 
+from src.helpers.checkpoint import atomic_output
+from src.helpers.chunk_reader import DEFAULT_CHUNK_MEMORY
+from src.helpers.dataset_store import DatasetStore
 from src.helpers.feature_cleaner import FeatureCleaner
+from src.helpers.metrics import run_report
 from src import *
 
 
-def process_local_datasets(iot_devices):
+def process_local_datasets(iot_devices, store, chunk_memory=DEFAULT_CHUNK_MEMORY):
     """
     Process and clean datasets for a list of IoT devices by reading feature files,
     cleaning them, and consolidating feature information for each device.
 
     Parameters:
         iot_devices (list): A list of IoT device identifiers to process.
+        store (DatasetStore): Partitioned store of the extracted feature files.
+        chunk_memory (int): Target in-memory size of the chunks read.
 
     Returns:
         list: A list of sets representing the features for each device.
@@ -23,34 +28,22 @@ def process_local_datasets(iot_devices):
 
     # Iterate over each IoT device
     for iot_device in iot_devices:
-        # Get the list of file paths for benign and malicious data for the device
-        m_filenames = glob.glob(
-            os.path.join(
-                DATA_DIR, "extracted_features", "malicious", "*", f"{iot_device}*.csv"
-            )
-        )
-        b_filenames = glob.glob(
-            os.path.join(DATA_DIR, "extracted_features", "benign", f"{iot_device}*.csv")
-        )
+        with run_report(REPORT_DIR).stage("clean", iot_device) as metrics:
+            # Read and concatenate the chunks from all the partitions of the device
+            processed_chunks = list(store.iter_chunks(iot_device, chunk_memory))
 
-        # Read and concatenate the chunks from all the files associated with the device
-        processed_chunks = []
-        for filename in b_filenames + m_filenames:
-            # Read each file in chunks to optimize memory usage
-            for chunk in pd.read_csv(
-                filename, sep="\t", low_memory=False, chunksize=10000
-            ):
-                processed_chunks.append(chunk)
+            if processed_chunks == []:
+                continue
 
-        if processed_chunks == []:
-            continue
+            # Concatenate all the chunks into a single DataFrame
+            df = pd.concat(processed_chunks)
 
-        # Concatenate all the chunks into a single DataFrame
-        df = pd.concat(processed_chunks)
+            # Perform local cleaning (e.g., handling missing values, transforming features, etc.)
+            feature_cleaner = FeatureCleaner()
+            df_cleaned = feature_cleaner.clean_features(df)
 
-        # Perform local cleaning (e.g., handling missing values, transforming features, etc.)
-        feature_cleaner = FeatureCleaner()
-        df_cleaned = feature_cleaner.clean_features(df)
+            metrics.rows_in, metrics.rows_out = len(df), len(df_cleaned)
+            metrics.bytes_read = store.device_size(iot_device)
 
         # Track the columns (features) in the cleaned data for this IoT device
         feature_info.append(set(df_cleaned.columns))
@@ -113,20 +106,34 @@ def save_cleaned_data(cleaned_data, output_dir):
 
     # Save each device's cleaned data as a CSV file
     for device, df in cleaned_data.items():
-        df.to_csv(os.path.join(output_dir, f"{device}_cleaned.csv"), index=False)
+        with atomic_output(os.path.join(output_dir, f"{device}_cleaned.csv")) as path:
+            df.to_csv(path, index=False)
+
+
+def main(argv=None):
+    """Clean the extracted features of every device."""
+    parser = argparse.ArgumentParser(description="Clean the extracted features.")
+    parser.add_argument(
+        "--chunk-memory-mb",
+        type=float,
+        default=DEFAULT_CHUNK_MEMORY / 2**20,
+        help="Target in-memory size of the chunks read from the extracted files.",
+    )
+    args = parser.parse_args(argv)
 
+    # Index the extracted feature partitions of every device
+    store = DatasetStore.build(os.path.join(DATA_DIR, "extracted_features"))
+    iot_devices = store.devices()
 
-if __name__ == "__main__":
-    # Define paths to local datasets
-    benign_filenames = os.path.join(DATA_DIR, "extracted_features", "benign", "*.csv")
-    iot_devices = list(
-        set(
-            [re.search(r"([a-zA-Z\-]+)-([0-9]+)", f).group(0) for f in benign_filenames]
+    with run_report(REPORT_DIR).stage("clean"):
+        # Step 1: Process each device's dataset locally
+        feature_info = process_local_datasets(
+            iot_devices, store, int(args.chunk_memory_mb * 2**20)
         )
-    )
 
-    # Step 1: Process each device's dataset locally
-    feature_info = process_local_datasets(iot_devices)
+        # Step 2: Consolidate features across all devices
+        m_global_features = federated_feature_consolidation(feature_info)
+
 
-    # Step 2: Consolidate features across all devices
-    m_global_features = federated_feature_consolidation(feature_info)
+if __name__ == "__main__":
+    main()
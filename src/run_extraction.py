@@ -1,12 +1,135 @@
 import os
 import re
+import argparse
 
+from src.helpers.checkpoint import CheckpointJournal, atomic_output
 from src.helpers.feature_extractor import PCAPReader
+from src.helpers.fields import PROJECTED_FIELDS
+from src.helpers.metrics import run_report
+from src.helpers.tshark_scheduler import TsharkScheduler
 from src.helpers.utils import load_json_file
 from src import *
 
 
-def process_pcap_directory(input_dir, output_dir, features, is_malicious=False):
+FIELD_MODES = ["projected", "full"]
+
+# Field numbering the packets of a capture, which PcapIndex looks packets up by
+FRAME_NUMBER = "frame.number"
+
+
+def extraction_fields(features, mode="projected", frame_numbers=False):
+    """
+    Return the fields to extract with tshark.
+
+    In projected mode only the fields read by the labelling, preprocessing and flow
+    stages (PROJECTED_FIELDS) are extracted, in the order of the feature configuration;
+    full mode extracts every configured field.
+
+    Parameters:
+        features (list): Fields of the feature configuration.
+        mode (str): "projected" or "full".
+        frame_numbers (bool): Also extract the frame number of every packet, first, so
+            every row can be traced back to its packet in the capture.
+
+    Returns:
+        list: The fields to extract.
+    """
+    if mode not in FIELD_MODES:
+        raise ValueError(f"Unknown field mode '{mode}', expected one of {FIELD_MODES}.")
+    if frame_numbers and FRAME_NUMBER not in features:
+        return [FRAME_NUMBER] + extraction_fields(features, mode)
+    if mode == "full":
+        return features
+
+    required = set(PROJECTED_FIELDS)
+    missing = required.difference(features)
+    if missing:
+        raise ValueError(
+            f"The feature configuration lacks the fields {sorted(missing)}."
+        )
+    required.add(FRAME_NUMBER)  # When configured
+    return [feature for feature in features if feature in required]
+
+
+def pcap_reader(pcap_file, features):
+    """
+    Build the reader of a pcap file, filtered on the IP address of its device.
+
+    Parameters:
+        pcap_file (str): Path of the pcap file, named after the device.
+        features (list): Fields extracted by tshark.
+
+    Returns:
+        PCAPReader: The reader of the pcap file.
+    """
+    file = os.path.basename(pcap_file)
+    benign_metadata_path = os.path.join(METADATA_DIR, "metadata-benign.json")
+    benign_metadata = load_json_file(benign_metadata_path)
+
+    match = re.match(r"([a-zA-Z\-]+)-([0-9]+)", file)
+    device_name, device_number_str = match.group(1), match.group(2)
+    device_number = int(device_number_str) - 1
+    device_info = benign_metadata.get(device_name, [])
+    print(device_name)
+    print(device_info)
+    device_ip_address = device_info.get("device_ip", [])[device_number]
+
+    filters = f"ip.addr == {device_ip_address}"
+
+    return PCAPReader(
+        pcap_path=pcap_file,
+        feature_vector=features,
+        tool=None,
+        tshark_path="tshark",
+        zeek_path=None,
+        filters=filters,
+    )
+
+
+def extract_pcap_file(pcap_file, output_file, features):
+    """
+    Extract the features of the traffic of the device a pcap file was captured on.
+
+    Parameters:
+        pcap_file (str): Path of the pcap file, named after the device.
+        output_file (str): Path of the tab-separated output file.
+        features (list): Fields extracted by tshark.
+    """
+    pcapreader = pcap_reader(pcap_file, features)
+    with run_report(REPORT_DIR).stage("extract", pcap_file) as metrics:
+        with atomic_output(output_file) as tmp_file:
+            pcapreader.to_csv(tmp_file)
+
+        metrics.read(pcap_file)
+        metrics.wrote(output_file)
+        with open(output_file, "r") as f:
+            metrics.rows_out = max(0, sum(1 for _ in f) - 1)
+
+
+def process_pcap_directory(
+    input_dir, output_dir, features, is_malicious=False, journal=None, scheduler=None
+):
+    """
+    Extract the features of every pcap file of a directory tree.
+
+    The files are extracted concurrently by the scheduler. A file whose extraction
+    failed or timed out is not written; the others are kept, and an error listing the
+    failed files is raised once the batch is over.
+
+    Parameters:
+        input_dir (str): Directory of the pcap files of an event.
+        output_dir (str): Directory of the extracted feature files.
+        features (list): Fields extracted by tshark.
+        is_malicious (bool): Whether the pcap files are in per-attack subfolders.
+        journal (CheckpointJournal): Journal of the files already extracted, which are
+            skipped.
+        scheduler (TsharkScheduler): Scheduler running tshark (default is one process
+            at a time).
+    """
+    if scheduler is None:
+        scheduler = TsharkScheduler(max_concurrency=1, report=run_report(REPORT_DIR))
+
+    jobs = []
     for root, _, files in os.walk(input_dir):
         for file in files:
             if file.endswith(".pcap"):
@@ -28,62 +151,115 @@ def process_pcap_directory(input_dir, output_dir, features, is_malicious=False):
                 # Set output file path in the correct subdirectory
                 output_file = os.path.join(output_subdir, file.replace(".pcap", ".csv"))
 
-                benign_metadata_path = os.path.join(
-                    METADATA_DIR, "metadata-benign.json"
-                )
-                benign_metadata = load_json_file(benign_metadata_path)
-
-                match = re.match(r"([a-zA-Z\-]+)-([0-9]+)", file)
-                device_name, device_number_str = match.group(1), match.group(2)
-                device_number = int(device_number_str) - 1
-                device_info = benign_metadata.get(device_name, [])
-                print(device_name)
-                print(device_info)
-                device_ip_address = device_info.get("device_ip", [])[device_number]
-
-                filters = f"ip.addr == {device_ip_address}"
-
-                pcapreader = PCAPReader(
-                    pcap_path=pcap_file,
-                    feature_vector=features,
-                    tool=None,
-                    tshark_path="tshark",
-                    zeek_path=None,
-                    filters=filters,
-                )
-                pcapreader.to_csv(output_file)
+                if journal and journal.is_done(pcap_file, [pcap_file]):
+                    print(f"{output_file} already extracted")
+                    continue
 
+                jobs.append((pcap_reader(pcap_file, features), output_file))
 
-if __name__ == "__main__":
-    # Input directories
-    benign_dir = os.path.join(DATA_DIR, "raw", "benign")
-    malicious_dir = os.path.join(DATA_DIR, "raw", "malicious")
+    def on_result(result):
+        if not result.ok:
+            print(
+                f"Error executing tshark on {result.pcap_path} ({result.status}, "
+                f"exit code {result.returncode}): {result.stderr.strip()}"
+            )
+            return
 
-    # Output directories
-    output_dir_benign = os.path.join(DATA_DIR, "extracted_features", "benign")
-    output_dir_malicious = os.path.join(DATA_DIR, "extracted_features", "malicious")
+        print(f"tshark parsing complete. File saved as: {result.output_file}")
+        if journal:
+            journal.record(result.pcap_path, [result.pcap_path], [result.output_file])
 
-    # Ensure output directories exist
-    os.makedirs(output_dir_benign, exist_ok=True)
-    os.makedirs(output_dir_malicious, exist_ok=True)
+    results = scheduler.run(jobs, on_result)
+    failed = [result.pcap_path for result in results if not result.ok]
+    if failed:
+        raise RuntimeError(f"tshark failed on {len(failed)} files: {failed}")
+
+
+def main(argv=None):
+    """Extract the features of the pcap files of the given events."""
+    parser = argparse.ArgumentParser(description="Extract features from pcap files.")
+    parser.add_argument("--events", nargs="+", choices=EVENTS, default=EVENTS)
+    parser.add_argument(
+        "--fields",
+        choices=FIELD_MODES,
+        default="projected",
+        help="Extract only the fields read by the labelling and preprocessing "
+        "stages, or every configured field.",
+    )
+    parser.add_argument(
+        "--frame-numbers",
+        action="store_true",
+        help="Also extract the frame number of every packet, which the labelled rows "
+        "keep, to look the packets up in the captures (see PcapIndex).",
+    )
+    parser.add_argument(
+        "--n-jobs",
+        type=int,
+        default=1,
+        help="Maximum number of tshark processes running at once.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="Seconds after which a tshark process is killed.",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Ignore the checkpoint of an interrupted run.",
+    )
+    args = parser.parse_args(argv)
 
     # Load features
-    feature_config = load_json_file("./features/protocol_fields_output.json")
+    feature_config = load_json_file(FEATURES_PATH)
     features_to_extract = feature_config["features"]
-    features = [feature["field"] for feature in features_to_extract]
-
-    # Process benign traffic
-    process_pcap_directory(
-        input_dir=benign_dir,
-        output_dir=output_dir_benign,
-        features=features,
-        is_malicious=False,
+    features = extraction_fields(
+        [feature["field"] for feature in features_to_extract],
+        args.fields,
+        args.frame_numbers,
     )
 
-    # Process malicious traffic
-    process_pcap_directory(
-        input_dir=malicious_dir,
-        output_dir=output_dir_malicious,
-        features=features,
-        is_malicious=True,
+    scheduler = TsharkScheduler(
+        max_concurrency=args.n_jobs,
+        timeout=args.timeout,
+        report=run_report(REPORT_DIR),
     )
+
+    with run_report(REPORT_DIR).stage("extract"):
+        for event in args.events:
+            if event == "benign":
+                # Benign traffic does not have subfolders
+                input_dir = os.path.join(DATA_DIR, "raw", "benign")
+                output_dir = os.path.join(DATA_DIR, "extracted_features", "benign")
+            else:
+                input_dir = os.path.join(DATA_DIR, "raw", "malicious", event)
+                output_dir = os.path.join(
+                    DATA_DIR, "extracted_features", "malicious", event
+                )
+
+            # Ensure output directory exists
+            os.makedirs(output_dir, exist_ok=True)
+
+            # Files extracted by an interrupted run of the event are skipped
+            journal = CheckpointJournal(
+                os.path.join(DATA_DIR, "checkpoints", f"extract-{event}.jsonl"),
+                config={"features": features},
+            )
+            if args.restart:
+                journal.reset()
+
+            # Process the traffic of the event
+            process_pcap_directory(
+                input_dir=input_dir,
+                output_dir=output_dir,
+                features=features,
+                is_malicious=event != "benign",
+                journal=journal,
+                scheduler=scheduler,
+            )
+            journal.finish()
+
+
+if __name__ == "__main__":
+    main()
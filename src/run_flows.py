@@ -0,0 +1,152 @@
+import os
+import argparse
+
+from src.helpers.chunk_reader import DEFAULT_CHUNK_MEMORY
+from src.helpers.dataset_store import DatasetStore
+from src.helpers.flow_table import FlowTable, flow_schema
+from src.helpers.label_index import write_indexed
+from src.helpers.metrics import run_report
+from src.helpers.schema import PacketSchema, field_kinds, load_schema
+from src.helpers.utils import load_json_file
+from src.run_extraction import extraction_fields, pcap_reader
+from src.run_labeling import build_labeller
+from src import *
+
+
+# Captures the flows are aggregated from: the extracted feature files, or the raw
+# pcap files read straight through tshark
+FLOW_SOURCES = {"extracted": ".csv", "raw": ".pcap"}
+
+
+def aggregate_capture(chunks, table, labeller, filename, output_file):
+    """
+    Aggregate the packets of a capture into labelled flows, streaming the chunks.
+
+    The flows are labelled and written as soon as they end, so only the open flows of
+    the table are held in memory. The flow file gets a sidecar index of the start times
+    and labels of the flows (see LabelIndex).
+
+    Parameters:
+        chunks (iterable): Packet chunks of the capture, in capture order.
+        table (FlowTable): Flow table, reset before the capture.
+        labeller (Labeller): Labeller of the event the capture belongs to.
+        filename (str): Name of the capture, identifying its device.
+        output_file (str): Path of the flow file.
+
+    Returns:
+        tuple: Number of packets read and of flows written.
+    """
+    n_packets = 0
+
+    def labelled_flows():
+        nonlocal n_packets
+        table.reset()
+        for chunk in chunks:
+            n_packets += len(chunk)
+            yield labeller.label_flows(filename, table.update(chunk))
+        yield labeller.label_flows(filename, table.flush())
+
+    n_flows = write_indexed(
+        labelled_flows(), output_file, flow_schema(), time_column="flow.start"
+    )
+    return n_packets, n_flows
+
+
+def main(argv=None):
+    """Aggregate the captures of the given events into labelled flows."""
+    parser = argparse.ArgumentParser(
+        description="Aggregate the captures into labelled bidirectional flows."
+    )
+    parser.add_argument("--events", nargs="+", choices=EVENTS, default=EVENTS)
+    parser.add_argument(
+        "--source",
+        choices=list(FLOW_SOURCES),
+        default="extracted",
+        help="Aggregate the extracted feature files, or read the raw captures "
+        "through tshark.",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=15.0,
+        help="Seconds without packets after which a flow ends.",
+    )
+    parser.add_argument(
+        "--active-timeout",
+        type=float,
+        default=1800.0,
+        help="Seconds after its first packet at which a flow ends.",
+    )
+    parser.add_argument(
+        "--max-flows",
+        type=int,
+        default=None,
+        help="Maximum number of open flows per capture; the least recently active "
+        "ones are ended early beyond it (default is no limit).",
+    )
+    parser.add_argument(
+        "--chunk-memory-mb",
+        type=float,
+        default=DEFAULT_CHUNK_MEMORY / 2**20,
+        help="Target in-memory size of the packet chunks.",
+    )
+    args = parser.parse_args(argv)
+
+    extension = FLOW_SOURCES[args.source]
+    source_dir = os.path.join(
+        DATA_DIR, "raw" if args.source == "raw" else "extracted_features"
+    )
+    chunk_memory = int(args.chunk_memory_mb * 2**20)
+    if args.source == "raw":
+        features = extraction_fields(
+            [f["field"] for f in load_json_file(FEATURES_PATH)["features"]], "projected"
+        )
+        schema = PacketSchema.from_features(features, field_kinds(FEATURES_PATH))
+    else:
+        schema = load_schema(FEATURES_PATH)
+
+    benign_metadata_path = os.path.join(METADATA_DIR, "metadata-benign.json")
+    labellers = {}
+    table = FlowTable(args.idle_timeout, args.active_timeout, args.max_flows)
+    store = DatasetStore.build(source_dir, extension=extension)
+
+    with run_report(REPORT_DIR).stage("flows"):
+        for partition in store.partitions:
+            event = partition["event"]
+            if event not in args.events:
+                continue
+            if event not in labellers:
+                labellers[event] = build_labeller(
+                    benign_metadata_path,
+                    (
+                        None
+                        if event == "benign"
+                        else os.path.join(METADATA_DIR, f"metadata-{event}.json")
+                    ),
+                )
+
+            path = os.path.join(store.root, partition["path"])
+            filename = os.path.basename(path).replace(extension, ".csv")
+            output_file = os.path.join(
+                DATA_DIR, "flows", partition["path"].replace(extension, ".csv")
+            )
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+            if args.source == "raw":
+                chunks = pcap_reader(path, features).iter_chunks(chunk_memory, schema)
+            else:
+                chunks = DatasetStore(
+                    store.root, [partition], sep=store.sep
+                ).iter_chunks(partition["device"], chunk_memory, schema=schema)
+
+            with run_report(REPORT_DIR).stage("flows", path) as metrics:
+                metrics.rows_in, metrics.rows_out = aggregate_capture(
+                    chunks, table, labellers[event], filename, output_file
+                )
+                metrics.read(path)
+                metrics.wrote(output_file)
+            print(f"Flows saved to {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+import os
+import gc
+import argparse
+import pandas as pd
+
+from src.helpers.chunk_reader import DEFAULT_CHUNK_MEMORY
+from src.helpers.dataset_store import DatasetStore
+from src.helpers.feature_extractor import PCAPReader
+from src.helpers.labeller import Labeller
+from src.helpers.metrics import run_report
+from src.helpers.preprocessor import DataPreprocessor
+from src.helpers.sampler import LabelSampler, counts_path
+from src.helpers.scheduler import MemoryAwareScheduler
+from src.helpers.schema import PacketSchema, field_kinds
+from src.helpers.utils import load_json_file
+from src.run_extraction import FIELD_MODES, extraction_fields
+from src.run_labeling import add_sampling_arguments, sampling_options
+from src.run_preprocessing import convert_chunk, finalise_device_data
+from src import *
+from src.config import *
+
+
+def build_labellers(benign_metadata):
+    """
+    Build one Labeller per event, sharing the benign metadata.
+
+    Parameters:
+        benign_metadata (dict): Benign metadata of the IoT devices.
+
+    Returns:
+        dict: Labeller of every event.
+    """
+    labellers = {}
+    for event in EVENTS:
+        if event == "benign":
+            malicious_metadata = []
+        else:
+            malicious_metadata = load_json_file(
+                os.path.join(METADATA_DIR, f"metadata-{event}.json")
+            )
+        labellers[event] = Labeller(
+            benign_metadata=benign_metadata,
+            malicious_metadata=malicious_metadata,
+        )
+    return labellers
+
+
+def start_debug_files(debug_dir, csv_path):
+    """
+    Remove the debug files of a capture left by a previous run, so its chunks are not
+    appended to them.
+
+    Returns:
+        tuple: Paths of the extracted and labelled debug files of the capture.
+    """
+    paths = tuple(
+        os.path.join(debug_dir, stage, csv_path)
+        for stage in ["extracted_features", "labelled"]
+    )
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+    return paths
+
+
+def append_debug_chunk(chunk, path, schema):
+    """Append a chunk to a tab-separated debug file, writing the header once."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_header = not os.path.exists(path)
+    schema.to_text(chunk).to_csv(
+        path, mode="a", header=write_header, index=False, sep="\t"
+    )
+
+
+def process_device_fused(
+    iot_device,
+    store,
+    features,
+    labellers,
+    preprocessor,
+    output_dir,
+    artifact_path=None,
+    debug_dir=None,
+    chunk_memory=DEFAULT_CHUNK_MEMORY,
+    sampling=None,
+):
+    """
+    Extract, label and convert every capture of a device in a single streaming pass.
+
+    Chunks read from tshark's output go straight through the Labeller and the
+    conversion steps of the DataPreprocessor; only the converted rows are kept until
+    the device is split, scaled and saved.
+
+    Parameters:
+        iot_device (str): IoT device identifier.
+        store (DatasetStore): Partitioned store of the raw captures.
+        features (list): Fields extracted by tshark.
+        labellers (dict): Labeller of every event.
+        preprocessor (DataPreprocessor): Preprocessor providing the conversion steps.
+        output_dir (str): Directory where the processed files are written.
+        artifact_path (str): Global artifact to transform with (default is a per-device fit).
+        debug_dir (str): When set, the extracted and labelled chunks are also written
+            under this directory, mirroring the layout of the file-based pipeline.
+        chunk_memory (int): Target in-memory size of the chunks read from tshark.
+        sampling (dict): LabelSampler arguments (size, mode, seed) to sample every
+            capture with once labelled; the counts are saved under output_dir/sampling.
+    """
+    print(f"Processing {iot_device}")
+
+    schema = PacketSchema.from_features(features, field_kinds(FEATURES_PATH))
+    with run_report(REPORT_DIR).stage("fused", iot_device) as metrics:
+        processed_chunks = []
+        for partition in store.device_partitions(iot_device):
+            pcap_path = os.path.join(store.root, partition["path"])
+            filename = os.path.basename(pcap_path).replace(".pcap", ".csv")
+            labeller = labellers[partition["event"]]
+            device_ip_address, _ = labeller.device_ip_address(filename)
+
+            pcapreader = PCAPReader(
+                pcap_path=pcap_path,
+                feature_vector=features,
+                tool=None,
+                tshark_path="tshark",
+                zeek_path=None,
+                filters=f"ip.addr == {device_ip_address}",
+            )
+
+            csv_path = partition["path"].replace(".pcap", ".csv")
+            if debug_dir:
+                extracted_debug, labelled_debug = start_debug_files(debug_dir, csv_path)
+            sampler = LabelSampler(**sampling, name=filename) if sampling else None
+            window_engine = preprocessor.window_engine()  # One per capture
+            for chunk in pcapreader.iter_chunks(chunk_memory, schema=schema):
+                if debug_dir:
+                    append_debug_chunk(chunk, extracted_debug, schema)
+
+                chunk = labeller.label_data(filename, chunk)
+                if sampler is not None:
+                    sampler.update(chunk)  # Converted once the capture is sampled
+                    continue
+                if debug_dir:
+                    append_debug_chunk(chunk, labelled_debug, schema)
+
+                processed_chunks.append(
+                    convert_chunk(chunk, preprocessor, window_engine)
+                )
+
+            if sampler is not None:
+                counts_file = counts_path(
+                    os.path.join(output_dir, "sampling", csv_path)
+                )
+                os.makedirs(os.path.dirname(counts_file), exist_ok=True)
+                sampler.save_counts(counts_file, iot_device)
+
+                chunk = sampler.result()
+                if chunk.empty:
+                    continue
+                if debug_dir:
+                    append_debug_chunk(chunk, labelled_debug, schema)
+                processed_chunks.append(
+                    convert_chunk(chunk, preprocessor, window_engine)
+                )
+
+        metrics.bytes_read = store.device_size(iot_device)
+        if not processed_chunks:
+            return
+
+        df = pd.concat(processed_chunks, ignore_index=True)
+        del processed_chunks
+        metrics.rows_in = len(df)
+
+        metrics.rows_out, paths = finalise_device_data(
+            iot_device, df, output_dir, preprocessor, artifact_path
+        )
+        metrics.wrote(*paths)
+
+    del df
+    gc.collect()
+
+
+def main(argv=None):
+    """Extract, label and preprocess the raw captures in a single pass."""
+    parser = argparse.ArgumentParser(
+        description="Extract, label and preprocess the raw captures in a single pass."
+    )
+    parser.add_argument(
+        "--artifact",
+        default=None,
+        help="Global preprocessor artifact to transform with (default is a per-device fit).",
+    )
+    parser.add_argument(
+        "--debug-dir",
+        default=None,
+        help="Also write the extracted and labelled intermediates under this directory.",
+    )
+    parser.add_argument(
+        "--fields",
+        choices=FIELD_MODES,
+        default="projected",
+        help="Extract only the fields read by the labelling and preprocessing "
+        "steps, or every configured field.",
+    )
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument(
+        "--chunk-memory-mb",
+        type=float,
+        default=DEFAULT_CHUNK_MEMORY / 2**20,
+        help="Target in-memory size of the chunks read from tshark.",
+    )
+    parser.add_argument(
+        "--windows",
+        nargs="+",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="Add host statistics over sliding windows of these lengths, e.g. 1 10.",
+    )
+    add_sampling_arguments(parser)
+    args = parser.parse_args(argv)
+
+    # Load features
+    feature_config = load_json_file(FEATURES_PATH)
+    features = extraction_fields(
+        [feature["field"] for feature in feature_config["features"]], args.fields
+    )
+
+    benign_metadata = load_json_file(os.path.join(METADATA_DIR, "metadata-benign.json"))
+    labellers = build_labellers(benign_metadata)
+
+    preprocessor = DataPreprocessor(
+        port_hierarchy_map_iot=port_hierarchy_map_iot,
+        categorical_vocabularies=categorical_vocabularies,
+        global_label_values=global_label_values,
+        global_label_grouped_values=global_label_grouped_values,
+        windows=args.windows,
+    )
+
+    # Index the raw captures of every device
+    store = DatasetStore.build(os.path.join(DATA_DIR, "raw"), extension=".pcap")
+
+    output_dir = os.path.join(DATA_DIR, "final")
+    os.makedirs(output_dir, exist_ok=True)  # Ensure output directory exists
+
+    # Captures are far smaller once converted, hence the low memory factor
+    scheduler = MemoryAwareScheduler(
+        max_workers=args.n_jobs, memory_factor=2.0, size_of=store.device_size
+    )
+    with run_report(REPORT_DIR).stage("fused"):
+        scheduler.map(
+            process_device_fused,
+            store.devices(),
+            store,
+            features,
+            labellers,
+            preprocessor,
+            output_dir,
+            args.artifact,
+            args.debug_dir,
+            int(args.chunk_memory_mb * 2**20),
+            sampling_options(args),
+        )
+
+
+if __name__ == "__main__":
+    main()
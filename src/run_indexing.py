@@ -0,0 +1,64 @@
+import os
+import argparse
+
+from src.helpers.metrics import run_report
+from src.helpers.pcap_index import PcapIndex, index_path
+from src import *
+
+
+def index_pcap_directory(input_dir, force=False):
+    """
+    Index the packets of every pcap file of a directory tree that has no up-to-date
+    index, once, so they can be looked up by frame number or time range.
+
+    Parameters:
+        input_dir (str): Directory of the pcap files of an event.
+        force (bool): Index the files again even if their index is up to date.
+    """
+    for root, _, files in os.walk(input_dir):
+        for file in sorted(files):
+            if not file.endswith((".pcap", ".pcapng")):
+                continue
+            pcap_file = os.path.join(root, file)
+
+            if not force:
+                try:
+                    PcapIndex.load(pcap_file)
+                    print(f"{pcap_file} already indexed")
+                    continue
+                except (FileNotFoundError, ValueError):
+                    pass  # Not indexed yet, or changed since
+
+            with run_report(REPORT_DIR).stage("index", pcap_file) as metrics:
+                index = PcapIndex.build(pcap_file)
+                index.save()
+                metrics.rows_out = len(index)
+                metrics.read(pcap_file)
+                metrics.wrote(index_path(pcap_file))
+            print(f"Indexed {len(index)} packets of {pcap_file}")
+
+
+def main(argv=None):
+    """Index the packets of the pcap files of the given events."""
+    parser = argparse.ArgumentParser(
+        description="Index the packets of the pcap files for random access."
+    )
+    parser.add_argument("--events", nargs="+", choices=EVENTS, default=EVENTS)
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Index the files again even if their index is up to date.",
+    )
+    args = parser.parse_args(argv)
+
+    with run_report(REPORT_DIR).stage("index"):
+        for event in args.events:
+            if event == "benign":
+                input_dir = os.path.join(DATA_DIR, "raw", "benign")
+            else:
+                input_dir = os.path.join(DATA_DIR, "raw", "malicious", event)
+            index_pcap_directory(input_dir, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,53 @@
 # src/pipeline.py
 
 import os
+import json
+import hashlib
+import argparse
 import pandas as pd
 
+from src.helpers.checkpoint import CheckpointJournal, atomic_output, code_version
+from src.helpers.dataset_store import DatasetStore
+from src.helpers.label_index import write_indexed
 from src.helpers.labeller import Labeller
+from src.helpers.metrics import run_report
+from src.helpers.sampler import SAMPLE_MODES, LabelSampler, counts_path
+from src.helpers.schema import int_to_ipv4, ipv4_equals, load_schema
+from src.helpers.tsv_reader import read_tsv
 from src.helpers.utils import load_json_file
 from src import *
 
 
-def run_pipeline(
-    csv_directory,
-    output_directory,
-    benign_metadata_path,
-    malicious_metadata_path,
-    is_malicious=True,
-):
+# Suffix of the record of what a labelled file was labelled from
+LABELLING_SUFFIX = ".labelling.json"
+
+# Peers recorded per file; beyond, e.g. for spoofed floods, any peer is assumed
+MAX_PEERS = 4096
+
+# Source files of the labelling, whose changes relabel every file
+HELPERS_DIR = os.path.join(os.path.dirname(__file__), "helpers")
+LABELLING_CODE = [
+    __file__,
+    os.path.join(HELPERS_DIR, "label_index.py"),
+    os.path.join(HELPERS_DIR, "labeller.py"),
+    os.path.join(HELPERS_DIR, "sampler.py"),
+    os.path.join(HELPERS_DIR, "schema.py"),
+    os.path.join(HELPERS_DIR, "tsv_reader.py"),
+]
+
+
+def build_labeller(benign_metadata_path, malicious_metadata_path=None):
+    """
+    Build the Labeller of an event from its metadata files.
+
+    Parameters:
+        benign_metadata_path (str): Path of the benign metadata.
+        malicious_metadata_path (str): Path of the malicious metadata of the event,
+            None for the benign traffic.
+
+    Returns:
+        Labeller: The labeller of the event.
+    """
     # Load metadata for benign and malicious rules
     benign_metadata = load_json_file(benign_metadata_path)
     if malicious_metadata_path:
@@ -23,54 +56,245 @@ def run_pipeline(
         malicious_metadata = []
 
     # Initialize Labeler with metadata
-    labeller = Labeller(
+    return Labeller(
         benign_metadata=benign_metadata,
         malicious_metadata=malicious_metadata,
     )
 
+
+def add_sampling_arguments(parser):
+    """Add the options of the per-label sampling to a parser."""
+    parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=None,
+        help="Keep at most this many packets per label of every capture "
+        "(default is to keep every packet).",
+    )
+    parser.add_argument("--sample-mode", choices=SAMPLE_MODES, default="reservoir")
+    parser.add_argument("--sample-seed", type=int, default=42)
+
+
+def sampling_options(args):
+    """Return the LabelSampler arguments of parsed options, None without sampling."""
+    if args.sample_size is None:
+        return None
+    return {
+        "size": args.sample_size,
+        "mode": args.sample_mode,
+        "seed": args.sample_seed,
+    }
+
+
+def labelling_path(output_file):
+    """Return the path of the labelling record of a labelled file."""
+    return os.path.splitext(output_file)[0] + LABELLING_SUFFIX
+
+
+def traffic_space(df, device_ip_address):
+    """
+    Return the peers and IP protocols of a device's packets, which bound the rules
+    that can match them (see Labeller.rule_dependencies).
+
+    Returns:
+        tuple: Sorted peer addresses (None beyond MAX_PEERS) and protocol numbers.
+    """
+    peers = pd.concat(
+        [
+            df.loc[ipv4_equals(df["ip.src"], device_ip_address), "ip.dst"],
+            df.loc[ipv4_equals(df["ip.dst"], device_ip_address), "ip.src"],
+        ]
+    )
+    peers = peers.dropna().unique()
+    if pd.api.types.is_integer_dtype(peers.dtype):
+        peers = [int_to_ipv4(peer) for peer in peers]
+    peers = sorted(str(peer) for peer in peers) if len(peers) <= MAX_PEERS else None
+    protocols = sorted(int(proto) for proto in df["ip.proto"].dropna().unique())
+    return peers, protocols
+
+
+def labelling_record(labeller, csv_file_path, output_file, sampling, peers, protocols):
+    """
+    Describe what a labelled file depends on: its input file, the sampling, the code
+    and a digest of the metadata that can label its packets.
+    """
+    filename = os.path.basename(csv_file_path)
+    dependencies = labeller.rule_dependencies(filename, peers, protocols)
+    return {
+        "input": CheckpointJournal.signature([csv_file_path])[csv_file_path],
+        "output": CheckpointJournal.signature([output_file])[output_file],
+        "sampling": sampling,
+        "code": code_version(LABELLING_CODE),
+        "peers": peers,
+        "protocols": protocols,
+        "rules": hashlib.sha256(
+            json.dumps(dependencies, sort_keys=True).encode()
+        ).hexdigest(),
+    }
+
+
+def is_labelled(labeller, csv_file_path, output_file, sampling=None):
+    """
+    Return True if a labelled file is up to date: its input, sampling and code are the
+    same and the metadata that can label its packets did not change, so editing a rule
+    only relabels the files whose traffic it can match.
+    """
+    path = labelling_path(output_file)
+    if not os.path.exists(output_file) or not os.path.exists(path):
+        return False
+    with open(path, "r") as f:
+        record = json.load(f)
+
+    try:
+        current = labelling_record(
+            labeller,
+            csv_file_path,
+            output_file,
+            sampling,
+            record["peers"],
+            record["protocols"],
+        )
+    except (OSError, ValueError, IndexError):
+        return False  # Input gone or device no longer in the metadata
+    return current == record
+
+
+def label_csv_file(labeller, csv_file_path, output_file, sampling=None, force=False):
+    """
+    Label the packets of an extracted feature file, written with a sidecar index of
+    their times and labels (see LabelIndex).
+
+    A record of the metadata the labels depend on is saved next to the output file, and
+    the file is skipped while it is up to date (see is_labelled).
+
+    Parameters:
+        labeller (Labeller): Labeller of the event the file belongs to.
+        csv_file_path (str): Path of the extracted feature file, named after the device.
+        output_file (str): Path of the labelled output file.
+        sampling (dict): LabelSampler arguments (size, mode, seed) to sample the
+            labelled packets with; their counts are saved next to the output file.
+        force (bool): Whether to relabel the file even when it is up to date.
+
+    Returns:
+        bool: Whether the file was labelled.
+    """
+    if not force and is_labelled(labeller, csv_file_path, output_file, sampling):
+        print(f"{output_file} is up to date")
+        return False
+
+    filename = os.path.basename(csv_file_path)
+    schema = load_schema(FEATURES_PATH)
+    with run_report(REPORT_DIR).stage("label", csv_file_path) as metrics:
+        # Load packet data
+        df = schema.apply(read_tsv(csv_file_path, schema))
+
+        # Label the data
+        labeled_df = labeller.label_data(filename, df)
+        device_ip_address, _ = labeller.device_ip_address(filename)
+        peers, protocols = traffic_space(labeled_df, device_ip_address)
+
+        # Sample every label, recording the packets seen and kept
+        if sampling:
+            sampler = LabelSampler(**sampling, name=filename)
+            labeled_df = sampler.sample(labeled_df)
+            sampler.save_counts(
+                counts_path(output_file), DatasetStore.device_from_filename(filename)
+            )
+        elif os.path.exists(counts_path(output_file)):
+            os.remove(counts_path(output_file))  # Left by a sampled run
+
+        # Save labeled data with the index of its times and labels
+        write_indexed([labeled_df], output_file, schema)
+
+        # Record what the labels depend on, once the output is complete
+        record = labelling_record(
+            labeller, csv_file_path, output_file, sampling, peers, protocols
+        )
+        with atomic_output(labelling_path(output_file)) as tmp_file:
+            with open(tmp_file, "w") as f:
+                json.dump(record, f, indent=4)
+
+        metrics.rows_in, metrics.rows_out = len(df), len(labeled_df)
+        metrics.read(csv_file_path)
+        metrics.wrote(output_file)
+    print(f"Labeled data saved to {output_file}")
+    return True
+
+
+def run_pipeline(
+    csv_directory,
+    output_directory,
+    benign_metadata_path,
+    malicious_metadata_path,
+    is_malicious=True,
+    sampling=None,
+    force=False,
+):
+    labeller = build_labeller(benign_metadata_path, malicious_metadata_path)
+
     # Loop through each CSV file in the specified directory
     for filename in os.listdir(csv_directory):
         if filename.endswith(".csv"):
-            csv_file_path = os.path.join(csv_directory, filename)
+            label_csv_file(
+                labeller,
+                os.path.join(csv_directory, filename),
+                os.path.join(output_directory, filename),
+                sampling,
+                force,
+            )
 
-            # Load packet data
-            df = pd.read_csv(csv_file_path, sep="\t", low_memory=False)
 
-            # Label the data
-            labeled_df = labeller.label_data(filename, df)
+def main(argv=None):
+    """Label the extracted features of the given events."""
+    parser = argparse.ArgumentParser(description="Label the extracted features.")
+    parser.add_argument("--events", nargs="+", choices=EVENTS, default=EVENTS)
+    add_sampling_arguments(parser)
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Relabel every file, including those whose metadata did not change.",
+    )
+    args = parser.parse_args(argv)
 
-            # Save labeled data
-            output_file = os.path.join(output_directory, filename)
-            labeled_df.to_csv(output_file, index=False, sep="\t")
-            print(f"Labeled data saved to {output_file}")
+    benign_metadata_path = os.path.join(METADATA_DIR, "metadata-benign.json")
+    with run_report(REPORT_DIR).stage("label"):
+        for event in args.events:
+            if event == "benign":
+                csv_directory = os.path.join(DATA_DIR, "extracted_features", "benign")
+                output_directory = os.path.join(DATA_DIR, "labelled", "benign")
+                malicious_metadata_path = None
+                is_malicious = False
+            else:
+                csv_directory = os.path.join(
+                    DATA_DIR, "extracted_features", "malicious", event
+                )
+                output_directory = os.path.join(
+                    DATA_DIR, "labelled", "malicious", event
+                )
+                malicious_metadata_path = os.path.join(
+                    METADATA_DIR, f"metadata-{event}.json"
+                )
+                is_malicious = True
 
+            # Events without extracted captures have nothing to label
+            if not os.path.isdir(csv_directory):
+                continue
 
-# Example execution
-if __name__ == "__main__":
-    benign_metadata_path = os.path.join(METADATA_DIR, "metadata-benign.json")
-    for event in EVENTS:
-        if event == "benign":
-            csv_directory = os.path.join(DATA_DIR, "extracted_features", "benign")
-            output_directory = os.path.join(DATA_DIR, "labelled", "benign")
-            malicious_metadata_path = None
-            is_malicious = False
-        else:
-            csv_directory = os.path.join(
-                DATA_DIR, "extracted_features", "malicious", event
-            )
-            output_directory = os.path.join(DATA_DIR, "labelled", "malicious", event)
-            malicious_metadata_path = os.path.join(
-                METADATA_DIR, f"metadata-{event}.json"
+            # Ensure output directory exists
+            os.makedirs(output_directory, exist_ok=True)
+
+            # Label traffic
+            run_pipeline(
+                csv_directory=csv_directory,
+                output_directory=output_directory,
+                benign_metadata_path=benign_metadata_path,
+                malicious_metadata_path=malicious_metadata_path,
+                is_malicious=is_malicious,
+                sampling=sampling_options(args),
+                force=args.force,
             )
-            is_malicious = True
 
-        os.makedirs(output_directory, exist_ok=True)  # Ensure output directory exists
 
-        # Label traffic
-        run_pipeline(
-            csv_directory=csv_directory,
-            output_directory=output_directory,
-            benign_metadata_path=benign_metadata_path,
-            malicious_metadata_path=malicious_metadata_path,
-            is_malicious=is_malicious,
-        )
+# Example execution
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+import os
+import sys
+import argparse
+
+from src.helpers.metrics import run_report
+from src.helpers.profiling import (
+    PROFILE_ENV,
+    PROFILE_MODE_ENV,
+    PROFILE_MODES,
+    resolve_target,
+)
+from src.helpers.stage_runner import Stage, StageRunner
+from src.run_labeling import add_sampling_arguments, sampling_options
+from src import *
+from src import configure_roots
+
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def raw_dir(event):
+    if event == "benign":
+        return os.path.join(DATA_DIR, "raw", "benign")
+    return os.path.join(DATA_DIR, "raw", "malicious", event)
+
+
+def extracted_dir(event):
+    if event == "benign":
+        return os.path.join(DATA_DIR, "extracted_features", "benign")
+    return os.path.join(DATA_DIR, "extracted_features", "malicious", event)
+
+
+def labelled_dir(event):
+    if event == "benign":
+        return os.path.join(DATA_DIR, "labelled", "benign")
+    return os.path.join(DATA_DIR, "labelled", "malicious", event)
+
+
+def build_stages(
+    preprocessing_args=(), fields="projected", sampling=None, frame_numbers=False
+):
+    """
+    Declare the extract -> label -> prepare -> clean -> preprocess stages.
+
+    Extraction and labelling are declared per event, so changing the metadata of one
+    event only re-labels that event before the stages that consume every event.
+
+    Parameters:
+        preprocessing_args (list): Extra command line arguments for run_preprocessing.
+        fields (str): Fields extracted, "projected" or "full" (see run_extraction).
+        sampling (dict): LabelSampler arguments of the labelling (see run_labeling).
+        frame_numbers (bool): Extract the frame numbers of the packets (see
+            run_extraction).
+
+    Returns:
+        list: The pipeline stages.
+    """
+    python = sys.executable
+    helpers = os.path.join(SRC_DIR, "helpers")
+    common_code = [
+        os.path.join(SRC_DIR, "__init__.py"),
+        os.path.join(helpers, "utils.py"),
+    ]
+    features_path = FEATURES_PATH
+
+    sampling_args = []
+    if sampling:
+        sampling_args = [
+            "--sample-size",
+            str(sampling["size"]),
+            "--sample-mode",
+            sampling["mode"],
+            "--sample-seed",
+            str(sampling["seed"]),
+        ]
+    benign_metadata_path = os.path.join(METADATA_DIR, "metadata-benign.json")
+
+    # Unchanged without frame numbers, so existing extractions stay up to date
+    extract_config = {"fields": fields}
+    if frame_numbers:
+        extract_config["frame_numbers"] = True
+
+    stages = []
+    for event in EVENTS:
+        stages.append(
+            Stage(
+                name=f"extract:{event}",
+                command=[
+                    python,
+                    "-m",
+                    "src.run_extraction",
+                    "--events",
+                    event,
+                    "--fields",
+                    fields,
+                ]
+                + (["--frame-numbers"] if frame_numbers else []),
+                inputs=[raw_dir(event), features_path, benign_metadata_path],
+                outputs=[extracted_dir(event)],
+                code=common_code
+                + [
+                    os.path.join(SRC_DIR, "run_extraction.py"),
+                    os.path.join(helpers, "feature_extractor.py"),
+                    os.path.join(helpers, "fields.py"),
+                    os.path.join(helpers, "tshark_scheduler.py"),
+                ],
+                config=extract_config,
+            )
+        )
+
+        label_inputs = [extracted_dir(event), benign_metadata_path]
+        if event != "benign":
+            label_inputs.append(os.path.join(METADATA_DIR, f"metadata-{event}.json"))
+        stages.append(
+            Stage(
+                name=f"label:{event}",
+                command=[
+                    python,
+                    "-m",
+                    "src.run_labeling",
+                    "--events",
+                    event,
+                    *sampling_args,
+                ],
+                inputs=label_inputs,
+                outputs=[labelled_dir(event)],
+                code=common_code
+                + [
+                    os.path.join(SRC_DIR, "run_labeling.py"),
+                    os.path.join(helpers, "label_index.py"),
+                    os.path.join(helpers, "labeller.py"),
+                    os.path.join(helpers, "sampler.py"),
+                    os.path.join(helpers, "schema.py"),
+                    os.path.join(helpers, "tsv_reader.py"),
+                ],
+                config={"sampling": sampling},
+            )
+        )
+
+    index_path = os.path.join(DATA_DIR, "processed", "index.json")
+    stages += [
+        Stage(
+            name="prepare",
+            command=[python, "-m", "src.run_preparation"],
+            inputs=[os.path.join(DATA_DIR, "labelled")],
+            outputs=[index_path],
+            code=common_code
+            + [
+                os.path.join(SRC_DIR, "run_preparation.py"),
+                os.path.join(helpers, "dataset_store.py"),
+            ],
+        ),
+        Stage(
+            name="clean",
+            command=[python, "-m", "src.run_cleaning"],
+            inputs=[os.path.join(DATA_DIR, "extracted_features")],
+            code=common_code
+            + [
+                os.path.join(SRC_DIR, "run_cleaning.py"),
+                os.path.join(helpers, "feature_cleaner.py"),
+                os.path.join(helpers, "chunk_reader.py"),
+                os.path.join(helpers, "dataset_store.py"),
+                os.path.join(helpers, "tsv_reader.py"),
+            ],
+        ),
+        Stage(
+            name="preprocess",
+            command=[
+                python,
+                "-m",
+                "src.run_preprocessing",
+                "--incremental",
+                *preprocessing_args,
+            ],
+            inputs=[index_path, os.path.join(DATA_DIR, "labelled")],
+            outputs=[os.path.join(DATA_DIR, "final")],
+            code=common_code
+            + [
+                os.path.join(SRC_DIR, "config.py"),
+                os.path.join(SRC_DIR, "run_preprocessing.py"),
+                os.path.join(helpers, "artifact.py"),
+                os.path.join(helpers, "category_encoder.py"),
+                os.path.join(helpers, "chunk_reader.py"),
+                os.path.join(helpers, "dataset_store.py"),
+                os.path.join(helpers, "preprocessor.py"),
+                os.path.join(helpers, "scheduler.py"),
+                os.path.join(helpers, "schema.py"),
+                os.path.join(helpers, "tsv_reader.py"),
+                os.path.join(helpers, "window_features.py"),
+            ],
+        ),
+    ]
+    return stages
+
+
+def main(argv=None):
+    """Run the pipeline stages that are out of date."""
+    parser = argparse.ArgumentParser(
+        description="Run the pipeline stages that are out of date."
+    )
+    parser.add_argument(
+        "stages",
+        nargs="*",
+        help="Stages to run with their upstream stages, e.g. 'label' or "
+        "'label:mirai-dos' (default is every stage).",
+    )
+    parser.add_argument("--force", action="store_true", help="Ignore the cache.")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument(
+        "--profile",
+        nargs="+",
+        default=None,
+        metavar="METHOD",
+        help="Profile these methods in every stage, e.g. 'extract_protocols_and_ports' "
+        "or 'Labeller.label_malicious_traffic_by_ip'.",
+    )
+    parser.add_argument(
+        "--profile-mode", nargs="+", choices=PROFILE_MODES, default=["cpu"]
+    )
+    parser.add_argument(
+        "--fields",
+        choices=["projected", "full"],
+        default="projected",
+        help="Extract only the fields read downstream, or every configured field "
+        "(e.g. for the cleaning stage).",
+    )
+    parser.add_argument(
+        "--frame-numbers",
+        action="store_true",
+        help="Keep the frame number of every packet in the extracted and labelled "
+        "files (see PcapIndex).",
+    )
+    add_sampling_arguments(parser)
+    parser.add_argument(
+        "--preprocessing-args",
+        nargs=argparse.REMAINDER,
+        default=[],
+        help="Arguments forwarded to run_preprocessing.",
+    )
+    args = parser.parse_args(argv)
+
+    # The stage scripts inherit the roots and the run identifier, and append to the
+    # same report
+    configure_roots(DATA_DIR, METADATA_DIR, FEATURES_PATH)
+    report = run_report(REPORT_DIR)
+
+    # The stage scripts enable profiling from the environment they inherit
+    if args.profile:
+        for target in args.profile:
+            resolve_target(target)  # Fail before running any stage
+        os.environ[PROFILE_ENV] = ",".join(args.profile)
+        os.environ[PROFILE_MODE_ENV] = ",".join(args.profile_mode)
+
+    runner = StageRunner(
+        build_stages(
+            args.preprocessing_args,
+            args.fields,
+            sampling_options(args),
+            args.frame_numbers,
+        ),
+        state_path=os.path.join(DATA_DIR, ".pipeline", "state.json"),
+        max_workers=args.jobs,
+    )
+    status = runner.run(args.stages, force=args.force, dry_run=args.dry_run)
+
+    if os.path.exists(report.path):
+        for stage, totals in report.summary().items():
+            print(
+                f"{stage:<16}{totals['wall_time_s']:>10.1f} s"
+                f"{totals['rows_out']:>12} rows"
+                f"{totals['bytes_read'] / 2**20:>10.1f} MB read"
+                f"{totals['bytes_written'] / 2**20:>10.1f} MB written"
+                f"{totals['peak_rss_mb']:>10.1f} MB peak"
+            )
+        print(f"Run report: {report.path}")
+    if args.profile:
+        print(f"Profiles: {os.path.join(report.report_dir, 'profiles', report.run_id)}")
+
+    failed = [name for name, s in status.items() if s == StageRunner.STATUS_FAILED]
+    if failed:
+        sys.exit(f"Failed stages: {', '.join(sorted(failed))}")
+    print("Pipeline completed!")
+
+
+if __name__ == "__main__":
+    main()
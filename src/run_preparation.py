@@ -0,0 +1,30 @@
+import os
+import argparse
+
+from src.helpers.dataset_store import DatasetStore
+from src.helpers.metrics import run_report
+from src import *
+
+
+def main(argv=None):
+    """Index the labelled partitions of every device."""
+    parser = argparse.ArgumentParser(
+        description="Index the labelled partitions of every device."
+    )
+    parser.parse_args(argv)
+
+    # Index the labelled partitions of every IoT device once. Downstream stages stream a
+    # device's benign and malicious partitions through the index instead of reading a
+    # merged copy of them.
+    with run_report(REPORT_DIR).stage("prepare") as metrics:
+        index_path = os.path.join(DATA_DIR, "processed", DatasetStore.INDEX_FILENAME)
+        store = DatasetStore.build(os.path.join(DATA_DIR, "labelled"))
+        store.save(index_path)
+        metrics.wrote(index_path)
+
+    for iot_device in store.devices():
+        print(f"IoT Device: {iot_device} Done!")
+
+
+if __name__ == "__main__":
+    main()
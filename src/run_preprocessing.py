@@ -1,126 +1,571 @@
 import os
-import glob
+import argparse
+import functools
+import numpy as np
 import pandas as pd
 import gc
+from pandas.api.types import union_categoricals
+from sklearn.preprocessing import StandardScaler
 
+from src.helpers.artifact import PreprocessorArtifact
+from src.helpers.checkpoint import CheckpointJournal, atomic_output, code_version
+from src.helpers.chunk_reader import DEFAULT_CHUNK_MEMORY
+from src.helpers.dataset_store import DatasetStore
+from src.helpers.metrics import run_report
 from src.helpers.preprocessor import DataPreprocessor
+from src.helpers.scheduler import MemoryAwareScheduler
+from src.helpers.schema import load_schema
 from src import *
 from src.config import *
 
 
-def process_csv_files(input_dir, output_dir, preprocessor):
-    # Get list of CSV filenames
-    filenames = glob.glob(os.path.join(input_dir, "*.csv"))
+FIT_MODES = ["per-device", "global"]
 
-    for filename in filenames:
-        print(f"Processing {filename}")
+# Columns of the converted datasets holding the labels
+LABEL_COLUMNS = ["label", "label_category"]
 
-        processed_chunks = []  # List to hold processed data chunks
+# Source files of the preprocessing, whose changes reprocess every device in
+# incremental runs
+HELPERS_DIR = os.path.join(os.path.dirname(__file__), "helpers")
+PREPROCESSING_CODE = [
+    __file__,
+    os.path.join(os.path.dirname(__file__), "config.py"),
+    os.path.join(HELPERS_DIR, "artifact.py"),
+    os.path.join(HELPERS_DIR, "category_encoder.py"),
+    os.path.join(HELPERS_DIR, "chunk_reader.py"),
+    os.path.join(HELPERS_DIR, "dataset_store.py"),
+    os.path.join(HELPERS_DIR, "preprocessor.py"),
+    os.path.join(HELPERS_DIR, "schema.py"),
+    os.path.join(HELPERS_DIR, "tsv_reader.py"),
+    os.path.join(HELPERS_DIR, "window_features.py"),
+]
 
-        # Process CSV file in chunks for memory efficiency
-        for chunk in pd.read_csv(filename, sep=",", low_memory=False, chunksize=10000):
-            chunk = preprocessor.extract_protocols_and_ports(chunk)
-            chunk = preprocessor.convert_time(chunk)
-            chunk = preprocessor.convert_ports(chunk)
-            chunk = preprocessor.convert_checksums(chunk)
-            chunk = preprocessor.fill_missing_values(chunk)
-            chunk = preprocessor.rename_labels(chunk)
-            chunk = preprocessor.group_labels(chunk)
-            chunk = preprocessor.select_columns(chunk)
 
-            processed_chunks.append(chunk)
+def convert_chunk(chunk, preprocessor, window_engine=None):
+    """
+    Apply the conversion steps of the preprocessor to a chunk of labelled packets.
 
-        # Concatenate all processed chunks into a single DataFrame
-        df = pd.concat(processed_chunks, ignore_index=True)
+    Parameters:
+        chunk (pd.DataFrame): Chunk of labelled packets.
+        preprocessor (DataPreprocessor): Preprocessor providing the conversion steps.
+        window_engine (WindowFeatureEngine): Engine of the capture the chunk belongs
+            to, which adds the sliding-window features (default is none).
 
-        # Split data into training, validation, and testing sets
-        training_set, validation_set, testing_set = preprocessor.train_valid_test_split(
-            df
-        )
+    Returns:
+        pd.DataFrame: The converted chunk.
+    """
+    if window_engine is not None:
+        chunk = window_engine.transform(chunk)
+    chunk = preprocessor.extract_protocols_and_ports(chunk)
+    chunk = preprocessor.convert_time(chunk)
+    chunk = preprocessor.convert_ports(chunk)
+    chunk = preprocessor.convert_checksums(chunk)
+    chunk = preprocessor.fill_missing_values(chunk)
+    chunk = preprocessor.rename_labels(chunk)
+    chunk = preprocessor.group_labels(chunk)
+    chunk = preprocessor.select_columns(chunk)
+    return chunk
 
-        # Scale the data and split into features and labels
-        (
-            (X_train, y_train_not_grouped, y_train_grouped),
-            (X_val, y_val_not_grouped, y_val_grouped),
-            (X_test, y_test_not_grouped, y_test_grouped),
-        ) = preprocessor.scale(training_set, validation_set, testing_set)
 
-        # Extract IoT device name from filename for saving
-        iot_device = os.path.basename(filename).rstrip(".csv")
+def iter_device_chunks(
+    iot_device,
+    store,
+    preprocessor,
+    chunk_memory=DEFAULT_CHUNK_MEMORY,
+    time_order=False,
+):
+    """
+    Stream the partitions of a device in chunks and apply the conversion steps to each chunk.
 
-        # Save the processed data to pickle files for each IoT device
-        X_train.to_pickle(
-            os.path.join(output_dir, f"{iot_device}_train_features.pkl"),
-            compression="gzip",
-        )
-        y_train_not_grouped.to_pickle(
-            os.path.join(output_dir, f"{iot_device}_train_labels.pkl"),
-            compression="gzip",
-        )
-        y_train_grouped.to_pickle(
-            os.path.join(output_dir, f"{iot_device}_train_labels_grouped.pkl"),
-            compression="gzip",
-        )
+    Parameters:
+        iot_device (str): IoT device identifier.
+        store (DatasetStore): Partitioned store of the labelled files.
+        preprocessor (DataPreprocessor): Preprocessor providing the conversion steps.
+        chunk_memory (int): Target in-memory size of a chunk in bytes.
+        time_order (bool): Whether to merge the partitions into a single time-ordered
+            stream, over which the sliding windows span the captures (default is to
+            read them one after the other).
+
+    Yields:
+        pd.DataFrame: The next converted chunk of the device.
+    """
+    schema = load_schema(FEATURES_PATH)
+    window_engine = preprocessor.window_engine()
+    if time_order:
+        for chunk in store.iter_time_ordered(iot_device, chunk_memory, schema=schema):
+            yield convert_chunk(chunk, preprocessor, window_engine)
+        return
+
+    current_partition = None
+    for partition, chunk in store.iter_chunks(
+        iot_device, chunk_memory, schema=schema, with_partition=True
+    ):
+        # The sliding windows do not span captures
+        if window_engine is not None and partition is not current_partition:
+            window_engine.reset()
+            current_partition = partition
+        yield convert_chunk(chunk, preprocessor, window_engine)
+
+
+def load_device_data(
+    iot_device,
+    store,
+    preprocessor,
+    chunk_memory=DEFAULT_CHUNK_MEMORY,
+    time_order=False,
+):
+    """
+    Load the converted dataset of a device, converted chunk by chunk (see
+    iter_device_chunks).
+
+    Returns:
+        pd.DataFrame: The converted dataset of the device.
+    """
+    return pd.concat(
+        iter_device_chunks(iot_device, store, preprocessor, chunk_memory, time_order),
+        ignore_index=True,
+    )
 
-        X_val.to_pickle(
-            os.path.join(output_dir, f"{iot_device}_val_features.pkl"),
-            compression="gzip",
+
+def save_device_data(output_dir, iot_device, datasets):
+    """
+    Save the scaled training, validation and testing sets of a device to gzip pickles.
+
+    Parameters:
+        output_dir (str): Directory where the pickle files are written.
+        iot_device (str): IoT device name used as filename prefix.
+        datasets (tuple): Scaled (X, y, y_grouped) tuples for train, val and test.
+
+    Returns:
+        list: Paths of the written files.
+    """
+    paths = []
+    for split, (X, y_not_grouped, y_grouped) in zip(["train", "val", "test"], datasets):
+        for suffix, data in [
+            ("features", X),
+            ("labels", y_not_grouped),
+            ("labels_grouped", y_grouped),
+        ]:
+            path = os.path.join(output_dir, f"{iot_device}_{split}_{suffix}.pkl")
+            with atomic_output(path) as tmp_path:
+                data.to_pickle(tmp_path, compression="gzip")
+            paths.append(path)
+    return paths
+
+
+def device_statistics(
+    iot_device,
+    store,
+    preprocessor,
+    sample_size,
+    chunk_memory=DEFAULT_CHUNK_MEMORY,
+    time_order=False,
+):
+    """
+    Fit the numerical statistics of a device's training set and sample its training rows.
+
+    The device is streamed twice: once for the classes of its labels, from which the
+    training rows are drawn as by train_valid_test_split, then to fit the statistics
+    and gather the sample one chunk at a time, so only the classes of the whole device
+    are held.
+
+    Parameters:
+        iot_device (str): IoT device identifier.
+        store (DatasetStore): Partitioned store of the labelled files.
+        preprocessor (DataPreprocessor): Preprocessor providing the conversion steps.
+        sample_size (int): Maximum number of training rows to sample.
+        chunk_memory (int): Target in-memory size of a chunk in bytes.
+        time_order (bool): Whether to read the partitions in time order.
+
+    Returns:
+        tuple: The fitted StandardScaler and the sampled training rows.
+    """
+    with run_report(REPORT_DIR).stage("preprocess-fit", iot_device) as metrics:
+        chunks = functools.partial(
+            iter_device_chunks,
+            iot_device,
+            store,
+            preprocessor,
+            chunk_memory,
+            time_order,
         )
-        y_val_not_grouped.to_pickle(
-            os.path.join(output_dir, f"{iot_device}_val_labels.pkl"), compression="gzip"
+
+        # The split only depends on the labels, so the training rows and the sample
+        # are drawn from the classes of the labels of the whole device, read first
+        classes = union_categoricals(
+            [preprocessor.label_classes(chunk[LABEL_COLUMNS]) for chunk in chunks()],
+            sort_categories=True,
         )
-        y_val_grouped.to_pickle(
-            os.path.join(output_dir, f"{iot_device}_val_labels_grouped.pkl"),
-            compression="gzip",
+        train, _, _ = preprocessor.split_positions(classes)
+        training = np.zeros(len(classes), dtype=bool)
+        training[train] = True
+        sample_index = (
+            pd.Series(train)
+            .sample(n=min(sample_size, len(train)), random_state=42)
+            .to_numpy()
         )
+        del classes, train
 
-        X_test.to_pickle(
-            os.path.join(output_dir, f"{iot_device}_test_features.pkl"),
-            compression="gzip",
-        )
-        y_test_not_grouped.to_pickle(
-            os.path.join(output_dir, f"{iot_device}_test_labels.pkl"),
-            compression="gzip",
+        # Then the statistics are fitted and the sample gathered one chunk at a time
+        scaler, samples, numeric_features, offset = StandardScaler(), [], None, 0
+        for chunk in chunks():
+            chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+            offset += len(chunk)
+            X = chunk.drop(columns=LABEL_COLUMNS)[training[chunk.index]]
+            if X.empty:
+                continue
+            if numeric_features is None:
+                numeric_features = preprocessor.numeric_features(X)
+            scaler.partial_fit(X[numeric_features])
+            samples.append(X[X.index.isin(sample_index)])
+        sample = pd.concat(samples).loc[sample_index]
+
+        metrics.rows_in, metrics.rows_out = len(training), len(sample)
+        metrics.bytes_read = store.device_size(iot_device)
+
+    gc.collect()
+
+    return scaler, sample
+
+
+def fit_global_artifact(
+    store,
+    preprocessor,
+    sample_size,
+    scheduler,
+    chunk_memory=DEFAULT_CHUNK_MEMORY,
+    time_order=False,
+):
+    """
+    Fit a single transformer for all devices.
+
+    The numerical statistics are merged across the training sets of every device, while
+    the remaining steps are fitted on a sample of at most sample_size training rows
+    drawn evenly from the devices.
+
+    Parameters:
+        store (DatasetStore): Partitioned store of the labelled files.
+        preprocessor (DataPreprocessor): Preprocessor providing the conversion steps.
+        sample_size (int): Maximum number of training rows used to fit the transformer.
+        scheduler (MemoryAwareScheduler): Scheduler running the devices in parallel.
+        chunk_memory (int): Target in-memory size of a chunk in bytes.
+        time_order (bool): Whether to read the partitions in time order.
+
+    Returns:
+        PreprocessorArtifact: The globally fitted artifact.
+    """
+    iot_devices = store.devices()
+    per_device_sample_size = max(1, sample_size // len(iot_devices))
+    results = scheduler.map(
+        device_statistics,
+        iot_devices,
+        store,
+        preprocessor,
+        per_device_sample_size,
+        chunk_memory,
+        time_order,
+    )
+    scalers, samples = zip(*results)
+
+    # Statistics are merged in device order so parallel and serial runs agree
+    numerical_statistics = preprocessor.merge_numerical_statistics(scalers)
+    transformer = preprocessor.fit_transformer(
+        pd.concat(samples, ignore_index=True),
+        numerical_statistics=numerical_statistics,
+    )
+    le, le_grouped = preprocessor.fit_label_encoders()
+
+    return PreprocessorArtifact(
+        transformer=transformer,
+        label_encoder=le,
+        label_grouped_encoder=le_grouped,
+        fit_mode="global",
+        devices=iot_devices,
+        n_samples_seen=numerical_statistics.n_samples_seen_,
+    )
+
+
+def finalise_device_data(iot_device, df, output_dir, preprocessor, artifact_path=None):
+    """
+    Split, scale and save the converted dataset of a single device.
+
+    Parameters:
+        iot_device (str): IoT device identifier.
+        df (pd.DataFrame): Converted dataset of the device.
+        output_dir (str): Directory where the processed files are written.
+        preprocessor (DataPreprocessor): Preprocessor providing the conversion steps.
+        artifact_path (str): Global artifact to transform with; when None a
+            per-device artifact is fitted and saved next to the outputs.
+
+    Returns:
+        tuple: Number of rows written and paths of the written files.
+    """
+    # Split data into training, validation, and testing sets
+    training_set, validation_set, testing_set = preprocessor.train_valid_test_split(df)
+
+    if artifact_path is None:
+        transformer = preprocessor.fit_transformer(training_set[0])
+        le, le_grouped = preprocessor.fit_label_encoders()
+        artifact = PreprocessorArtifact(
+            transformer=transformer,
+            label_encoder=le,
+            label_grouped_encoder=le_grouped,
+            fit_mode="per-device",
+            devices=[iot_device],
+            n_samples_seen=len(training_set[0]),
         )
-        y_test_grouped.to_pickle(
-            os.path.join(output_dir, f"{iot_device}_test_labels_grouped.pkl"),
-            compression="gzip",
+        artifact.save(os.path.join(output_dir, "artifacts"), iot_device)
+    else:
+        artifact = PreprocessorArtifact.load(artifact_path)
+
+    # Scale the data and split into features and labels
+    datasets = preprocessor.scale(
+        training_set, validation_set, testing_set, artifact=artifact
+    )
+
+    # Save the processed data to pickle files for each IoT device
+    paths = save_device_data(output_dir, iot_device, datasets)
+    n_rows = sum(len(X) for X, _, _ in datasets)
+
+    # Clean up memory by deleting intermediate variables and performing garbage collection
+    del training_set, validation_set, testing_set, datasets
+    gc.collect()
+
+    return n_rows, paths
+
+
+def device_inputs(iot_device, store, artifact_path=None):
+    """Return the input files of a device: its partitions and the global artifact."""
+    inputs = store.device_paths(iot_device)
+    if artifact_path is not None:
+        inputs.append(artifact_path)
+    return inputs
+
+
+def process_device(
+    iot_device,
+    store,
+    output_dir,
+    preprocessor,
+    artifact_path=None,
+    chunk_memory=DEFAULT_CHUNK_MEMORY,
+    journal=None,
+    time_order=False,
+):
+    """
+    Convert, split, scale and save the dataset of a single device.
+
+    Parameters:
+        iot_device (str): IoT device identifier.
+        store (DatasetStore): Partitioned store of the labelled files.
+        output_dir (str): Directory where the processed files are written.
+        preprocessor (DataPreprocessor): Preprocessor providing the conversion steps.
+        artifact_path (str): Global artifact to transform with; when None a
+            per-device artifact is fitted and saved next to the outputs.
+        chunk_memory (int): Target in-memory size of a chunk in bytes.
+        journal (CheckpointJournal): Journal the device is recorded in once saved.
+        time_order (bool): Whether to read the partitions in time order.
+    """
+    print(f"Processing {iot_device}")
+
+    with run_report(REPORT_DIR).stage("preprocess", iot_device) as metrics:
+        df = load_device_data(iot_device, store, preprocessor, chunk_memory, time_order)
+        metrics.rows_in = len(df)
+        metrics.bytes_read = store.device_size(iot_device)
+
+        metrics.rows_out, paths = finalise_device_data(
+            iot_device, df, output_dir, preprocessor, artifact_path
         )
+        metrics.wrote(*paths)
 
-        # Clean up memory by deleting intermediate variables and performing garbage collection
-        del (
-            chunk,
-            df,
-            training_set,
-            validation_set,
-            testing_set,
-            X_train,
-            y_train_not_grouped,
-            y_train_grouped,
-            X_val,
-            y_val_not_grouped,
-            y_val_grouped,
-            X_test,
-            y_test_not_grouped,
-            y_test_grouped,
+    if journal:
+        journal.record(
+            iot_device, device_inputs(iot_device, store, artifact_path), paths
         )
-        gc.collect()
 
+    del df
+    gc.collect()
+
+
+def process_csv_files(
+    store,
+    output_dir,
+    preprocessor,
+    fit_mode="per-device",
+    sample_size=1_000_000,
+    n_jobs=1,
+    memory_budget=None,
+    chunk_memory=DEFAULT_CHUNK_MEMORY,
+    journal=None,
+    time_order=False,
+):
+    """
+    Preprocess every device of the partitioned store.
+
+    Devices are processed in parallel by a memory-aware scheduler. Every device is split
+    with a fixed random state and the global statistics are merged in device order,
+    so the outputs do not depend on the number of jobs.
+
+    Parameters:
+        store (DatasetStore): Partitioned store of the labelled files.
+        output_dir (str): Directory where the processed files are written.
+        preprocessor (DataPreprocessor): Preprocessor providing the conversion steps.
+        fit_mode (str): "per-device" fits one transformer per device (federated
+            experiments), "global" fits one shared transformer for all devices.
+        sample_size (int): Maximum number of training rows used by the global fit.
+        n_jobs (int): Maximum number of devices processed in parallel.
+        memory_budget (int): Memory budget in bytes shared by the parallel jobs.
+        chunk_memory (int): Target in-memory size of the chunks read by every job.
+        journal (CheckpointJournal): Journal of the devices (and global artifact)
+            already processed, which are skipped.
+        time_order (bool): Whether to merge the partitions of every device into a
+            single time-ordered stream.
+    """
+    if fit_mode not in FIT_MODES:
+        raise ValueError(f"Unknown fit mode '{fit_mode}', expected one of {FIT_MODES}.")
+
+    iot_devices = store.devices()
+    if not iot_devices:
+        return
+
+    scheduler = MemoryAwareScheduler(
+        max_workers=n_jobs, memory_budget=memory_budget, size_of=store.device_size
+    )
+
+    artifact_path = None
+    if fit_mode == "global":
+        all_inputs = [
+            path for device in iot_devices for path in store.device_paths(device)
+        ]
+        if journal and journal.is_done("global-artifact", all_inputs):
+            (artifact_path,) = journal.outputs("global-artifact")
+            print(f"Global preprocessor already saved to {artifact_path}")
+        else:
+            artifact = fit_global_artifact(
+                store, preprocessor, sample_size, scheduler, chunk_memory, time_order
+            )
+            artifact_path = artifact.save(
+                os.path.join(output_dir, "artifacts"), "global"
+            )
+            print(f"Global preprocessor saved to {artifact_path}")
+            if journal:
+                journal.record("global-artifact", all_inputs, [artifact_path])
+
+    if journal:
+        remaining_devices = []
+        for iot_device in iot_devices:
+            inputs = device_inputs(iot_device, store, artifact_path)
+            if journal.is_done(iot_device, inputs):
+                print(f"{iot_device} already processed")
+            else:
+                remaining_devices.append(iot_device)
+        iot_devices = remaining_devices
+
+    scheduler.map(
+        process_device,
+        iot_devices,
+        store,
+        output_dir,
+        preprocessor,
+        artifact_path,
+        chunk_memory,
+        journal,
+        time_order,
+    )
+
+
+def main(argv=None):
+    """Preprocess the labelled partitions of every device."""
+    parser = argparse.ArgumentParser(description="Preprocess the processed datasets.")
+    parser.add_argument("--fit-mode", choices=FIT_MODES, default="per-device")
+    parser.add_argument("--sample-size", type=int, default=1_000_000)
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument("--memory-budget-gb", type=float, default=None)
+    parser.add_argument(
+        "--chunk-memory-mb",
+        type=float,
+        default=DEFAULT_CHUNK_MEMORY / 2**20,
+        help="Target in-memory size of the chunks read from the labelled files.",
+    )
+    parser.add_argument(
+        "--windows",
+        nargs="+",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="Add host statistics over sliding windows of these lengths, e.g. 1 10.",
+    )
+    parser.add_argument(
+        "--time-order",
+        action="store_true",
+        help="Merge the captures of every device in time order, so the sliding "
+        "windows span them (default is to read them one after the other).",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Keep the checkpoint once the run completes, so the next run only "
+        "reprocesses the devices whose labelled files changed, e.g. after relabelling.",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Ignore the checkpoint of an interrupted run.",
+    )
+    args = parser.parse_args(argv)
 
-if __name__ == "__main__":
     # Initialize data preprocessor with global values
     preprocessor = DataPreprocessor(
         port_hierarchy_map_iot=port_hierarchy_map_iot,
-        global_categorical_values=global_categorical_values,
+        categorical_vocabularies=categorical_vocabularies,
         global_label_values=global_label_values,
         global_label_grouped_values=global_label_grouped_values,
+        windows=args.windows,
     )
 
-    # Define input and output directories
-    input_dir = "./data/processed"
+    # Load the partition index built by data_preparation.py
+    store = DatasetStore.load(
+        os.path.join(DATA_DIR, "processed", DatasetStore.INDEX_FILENAME)
+    )
     output_dir = os.path.join(DATA_DIR, "final")
 
     os.makedirs(output_dir, exist_ok=True)  # Ensure output directory exists
 
-    # Process the CSV files
-    process_csv_files(input_dir, output_dir, preprocessor)
+    # Devices processed by an interrupted run with the same settings are skipped
+    journal = CheckpointJournal(
+        os.path.join(DATA_DIR, "checkpoints", "preprocess.jsonl"),
+        config={
+            "fit_mode": args.fit_mode,
+            "sample_size": args.sample_size,
+            "windows": args.windows,
+            "time_order": args.time_order,
+            "code": code_version(PREPROCESSING_CODE) if args.incremental else None,
+        },
+    )
+    if args.restart:
+        journal.reset()
+
+    # Process the partitions of every device
+    with run_report(REPORT_DIR).stage("preprocess"):
+        process_csv_files(
+            store,
+            output_dir,
+            preprocessor,
+            fit_mode=args.fit_mode,
+            sample_size=args.sample_size,
+            n_jobs=args.n_jobs,
+            memory_budget=(
+                int(args.memory_budget_gb * 1024**3)
+                if args.memory_budget_gb
+                else None
+            ),
+            chunk_memory=int(args.chunk_memory_mb * 2**20),
+            journal=journal,
+            time_order=args.time_order,
+        )
+    if not args.incremental:
+        journal.finish()
+
+
+if __name__ == "__main__":
+    main()
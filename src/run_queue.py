@@ -0,0 +1,293 @@
+import os
+import argparse
+import multiprocessing
+
+from src.helpers.dataset_store import DatasetStore
+from src.helpers.work_queue import WorkQueue, run_worker
+from src.run_labeling import add_sampling_arguments, sampling_options
+from src import *
+
+
+STAGES = ["extract", "label", "prepare", "preprocess"]
+
+
+def event_subdir(event):
+    return "benign" if event == "benign" else os.path.join("malicious", event)
+
+
+def list_files(directory, extension):
+    """Return the paths of the files of a directory tree, relative to DATA_DIR."""
+    return sorted(
+        os.path.relpath(os.path.join(root, file), DATA_DIR)
+        for root, _, files in os.walk(directory)
+        for file in files
+        if file.endswith(extension)
+    )
+
+
+def enqueue_units(
+    queue,
+    stages,
+    events,
+    artifact_path=None,
+    fields="projected",
+    sampling=None,
+    windows=None,
+):
+    """
+    Enqueue the units of the given stages: one per pcap file for extraction, one per
+    extracted file for labelling, a single indexing unit, and one per device for
+    preprocessing. Every unit runs after the units producing its inputs.
+
+    Paths are stored relative to the data directory, so workers mounting the shared data
+    at different places cooperate on the same queue.
+
+    Parameters:
+        queue (WorkQueue): Queue to add the units to.
+        stages (list): Stages to enqueue.
+        events (list): Events whose files are processed.
+        artifact_path (str): Global preprocessor artifact to transform with (default is a
+            per-device fit).
+        fields (str): Fields extracted, "projected" or "full" (see run_extraction).
+        sampling (dict): LabelSampler arguments of the labelling (see run_labeling).
+        windows (list): Sliding-window lengths of the preprocessing (see
+            run_preprocessing).
+
+    Returns:
+        list: Keys of the enqueued units.
+    """
+    keys = []
+    label_keys = []
+    # Devices are indexed from their benign files, see DatasetStore.build
+    devices = {
+        DatasetStore.device_from_filename(os.path.basename(path))
+        for path in list_files(os.path.join(DATA_DIR, "labelled", "benign"), ".csv")
+    }
+    for event in events:
+        subdir = event_subdir(event)
+        pcap_files = list_files(os.path.join(DATA_DIR, "raw", subdir), ".pcap")
+        csv_files = {
+            os.path.relpath(path, "raw").replace(".pcap", ".csv"): path
+            for path in pcap_files
+        }
+        if "extract" not in stages:
+            # Label whatever was extracted already
+            extracted_dir = os.path.join(DATA_DIR, "extracted_features", subdir)
+            csv_files = {
+                os.path.relpath(path, "extracted_features"): None
+                for path in list_files(extracted_dir, ".csv")
+            }
+
+        for csv_file, pcap_file in csv_files.items():
+            if event == "benign":
+                devices.add(
+                    DatasetStore.device_from_filename(os.path.basename(csv_file))
+                )
+
+            after = []
+            if "extract" in stages:
+                after = [
+                    queue.enqueue(
+                        "extract",
+                        pcap_file,
+                        args={
+                            "pcap_file": pcap_file,
+                            "output_file": os.path.join("extracted_features", csv_file),
+                            "fields": fields,
+                        },
+                    )
+                ]
+                keys += after
+
+            if "label" in stages:
+                key = queue.enqueue(
+                    "label",
+                    csv_file,
+                    args={
+                        "event": event,
+                        "csv_file": os.path.join("extracted_features", csv_file),
+                        "output_file": os.path.join("labelled", csv_file),
+                        "sampling": sampling,
+                    },
+                    after=after,
+                )
+                keys.append(key)
+                label_keys.append(key)
+
+    prepare_keys = []
+    if "prepare" in stages:
+        prepare_keys = [queue.enqueue("prepare", "index", after=label_keys)]
+        keys += prepare_keys
+
+    if "preprocess" in stages:
+        for iot_device in sorted(devices):
+            keys.append(
+                queue.enqueue(
+                    "preprocess",
+                    iot_device,
+                    args={
+                        "iot_device": iot_device,
+                        "artifact_path": artifact_path,
+                        "windows": windows,
+                    },
+                    after=prepare_keys,
+                )
+            )
+    return keys
+
+
+# The handlers import their stage lazily, so a worker only loads what its units need
+
+
+def extract_unit(pcap_file, output_file, fields="projected"):
+    from src.helpers.utils import load_json_file
+    from src.run_extraction import extract_pcap_file, extraction_fields
+
+    features = extraction_fields(
+        [f["field"] for f in load_json_file(FEATURES_PATH)["features"]], fields
+    )
+    output_file = os.path.join(DATA_DIR, output_file)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    extract_pcap_file(os.path.join(DATA_DIR, pcap_file), output_file, features)
+
+
+def label_unit(event, csv_file, output_file, sampling=None):
+    from src.run_labeling import build_labeller, label_csv_file
+
+    malicious_metadata_path = None
+    if event != "benign":
+        malicious_metadata_path = os.path.join(METADATA_DIR, f"metadata-{event}.json")
+    labeller = build_labeller(
+        os.path.join(METADATA_DIR, "metadata-benign.json"), malicious_metadata_path
+    )
+
+    output_file = os.path.join(DATA_DIR, output_file)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    label_csv_file(labeller, os.path.join(DATA_DIR, csv_file), output_file, sampling)
+
+
+def prepare_unit():
+    from src.run_preparation import main as run_preparation
+
+    run_preparation([])
+
+
+def preprocess_unit(iot_device, artifact_path=None, windows=None):
+    from src.config import (
+        port_hierarchy_map_iot,
+        categorical_vocabularies,
+        global_label_values,
+        global_label_grouped_values,
+    )
+    from src.helpers.preprocessor import DataPreprocessor
+    from src.run_preprocessing import process_device
+
+    preprocessor = DataPreprocessor(
+        port_hierarchy_map_iot=port_hierarchy_map_iot,
+        categorical_vocabularies=categorical_vocabularies,
+        global_label_values=global_label_values,
+        global_label_grouped_values=global_label_grouped_values,
+        windows=windows,
+    )
+    store = DatasetStore.load(
+        os.path.join(DATA_DIR, "processed", DatasetStore.INDEX_FILENAME)
+    )
+    output_dir = os.path.join(DATA_DIR, "final")
+    os.makedirs(output_dir, exist_ok=True)
+    process_device(iot_device, store, output_dir, preprocessor, artifact_path)
+
+
+HANDLERS = {
+    "extract": extract_unit,
+    "label": label_unit,
+    "prepare": prepare_unit,
+    "preprocess": preprocess_unit,
+}
+
+
+def worker(queue_dir, lease_seconds, poll_interval, wait):
+    """Run a worker process on the queue."""
+    queue = WorkQueue(queue_dir, lease_seconds=lease_seconds)
+    stats = run_worker(
+        queue, HANDLERS, poll_interval=poll_interval, stop_when_drained=not wait
+    )
+    print(
+        f"[{queue.worker_id}] {stats['done']} done, {stats['failed']} failed, "
+        f"{stats['lost']} lost"
+    )
+
+
+def main(argv=None):
+    """Enqueue units in a shared work queue, or work on it."""
+    parser = argparse.ArgumentParser(
+        description="Share the pipeline stages between workers on one or many hosts "
+        "through a work queue directory on a shared filesystem."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="Add units to the queue.")
+    enqueue_parser.add_argument("queue_dir")
+    enqueue_parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    enqueue_parser.add_argument("--events", nargs="+", choices=EVENTS, default=EVENTS)
+    enqueue_parser.add_argument(
+        "--artifact",
+        default=None,
+        help="Global preprocessor artifact to transform with (default is a per-device fit).",
+    )
+    enqueue_parser.add_argument(
+        "--fields", choices=["projected", "full"], default="projected"
+    )
+    add_sampling_arguments(enqueue_parser)
+    enqueue_parser.add_argument("--windows", nargs="+", type=float, default=None)
+
+    worker_parser = subparsers.add_parser("worker", help="Work on the queue.")
+    worker_parser.add_argument("queue_dir")
+    worker_parser.add_argument(
+        "--processes", type=int, default=1, help="Worker processes on this host."
+    )
+    worker_parser.add_argument("--lease-seconds", type=float, default=600)
+    worker_parser.add_argument("--poll-interval", type=float, default=5.0)
+    worker_parser.add_argument(
+        "--wait", action="store_true", help="Keep waiting for units once drained."
+    )
+
+    status_parser = subparsers.add_parser("status", help="Count the units per state.")
+    status_parser.add_argument("queue_dir")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "enqueue":
+        keys = enqueue_units(
+            WorkQueue(args.queue_dir),
+            args.stages,
+            args.events,
+            args.artifact,
+            args.fields,
+            sampling_options(args),
+            args.windows,
+        )
+        print(f"{len(keys)} units in the queue")
+    elif args.command == "worker":
+        worker_args = (
+            args.queue_dir,
+            args.lease_seconds,
+            args.poll_interval,
+            args.wait,
+        )
+        if args.processes == 1:
+            worker(*worker_args)
+        else:
+            processes = [
+                multiprocessing.Process(target=worker, args=worker_args)
+                for _ in range(args.processes)
+            ]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+    else:
+        print(WorkQueue(args.queue_dir).counts())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import os
+
+import pandas as pd
+import pytest
+
+from src.config import (
+    categorical_vocabularies,
+    global_label_grouped_values,
+    global_label_values,
+    port_hierarchy_map_iot,
+)
+from src.helpers.fields import PROJECTED_FIELDS
+from src.helpers.flow_table import FlowTable
+from src.helpers.labeller import Labeller
+from src.helpers.preprocessor import DataPreprocessor
+from src.helpers.schema import load_schema
+from src.helpers.tsv_reader import read_tsv
+from src.helpers.window_features import WindowFeatureEngine
+from src.run_preprocessing import convert_chunk
+from benchmarks.generator import GothamTrafficGenerator
+from benchmarks.run_benchmarks import (
+    FEATURES_PATH,
+    METADATA_DIR,
+    files_under,
+    labeller_for,
+)
+
+
+STAGES = [Labeller, DataPreprocessor, WindowFeatureEngine, FlowTable]
+
+
+@pytest.fixture(scope="module")
+def captures(tmp_path_factory):
+    """Generated captures with every configured field, with their Labeller."""
+    root = str(tmp_path_factory.mktemp("data"))
+    generator = GothamTrafficGenerator(METADATA_DIR, FEATURES_PATH, n_devices=2)
+    generator.generate(root, 500, ["benign", "mirai-dos"], write_pcaps=False)
+
+    schema = load_schema(FEATURES_PATH)
+    paths = files_under(os.path.join(root, "extracted_features"), ".csv")
+    assert paths
+    return [
+        (
+            os.path.basename(path),
+            labeller_for(path),
+            schema.apply(read_tsv(path, schema)),
+        )
+        for path in paths
+    ]
+
+
+def only(df, fields):
+    """Keep the given fields of a frame, once each, with its other columns dropped."""
+    return df[list(dict.fromkeys(fields))].copy()
+
+
+@pytest.mark.parametrize("stage", STAGES, ids=lambda stage: stage.__name__)
+def test_required_fields_are_projected(stage):
+    assert set(stage.REQUIRED_FIELDS) <= set(PROJECTED_FIELDS)
+
+
+def test_labeller_reads_only_its_fields(captures):
+    for filename, labeller, df in captures:
+        expected = labeller.label_data(filename, df.copy())
+        result = labeller.label_data(filename, only(df, Labeller.REQUIRED_FIELDS))
+        pd.testing.assert_frame_equal(result, expected[result.columns])
+
+
+def test_conversion_reads_only_its_fields(captures):
+    preprocessor = DataPreprocessor(
+        port_hierarchy_map_iot=port_hierarchy_map_iot,
+        categorical_vocabularies=categorical_vocabularies,
+        global_label_values=global_label_values,
+        global_label_grouped_values=global_label_grouped_values,
+        windows=[1.0, 10.0],
+    )
+    fields = DataPreprocessor.REQUIRED_FIELDS + WindowFeatureEngine.REQUIRED_FIELDS
+    for filename, labeller, df in captures:
+        labelled = labeller.label_data(filename, df.copy())
+        expected = convert_chunk(
+            labelled.copy(), preprocessor, preprocessor.window_engine()
+        )
+        result = convert_chunk(
+            only(labelled, fields + ["label"]),
+            preprocessor,
+            preprocessor.window_engine(),
+        )
+        pd.testing.assert_frame_equal(result, expected)
+
+
+def test_flow_table_reads_only_its_fields(captures):
+    for _, _, df in captures:
+        flows = []
+        for chunk in [df, only(df, FlowTable.REQUIRED_FIELDS)]:
+            table = FlowTable()
+            flows.append(pd.concat([table.update(chunk), table.flush()]))
+        pd.testing.assert_frame_equal(flows[1], flows[0])
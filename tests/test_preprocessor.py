@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from sklearn.model_selection import train_test_split
+
+from src.config import (
+    categorical_vocabularies,
+    global_label_grouped_values,
+    global_label_values,
+    port_hierarchy_map_iot,
+)
+from src.helpers.preprocessor import DataPreprocessor
+
+
+# Labels joining into text ordered unlike the pairs themselves, e.g. "a z" > "a b a"
+LABELS = ["a", "a b", "z", "Benign", "Mirai DoS", ""]
+CATEGORIES = ["a", "z", "b a", "Benign", "Attack"]
+
+
+def preprocessor():
+    return DataPreprocessor(
+        port_hierarchy_map_iot=port_hierarchy_map_iot,
+        categorical_vocabularies=categorical_vocabularies,
+        global_label_values=global_label_values,
+        global_label_grouped_values=global_label_grouped_values,
+    )
+
+
+def dataset(seed, n_rows=2000):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "value": np.arange(n_rows),
+            "label": rng.choice(LABELS, n_rows),
+            "label_category": rng.choice(CATEGORIES, n_rows),
+        }
+    )
+
+
+def stratified_on_labels(preprocessor, df):
+    """The split stratified on the frame of labels, as sklearn joins its rows."""
+    labels = df[["label", "label_category"]]
+    features = df.drop(columns=["label", "label_category"])
+    held_out = preprocessor.validation_size + preprocessor.testing_size
+    X_train, X_test, y_train, y_test = train_test_split(
+        features, labels, test_size=held_out, random_state=42, stratify=labels
+    )
+    X_test, X_val, y_test, y_val = train_test_split(
+        X_test,
+        y_test,
+        test_size=preprocessor.testing_size / held_out,
+        random_state=42,
+    )
+    return (X_train, y_train), (X_val, y_val), (X_test, y_test)
+
+
+def test_split_is_stratified_on_the_labels():
+    for seed in range(5):
+        df = dataset(seed)
+        expected = stratified_on_labels(preprocessor(), df)
+        result = preprocessor().train_valid_test_split(df)
+        for (X, y), (X_expected, y_expected) in zip(result, expected):
+            pd.testing.assert_frame_equal(X, X_expected)
+            pd.testing.assert_frame_equal(y, y_expected)
+
+
+def test_split_of_the_classes_of_chunks():
+    df = dataset(0)
+    chunks = np.array_split(np.arange(len(df)), 7)
+    classes = union_categoricals(
+        [preprocessor().label_classes(df.iloc[chunk]) for chunk in chunks],
+        sort_categories=True,
+    )
+    splits = preprocessor().split_positions(classes)
+    expected = preprocessor().split_positions(preprocessor().label_classes(df))
+    for positions, expected_positions in zip(splits, expected):
+        np.testing.assert_array_equal(positions, expected_positions)
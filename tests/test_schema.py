@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from src.helpers.schema import KINDS, PacketSchema, field_kinds, load_schema
+from benchmarks.run_benchmarks import FEATURES_PATH
+
+
+def write_config(tmp_path, features):
+    path = tmp_path / "features.json"
+    path.write_text(json.dumps({"features": features}))
+    return str(path)
+
+
+def test_configured_fields_have_a_kind():
+    with open(FEATURES_PATH) as f:
+        fields = [feature["field"] for feature in json.load(f)["features"]]
+    kinds = field_kinds(FEATURES_PATH)
+    assert list(kinds) == fields
+    assert set(kinds.values()) <= set(KINDS)
+    assert load_schema(FEATURES_PATH).kinds == kinds
+
+
+def test_field_without_a_type_is_an_error(tmp_path):
+    path = write_config(
+        tmp_path,
+        [{"field": "ip.ttl", "type": "uint8"}, {"field": "ip.len"}],
+    )
+    with pytest.raises(ValueError, match="ip.len .* has no type"):
+        field_kinds(path)
+
+
+def test_unknown_type_is_an_error(tmp_path):
+    path = write_config(tmp_path, [{"field": "ip.len", "type": "uint64"}])
+    with pytest.raises(ValueError, match="Unknown field kinds"):
+        load_schema(path)
+
+
+def test_extracted_fields():
+    kinds = field_kinds(FEATURES_PATH)
+    schema = PacketSchema.from_features(["frame.number", "ip.ttl"], kinds)
+    assert schema.kinds == {"frame.number": "uint32", "ip.ttl": "uint8"}
+    with pytest.raises(ValueError, match="ip.len"):
+        PacketSchema.from_features(["ip.ttl", "ip.len"], kinds)
@@ -0,0 +1,137 @@
+import io
+
+import pandas as pd
+import pytest
+
+from src.helpers import tsv_reader
+from src.helpers.schema import PacketSchema, load_schema
+from src.helpers.tsv_reader import NA_VALUES, open_tsv, read_tsv
+from benchmarks.generator import GothamTrafficGenerator
+from benchmarks.run_benchmarks import FEATURES_PATH, METADATA_DIR, files_under
+
+
+SCHEMA = PacketSchema(
+    {
+        "frame.time": "time",
+        "ip.src": "ipv4",
+        "ip.flags": "hex8",
+        "ip.ttl": "uint8",
+        "tcp.srcport": "port",
+        "tcp.options": "text",
+        "frame.protocols": "category",
+    }
+)
+
+# Typed fields, then columns without a read dtype whose type is inferred
+COLUMNS = list(SCHEMA.kinds) + ["label", "num", "hex", "date", "float", "empty", "bool"]
+
+CHUNK_SIZES = [1000, 77]
+
+
+def row(i, bad=False):
+    return [
+        "Oct 10, 2024 15:00:00.%06d000" % i,
+        f"10.0.0.{i % 5}",
+        "0x02",
+        "x" if bad else str(64 + i % 3),
+        "" if i % 4 else str(i),
+        "NA" if i % 3 else "02,04",
+        ["eth:ip", "eth:ip:tcp", ""][i % 3],
+        ["Benign", "Mirai"][i % 2],
+        str(i),
+        "0x1f",
+        "2024-10-10",
+        str(i / 7),
+        "",
+        ["True", "false"][i % 2],
+    ]
+
+
+def write(path, n_rows, bad_at=None):
+    with open(path, "w") as f:
+        f.write("\t".join(COLUMNS) + "\n")
+        for i in range(n_rows):
+            f.write("\t".join(row(i, i == bad_at)) + "\n")
+    return path
+
+
+def chunks(path, schema, engine):
+    out = []
+    with open_tsv(path, schema, engine=engine) as reader:
+        while True:
+            try:
+                out.append(reader.get_chunk(CHUNK_SIZES[len(out) % len(CHUNK_SIZES)]))
+            except StopIteration:
+                return out
+
+
+def assert_same_frames(path, schema, apply=True):
+    """Check both engines read a file, whole and in chunks, into the same frames."""
+    expected = read_tsv(path, schema, engine="pandas")
+    result = read_tsv(path, schema, engine="pyarrow")
+    pd.testing.assert_frame_equal(result, expected)
+    if apply:
+        pd.testing.assert_frame_equal(
+            schema.apply(result.copy()), schema.apply(expected.copy())
+        )
+
+    with open(path, "rb") as f:
+        buffered = read_tsv(io.BytesIO(f.read()), schema, engine="pyarrow")
+    pd.testing.assert_frame_equal(buffered, expected)
+
+    expected_chunks = chunks(path, schema, "pandas")
+    result_chunks = chunks(path, schema, "pyarrow")
+    assert len(result_chunks) == len(expected_chunks)
+    for result, expected in zip(result_chunks, expected_chunks):
+        pd.testing.assert_frame_equal(result, expected)
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    """Parse the files in many small blocks, several per read, as on a large file."""
+    monkeypatch.setattr(tsv_reader, "ARROW_BLOCK_SIZE", 2**16)
+    monkeypatch.setattr(tsv_reader, "MIN_STREAM_BLOCK_SIZE", 2**12)
+    monkeypatch.setattr(tsv_reader, "ARROW_THREADS", 4)
+
+
+def test_engines_read_the_same_frames(tmp_path):
+    assert_same_frames(write(tmp_path / "rows.tsv", 20000), SCHEMA)
+
+
+@pytest.mark.parametrize("bad_at", [3, 15000], ids=["first-block", "later-block"])
+def test_text_in_a_typed_column_falls_back_to_pandas(tmp_path, bad_at):
+    path = write(tmp_path / "rows.tsv", 20000, bad_at=bad_at)
+    assert_same_frames(path, SCHEMA, apply=False)
+
+
+def test_header_only_file(tmp_path):
+    assert_same_frames(write(tmp_path / "header.tsv", 0), SCHEMA)
+
+
+@pytest.mark.parametrize("engine", ["pandas", "pyarrow"])
+def test_empty_file(tmp_path, engine):
+    path = tmp_path / "empty.tsv"
+    path.touch()
+    with pytest.raises(pd.errors.EmptyDataError, match="No columns to parse"):
+        read_tsv(path, SCHEMA, engine=engine)
+    with pytest.raises(pd.errors.EmptyDataError, match="No columns to parse"):
+        with open_tsv(path, SCHEMA, engine=engine) as reader:
+            reader.get_chunk(10)
+
+
+def test_generated_captures(tmp_path):
+    generator = GothamTrafficGenerator(METADATA_DIR, FEATURES_PATH, n_devices=2)
+    generator.generate(str(tmp_path), 500, ["benign", "mirai-dos"], write_pcaps=False)
+    paths = files_under(str(tmp_path / "extracted_features"), ".csv")
+    assert paths
+    schema = load_schema(FEATURES_PATH)
+    for path in paths:
+        assert_same_frames(path, schema)
+
+
+def test_na_values_are_the_missing_values_of_pandas():
+    text = "key\tvalue\n" + "".join(
+        f"{i}\t{value}\n" for i, value in enumerate(NA_VALUES)
+    )
+    values = pd.read_csv(io.StringIO(text), sep="\t", dtype=str)["value"]
+    assert values.isna().all()
@@ -0,0 +1,126 @@
+import os
+import json
+import collections
+import time
+import signal
+import contextlib
+import multiprocessing
+
+from src.helpers.work_queue import WorkQueue, run_worker
+
+
+N_WORKERS = 4
+N_UNITS = 40
+LEASE_SECONDS = 1.0
+
+# Unit whose first run hangs until its worker is killed
+VICTIM = 7
+
+# Unit whose first run is frozen until another worker did it, then finishes
+STALLED = 11
+
+
+def first_run(name, marker_dir):
+    """Return True on the first run of a unit, writing the pid of its worker."""
+    try:
+        fd = os.open(
+            os.path.join(marker_dir, name), os.O_CREAT | os.O_EXCL | os.O_WRONLY
+        )
+    except FileExistsError:
+        return False
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+    return True
+
+
+def run_unit(i, marker_dir):
+    if i == VICTIM and first_run("victim", marker_dir):
+        time.sleep(600)
+    if i == STALLED and first_run("stalled", marker_dir):
+        os.kill(os.getpid(), signal.SIGSTOP)  # Freezes the lease renewal too
+    time.sleep(0.01)
+
+
+def worker(root, marker_dir):
+    queue = WorkQueue(root, lease_seconds=LEASE_SECONDS)
+    handler = lambda i: run_unit(i, marker_dir)  # noqa: E731
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        stats = run_worker(queue, {"unit": handler}, poll_interval=0.05)
+    with open(os.path.join(marker_dir, f"stats-{os.getpid()}.json"), "w") as f:
+        json.dump(stats, f)
+
+
+def wait_for(condition, message, timeout=60):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, message
+        time.sleep(0.05)
+
+
+def marker_pid(marker_dir, name):
+    path = os.path.join(marker_dir, name)
+    wait_for(lambda: os.path.exists(path) and os.path.getsize(path), f"No {name} run")
+    with open(path) as f:
+        return int(f.read())
+
+
+def test_killed_worker_units_are_done_exactly_once(tmp_path):
+    root, marker_dir = str(tmp_path / "queue"), str(tmp_path)
+    queue = WorkQueue(root, lease_seconds=LEASE_SECONDS)
+    keys = [queue.enqueue("unit", str(i), {"i": i}) for i in range(N_UNITS)]
+    # Units depending on the victim, which only run once it is re-run
+    for i in range(N_UNITS, N_UNITS + 5):
+        keys.append(queue.enqueue("unit", str(i), {"i": i}, after=[keys[VICTIM]]))
+
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=worker, args=(root, marker_dir))
+        for _ in range(N_WORKERS)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        os.kill(marker_pid(marker_dir, "victim"), signal.SIGKILL)
+
+        # Resume the frozen worker once its unit was re-queued and done by another
+        stalled = marker_pid(marker_dir, "stalled")
+        done = queue.path("done", keys[STALLED])
+        wait_for(lambda: os.path.exists(done), "The stalled unit was not re-run")
+        os.kill(stalled, signal.SIGCONT)
+
+        for process in processes:
+            process.join(timeout=120)
+            assert not process.is_alive(), "A worker did not drain the queue"
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.kill()
+
+    assert queue.counts() == {
+        "pending": 0,
+        "claimed": 0,
+        "done": len(keys),
+        "failed": 0,
+    }
+    finishers = collections.Counter()
+    for key in keys:
+        with open(queue.path("done", key)) as f:
+            unit = json.load(f)
+        finished = [claim for claim in unit["history"] if "finished" in claim]
+        assert len(finished) == 1
+        finishers[int(finished[0]["worker"].split(":")[1])] += 1
+        if key in [keys[VICTIM], keys[STALLED]]:
+            assert unit["attempts"] == 2
+
+    # Every surviving worker counted the units it finished, the frozen one its lost
+    # lease
+    stats = {}
+    for filename in os.listdir(marker_dir):
+        if filename.startswith("stats-"):
+            with open(os.path.join(marker_dir, filename)) as f:
+                stats[int(filename[len("stats-") : -len(".json")])] = json.load(f)
+    assert len(stats) == N_WORKERS - 1
+    for pid, worker_stats in stats.items():
+        assert worker_stats["done"] == finishers[pid]
+        assert worker_stats["failed"] == 0
+        assert worker_stats["lost"] == (pid == stalled)